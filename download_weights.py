@@ -1,13 +1,18 @@
+import json
 import os
+import struct
 import tyro
-import torch
 import ml_dtypes
-import jax.numpy as jnp
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, Tuple
+
+from entropix.packed import PACKED_NAME, PackedWriter
+
+
+SAFETENSORS_DTYPES = {'BF16': ml_dtypes.bfloat16, 'F16': np.float16, 'F32': np.float32}
 
-from transformers import AutoModelForCausalLM
-from unittest.mock import patch
-from transformers.dynamic_module_utils import get_imports
 
 def translate_key(in_key: str):
     out_key = in_key.replace('.weight', '')
@@ -50,21 +55,41 @@ def translate_key(in_key: str):
     return f'{out_key}.weight'
 
 
-def reverse_permute(tensor: torch.Tensor, n_heads: int = 32, dim1:int = 4096, dim2: int = 4096) -> torch.Tensor:
-    return tensor.view(n_heads, 2, dim1 // n_heads // 2, dim2).transpose(1, 2).reshape(dim1, dim2)
+def reverse_permute(tensor: np.ndarray, n_heads: int = 32, dim1:int = 4096, dim2: int = 4096) -> np.ndarray:
+    return tensor.reshape(n_heads, 2, dim1 // n_heads // 2, dim2).transpose(0, 2, 1, 3).reshape(dim1, dim2)
 
 
+def permute_args(config: dict) -> Dict[str, Tuple[int, int, int]]:
+    """`reverse_permute` (n_heads, dim1, dim2) for wq and wk, from the HF `config.json`."""
+    dim = config['hidden_size']
+    n_heads = config['num_attention_heads']
+    n_kv_heads = config.get('num_key_value_heads', n_heads)
+    head_dim = config.get('head_dim') or dim // n_heads
+    return {
+        'wq.weight': (n_heads, n_heads * head_dim, dim),
+        'wk.weight': (n_kv_heads, n_kv_heads * head_dim, dim),
+    }
 
-def fixed_get_imports(filename: str | os.PathLike) -> list[str]:
-    """Work around for https://huggingface.co/microsoft/phi-1_5/discussions/72."""
-    if not str(filename).endswith("/modeling_deepseek.py"):
-        return get_imports(filename)
-    imports = get_imports(filename)
-    imports.remove("flash_attn")
-    return imports
 
+def mmap_safetensors(path: Path) -> Dict[str, np.ndarray]:
+    """Zero-copy views of every tensor in a `.safetensors` file; nothing is read until a view is used."""
+    with open(path, 'rb') as f:
+        (n,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(n))
+    header.pop('__metadata__', None)
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    views = {}
+    for name, spec in header.items():
+        start, end = spec['data_offsets']
+        views[name] = buf[8 + n + start:8 + n + end].view(SAFETENSORS_DTYPES[spec['dtype']]).reshape(spec['shape'])
+    return views
 
-def main(model_id: str, out_dir: Path):
+
+def download(model_id: str) -> Path:
+    """Local snapshot of the safetensors shards and config of `model_id` (or `model_id` itself if it is a directory)."""
+    if Path(model_id).is_dir():
+        return Path(model_id)
+    from huggingface_hub import snapshot_download
     t_paths_candidates = [
         Path.home() / '.hf_token',
         Path.home() / '.cache' / 'huggingface' / 'token'
@@ -74,45 +99,60 @@ def main(model_id: str, out_dir: Path):
         if t_path.exists():
             token = t_path.read_text().strip()
             break
-    if not out_dir.exists():
-        out_dir.mkdir(parents=True, exist_ok=True)
-
-
-    with patch("transformers.dynamic_module_utils.get_imports", fixed_get_imports):
-      token = t_path.read_text().strip()
-      hf_model = AutoModelForCausalLM.from_pretrained(model_id,torch_dtype=torch.bfloat16, offload_folder="/tmp/offload", token=token)
-      with torch.no_grad():
-        state_dict = hf_model.state_dict()
-        for hf_name, param in state_dict.items():
-            print(f' {hf_name}: {param.shape=}')
-            name = translate_key(hf_name)
-            if name.endswith('wq.weight'):
-                param = reverse_permute(param, n_heads=32, dim1=2048, dim2=2048)  # 1B
-                #param = reverse_permute(param, n_heads=24, dim1=3072, dim2=3072)  # 3B
-                #param = reverse_permute(param, n_heads=32, dim1=4096, dim2=4096)  # 7B
-                #param = reverse_permute(param, n_heads=64, dim1=8192, dim2=8192)   # 70B
-                #param = reverse_permute(param, n_heads=96, dim1=12288, dim2=12288)   # 123B
-                #param = reverse_permute(param, n_heads=128, dim1=16384, dim2=16384) # 405B
-                #param = reverse_permute(param, n_heads=128, dim1=12288, dim2=12288) # DSV2
-                #param = reverse_permute(param, n_heads=64, dim1=12288, dim2=12288) # Commandr+
-                #param = reverse_permute(param, n_heads=48, dim1=6144, dim2=6144)    # Mixtral8x22B
-            elif name.endswith('wk.weight'): #wk.weight
-                param = reverse_permute(param, n_heads=8, dim1=512, dim2=2048)  # 1B
-                #param = reverse_permute(param, n_heads=8, dim1=1024, dim2=3072)  # 3B
-                #param = reverse_permute(param, n_heads=8, dim1=1024, dim2=4096)  # 7B
-                #param = reverse_permute(param, n_heads=8, dim1=1024, dim2=8192)   # 70B
-                #param = reverse_permute(param, n_heads=8, dim1=1024, dim2=12288)   # 123B
-                #param = reverse_permute(param, n_heads=8, dim1=1024, dim2=16384)  # 405B
-                #param = reverse_permute(param, n_heads=128, dim1=12288, dim2=12288)  # DSV2
-                #param = reverse_permute(param, n_heads=8, dim1=1024, dim2=12288)  # Commandr+
-                #param = reverse_permute(param, n_heads=8, dim1=1024, dim2=6144)    # Mixtral8x22B
-            else:
-                pass
-            bf16_np_out = param.cpu().view(dtype=torch.uint16).numpy().view(ml_dtypes.bfloat16)
-            bf16_out = jnp.asarray(bf16_np_out, dtype=jnp.bfloat16).reshape(*param.shape)
-            print(f'Writing {hf_name} as {name} to {out_dir}/{name}.npy')
-            jnp.save(f'{out_dir}/{name}.npy', bf16_out)
+    return Path(snapshot_download(model_id, allow_patterns=['*.safetensors', 'config.json'], token=token))
+
+
+def main(model_id: str, out_dir: Path, packed: bool = False, workers: int = 8):
+    """
+    Converts the safetensors shards of `model_id` one tensor at a time, `workers` tensors in parallel.
+
+    Writes one `.npy` per tensor, or with `packed` a single `weights.packed` file (see `entropix/packed.py`).
+    Tensors already written by an interrupted run are skipped.
+    """
+    model_dir = download(model_id)
+    config = json.loads((model_dir / 'config.json').read_text())
+    permute = permute_args(config)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    tensors = {}
+    for shard in sorted(model_dir.glob('*.safetensors')):
+        for hf_name, view in mmap_safetensors(shard).items():
+            tensors[translate_key(hf_name)] = (hf_name, view)
+    if 'output.weight' not in tensors and config.get('tie_word_embeddings', False):
+        tensors['output.weight'] = ('model.embed_tokens.weight', tensors['tok_embeddings.weight'][1])
+
+    writer = None
+    if packed:
+        writer = PackedWriter(out_dir / PACKED_NAME, {name: ('bfloat16', view.shape) for name, (_, view) in tensors.items()}, resume=True)
+
+    def convert(name: str, hf_name: str, view: np.ndarray) -> str:
+        param = np.asarray(view).astype(ml_dtypes.bfloat16)
+        suffix = '.'.join(name.split('.')[-2:])
+        if suffix in permute:
+            param = reverse_permute(param, *permute[suffix])
+        if writer is not None:
+            writer.write(name, param)
+            return f'Wrote {hf_name} as {name} to {out_dir}/{PACKED_NAME}'
+        # Written under a temporary name and renamed, so an existing `.npy` is always complete.
+        tmp = out_dir / f'{name}.npy.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, param)
+        os.replace(tmp, out_dir / f'{name}.npy')
+        return f'Wrote {hf_name} as {name} to {out_dir}/{name}.npy'
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = []
+        for name, (hf_name, view) in tensors.items():
+            done = name in writer.written if writer is not None else (out_dir / f'{name}.npy').exists()
+            if done:
+                print(f'Skipping {name}, already written')
+                continue
+            jobs.append(pool.submit(convert, name, hf_name, view))
+        for job in jobs:
+            print(job.result())
+    if writer is not None:
+        writer.close()
 
 
 if __name__ == "__main__":
-    tyro.cli(main)
\ No newline at end of file
+    tyro.cli(main)
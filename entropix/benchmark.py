@@ -0,0 +1,285 @@
+import contextlib
+import json
+import platform
+import resource
+import subprocess
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import torch
+import tyro
+
+from entropix.config import LLAMA_1B_PARAMS, ModelParams
+from entropix.kvcache import KVCache, bucket_len
+from entropix.main import build_attn_mask, precompute_freqs_cis
+from entropix.model import xfmr, xfmr_scan
+from entropix.sampler import BRANCH_NAMES, SamplerConfig, calculate_varentropy_logsoftmax, sample, sample_jit
+from entropix.stats import AttnStats, layer_stats
+from entropix.weights import random_weights
+
+# name -> (model params, vocab size, ffn dim; None for `random_weights`' default)
+PRESETS: Dict[str, Tuple[ModelParams, int, Optional[int]]] = {
+  'tiny': (ModelParams(n_layers=2, n_local_heads=4, n_local_kv_heads=2, head_dim=32, max_seq_len=1024, rope_theta=500000.0, use_scaled_rope=True), 4096, None),
+  '1B': (LLAMA_1B_PARAMS, 128256, None),
+  '8B': (LLAMA_1B_PARAMS._replace(n_layers=32, head_dim=128), 128256, 14336),
+}
+
+def percentiles(times: List[float]) -> Dict[str, float]:
+  ms = np.array(times) * 1e3
+  return {'p50_ms': float(np.percentile(ms, 50)), 'p99_ms': float(np.percentile(ms, 99))}
+
+
+def reset_peak_rss():
+  """Restarts the kernel's resident set high-water mark (Linux only, otherwise peaks are since process start)."""
+  with contextlib.suppress(OSError):
+    Path('/proc/self/clear_refs').write_text('5')
+
+
+def peak_rss_bytes() -> int:
+  try:
+    for line in Path('/proc/self/status').read_text().splitlines():
+      if line.startswith('VmHWM:'):
+        return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def peak_device_bytes(backend: str) -> Optional[int]:
+  if backend == 'torch':
+    return torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+  stats = jax.devices()[0].memory_stats()
+  return stats.get('peak_bytes_in_use') if stats else None
+
+
+def sampler_cases(vocab_size: int, cfg: SamplerConfig = SamplerConfig()) -> Dict[str, np.ndarray]:
+  """
+  (1, 1, vocab) logits landing in each `sample` quadrant: `m` tokens raised by `a` over a flat rest,
+  searched until the entropy and varentropy clear both the JAX thresholds in `cfg` and the
+  Torch sampler's hard-coded ones.
+  """
+  lo_ent, hi_ent = cfg.low_ent_thresh, max(cfg.med_ent_thresh, cfg.high_ent_thresh)
+  mid_ent = min(cfg.med_ent_thresh, cfg.high_ent_thresh)
+  targets = {
+    'low_ent_low_vent': lambda e, v: e < lo_ent and v < cfg.low_vent_thresh,
+    'high_ent_low_vent': lambda e, v: e > hi_ent and v < cfg.low_vent_thresh,
+    'low_ent_high_vent': lambda e, v: e < mid_ent and v > cfg.high_vent_thresh,
+    'high_ent_high_vent': lambda e, v: e > hi_ent and v > cfg.high_vent_thresh,
+    'adaptive': lambda e, v: lo_ent < e < mid_ent and cfg.low_vent_thresh < v < cfg.high_vent_thresh,
+  }
+  cases = {}
+  for m in (1, 2, 4, 16, 64, 256, 1024):
+    for a in np.arange(0.0, 40.0, 0.5):
+      logits = np.zeros((1, 1, vocab_size), np.float32)
+      logits[..., :m] = a
+      ent, vent = (float(x) for x in calculate_varentropy_logsoftmax(jnp.asarray(logits[0, -1])))
+      for name, hit in targets.items():
+        if name not in cases and hit(ent, vent):
+          cases[name] = logits
+  missing = set(BRANCH_NAMES) - set(cases)
+  if missing:
+    raise ValueError(f'No logits found for {sorted(missing)} with a vocab of {vocab_size}')
+  return {name: cases[name] for name in BRANCH_NAMES}
+
+
+def time_calls(fn: Callable[[], object], repeat: int) -> List[float]:
+  fn()  # warm-up
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return times
+
+
+def bench_jax_sampler(vocab_size: int, n_heads: int, repeat: int) -> Dict[str, Dict[str, float]]:
+  """Median microseconds of eager `sample` and `sample_jit` per quadrant; the clarifying question has already been asked."""
+  cfg = SamplerConfig()
+  gen_tokens = jnp.array([[2564]], jnp.int32)
+  scores = jax.random.normal(jax.random.PRNGKey(0), (1, n_heads, 1, 128), jnp.float32)
+  attn_stats = AttnStats.new(1, 1, n_heads)._replace(last_layer=layer_stats(jax.nn.softmax(scores, axis=-1), scores, jnp.ones(scores.shape, bool)))
+  report = {}
+  for i, (name, logits) in enumerate(sampler_cases(vocab_size, cfg).items()):
+    logits = jnp.asarray(logits)
+    _, branch = sample_jit(gen_tokens, logits, attn_stats, cfg=cfg)
+    assert int(branch) == i, (name, int(branch))
+    eager = time_calls(lambda logits=logits: sample(gen_tokens, logits, attn_stats, cfg=cfg).block_until_ready(), repeat)
+    jitted = time_calls(lambda logits=logits: sample_jit(gen_tokens, logits, attn_stats, cfg=cfg)[0].block_until_ready(), repeat)
+    report[name] = {'sample_us': float(np.median(eager)) * 1e6, 'sample_jit_us': float(np.median(jitted)) * 1e6}
+  return report
+
+
+def bench_torch_sampler(vocab_size: int, n_heads: int, repeat: int) -> Dict[str, Dict[str, float]]:
+  from entropix.torch_main import device
+  from entropix.torch_sampler import sample as torch_sample
+  from entropix.torch_stats import AttnStats as TorchAttnStats, layer_stats as torch_layer_stats
+  gen_tokens = torch.tensor([[2564]], dtype=torch.int32, device=device)
+  scores = torch.randn((1, n_heads, 1, 128), generator=torch.Generator().manual_seed(0)).to(device)
+  attn_stats = TorchAttnStats.new(1, 1, n_heads)._replace(last_layer=torch_layer_stats(torch.softmax(scores, dim=-1), scores, torch.ones_like(scores, dtype=torch.bool)))
+  generator = torch.Generator(device=device).manual_seed(1337)
+  report = {}
+  for name, logits in sampler_cases(vocab_size).items():
+    logits = torch.from_numpy(logits).to(device)
+    times = time_calls(lambda logits=logits: torch_sample(gen_tokens, logits, attn_stats, generator=generator).cpu(), repeat)
+    report[name] = {'sample_us': float(np.median(times)) * 1e6}
+  return report
+
+
+def bench_jax_model(xfmr_weights, model_params: ModelParams, prompt_len: int, n_decode: int, repeat: int, compiled: bool) -> Dict[str, float]:
+  """Prefill tokens/sec (median of `repeat`) and greedy per-token decode latency, both after warm-up."""
+  forward = xfmr_scan if compiled else xfmr
+  freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  tokens = jax.random.randint(jax.random.PRNGKey(0), (1, prompt_len), 0, xfmr_weights.tok_embeddings.shape[0])
+  attn_mask = build_attn_mask(prompt_len, 0)
+
+  def new_cache():
+    return KVCache.new(model_params.n_layers, 1, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim)
+
+  def run_prefill():
+    logits, kvcache, _ = forward(xfmr_weights, model_params, tokens, 0, freqs_cis[:prompt_len], new_cache(), attn_mask=attn_mask, with_stats=False)
+    logits.block_until_ready()
+    return logits, kvcache
+
+  prefill_times = time_calls(run_prefill, repeat)
+  logits, kvcache = run_prefill()
+  next_token = jnp.argmax(logits[:, -1], axis=-1, keepdims=True).astype(jnp.int32)
+  kv_len = bucket_len(prompt_len + n_decode + 2, model_params.max_seq_len)
+  decode_times = []
+  for step in range(n_decode + 1):
+    cur_pos = prompt_len + step
+    start = time.perf_counter()
+    logits, kvcache, _ = forward(xfmr_weights, model_params, next_token, cur_pos, freqs_cis[cur_pos:cur_pos+1], kvcache, kv_len=kv_len)
+    next_token = jnp.argmax(logits[:, -1], axis=-1, keepdims=True).astype(jnp.int32)
+    next_token.block_until_ready()
+    if step > 0:  # the first step compiles
+      decode_times.append(time.perf_counter() - start)
+  return {'prefill_tokens_per_sec': prompt_len / float(np.median(prefill_times)), **{f'decode_{k}': v for k, v in percentiles(decode_times).items()}}
+
+
+def bench_torch_model(xfmr_weights, model_params: ModelParams, prompt_len: int, n_decode: int, repeat: int, compiled: bool = False) -> Dict[str, float]:
+  """Eager prefill and decode; `compiled` adds the `torch.compile`d `StaticDecoder` decode, its warm-up time and speedup."""
+  from entropix.torch_decode import StaticDecoder
+  from entropix.torch_kvcache import KVCache as TorchKVCache
+  from entropix.torch_main import build_attn_mask as torch_attn_mask, device, precompute_freqs_cis as torch_freqs_cis
+  from entropix.torch_model import xfmr as torch_xfmr
+
+  def sync():
+    if device.type == 'cuda':
+      torch.cuda.synchronize()
+
+  freqs_cis = torch_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  tokens = torch.randint(0, xfmr_weights.tok_embeddings.shape[0], (1, prompt_len), generator=torch.Generator().manual_seed(0)).to(device)
+  attn_mask = torch_attn_mask(prompt_len, 0)
+
+  def new_cache():
+    return TorchKVCache.new(model_params.n_layers, 1, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim).to(device)
+
+  with torch.inference_mode():
+    def run_prefill():
+      logits, kvcache, _ = torch_xfmr(xfmr_weights, model_params, tokens, 0, freqs_cis[:prompt_len], new_cache(), attn_mask=attn_mask, with_stats=False)
+      sync()
+      return logits, kvcache
+
+    prefill_times = time_calls(run_prefill, repeat)
+    logits, kvcache = run_prefill()
+    next_token = torch.argmax(logits[:, -1], dim=-1, keepdim=True).to(torch.int32)
+    kv_len = bucket_len(prompt_len + n_decode + 2, model_params.max_seq_len)
+    decode_times = []
+    for step in range(n_decode + 1):
+      cur_pos = prompt_len + step
+      start = time.perf_counter()
+      logits, kvcache, _ = torch_xfmr(xfmr_weights, model_params, next_token, cur_pos, freqs_cis[cur_pos:cur_pos+1], kvcache, kv_len=kv_len)
+      next_token = torch.argmax(logits[:, -1], dim=-1, keepdim=True).to(torch.int32)
+      sync()
+      if step > 0:
+        decode_times.append(time.perf_counter() - start)
+    metrics = {'prefill_tokens_per_sec': prompt_len / float(np.median(prefill_times)), **{f'decode_{k}': v for k, v in percentiles(decode_times).items()}}
+    if not compiled:
+      return metrics
+
+    logits, kvcache = run_prefill()
+    next_token = torch.argmax(logits[:, -1], dim=-1, keepdim=True).to(torch.int32)
+    decoder = StaticDecoder(xfmr_weights, model_params, kvcache, freqs_cis)
+    metrics['compile_seconds'] = decoder.warmup([kv_len])
+    decode_times = []
+    for step in range(n_decode + 1):
+      start = time.perf_counter()
+      logits, _ = decoder.decode(next_token, prompt_len + step, kv_len)
+      next_token = torch.argmax(logits[:, -1], dim=-1, keepdim=True).to(torch.int32)
+      sync()
+      if step > 0:
+        decode_times.append(time.perf_counter() - start)
+    metrics.update({f'decode_compiled_{k}': v for k, v in percentiles(decode_times).items()})
+    metrics['decode_compiled_speedup'] = metrics['decode_p50_ms'] / metrics['decode_compiled_p50_ms']
+  return metrics
+
+
+def run(preset: str, backend: str, prompt_len: int = 128, n_decode: int = 32, repeat: int = 5, compiled: bool = True) -> Dict[str, object]:
+  """Every metric for one preset on one backend; weights are built fresh and dropped afterwards."""
+  model_params, vocab_size, ffn_dim = PRESETS[preset]
+  reset_peak_rss()
+  if torch.cuda.is_available():
+    torch.cuda.reset_peak_memory_stats()
+  if backend == 'jax':
+    xfmr_weights = random_weights(model_params, vocab_size, ffn_dim=ffn_dim, stacked=compiled)
+    metrics = bench_jax_model(xfmr_weights, model_params, prompt_len, n_decode, repeat, compiled)
+    metrics['sample'] = bench_jax_sampler(vocab_size, model_params.n_local_heads, repeat)
+  else:
+    from entropix.torch_weights import random_weights as torch_random_weights
+    xfmr_weights = torch_random_weights(model_params, vocab_size, ffn_dim=ffn_dim)
+    metrics = bench_torch_model(xfmr_weights, model_params, prompt_len, n_decode, repeat, compiled)
+    metrics['sample'] = bench_torch_sampler(vocab_size, model_params.n_local_heads, repeat)
+  metrics['peak_rss_bytes'] = peak_rss_bytes()
+  metrics['peak_device_bytes'] = peak_device_bytes(backend)
+  return metrics
+
+
+def environment() -> Dict[str, str]:
+  try:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = 'unknown'
+  return {'commit': commit, 'jax': jax.__version__, 'jax_device': str(jax.devices()[0]), 'torch': torch.__version__,
+          'python': platform.python_version(), 'machine': platform.machine(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(report: dict, baseline: dict, prefix: str = '') -> Dict[str, float]:
+  """Current / baseline ratio of every numeric metric present in both reports, keyed by its path."""
+  ratios = {}
+  for key, value in report.items():
+    if key not in baseline or key == 'environment':
+      continue
+    if isinstance(value, dict):
+      ratios.update(compare(value, baseline[key], f'{prefix}{key}.'))
+    elif isinstance(value, (int, float)) and isinstance(baseline[key], (int, float)) and baseline[key]:
+      ratios[f'{prefix}{key}'] = value / baseline[key]
+  return ratios
+
+
+def main(presets: Tuple[str, ...] = ('tiny',), backends: Tuple[str, ...] = ('jax', 'torch'), prompt_len: int = 128, n_decode: int = 32,
+         repeat: int = 5, compiled: bool = True, json_out: Optional[Path] = None, baseline: Optional[Path] = None):
+  """
+  Benchmarks random-weight models of the `PRESETS` shapes, no checkpoint needed. `compiled` runs
+  JAX through `xfmr_scan` and adds Torch's `torch.compile`d decode step next to the eager one. With `baseline`, a previous `json_out` file, prints every metric's ratio to it.
+  """
+  report = {'environment': environment()}
+  for preset in presets:
+    report[preset] = {}
+    for backend in backends:
+      report[preset][backend] = run(preset, backend, prompt_len=prompt_len, n_decode=n_decode, repeat=repeat, compiled=compiled)
+      metrics = report[preset][backend]
+      print(preset, backend, ' '.join(f'{k}={v:.4g}' for k, v in metrics.items() if isinstance(v, (int, float))))
+      for branch, times in metrics['sample'].items():
+        print(f'  sample {branch}', ' '.join(f'{k}={v:.4g}' for k, v in times.items()))
+  if json_out is not None:
+    json_out.write_text(json.dumps(report, indent=2))
+  if baseline is not None:
+    for name, ratio in compare(report, json.loads(baseline.read_text())).items():
+      print(f'{name}: {ratio:.3f}x baseline')
+
+if __name__ == '__main__':
+  tyro.cli(main)
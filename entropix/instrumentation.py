@@ -0,0 +1,200 @@
+import bisect
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import jax
+
+# Off unless ENTROPIX_METRICS=1 or `enable()`; disabled hooks cost one flag check per call.
+_enabled = os.environ.get('ENTROPIX_METRICS', '0') == '1'
+# Wait for device results before stopping a timer. Without it JAX and CUDA only time the dispatch.
+_sync = True
+_lock = threading.Lock()
+
+# Histogram upper bounds in seconds: 1us doubling up to ~67s.
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(27))
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def enable(on: bool = True, sync: bool = True):
+  """Turns every hook on or off. `sync=False` skips waiting for the device, so kernels overlap but timers measure dispatch."""
+  global _enabled, _sync
+  _enabled, _sync = on, sync
+
+
+def enabled() -> bool:
+  return _enabled
+
+
+class Counter:
+  def __init__(self, name: str, help: str):
+    self.name, self.help = name, help
+    self.values: Dict[Labels, float] = {}
+
+  def inc(self, amount: float = 1, **labels):
+    key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+    with _lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram:
+  def __init__(self, name: str, help: str):
+    self.name, self.help = name, help
+    self.series: Dict[Labels, list] = {}  # labels -> [per-bucket counts (last one is +Inf), sum]
+
+  def observe(self, value: float, **labels):
+    key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+    i = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+      series = self.series.get(key)
+      if series is None:
+        series = self.series[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+      series[0][i] += 1
+      series[1] += value
+
+
+REGISTRY: Dict[str, Counter | Histogram] = {}
+
+
+def _get(cls, name: str, help: str):
+  metric = REGISTRY.get(name)
+  if metric is None:
+    with _lock:
+      metric = REGISTRY.setdefault(name, cls(name, help))
+  return metric
+
+
+def inc(name: str, amount: float = 1, help: str = '', **labels):
+  """Adds to counter `entropix_<name>_total`."""
+  if _enabled:
+    _get(Counter, f'entropix_{name}_total', help).inc(amount, **labels)
+
+
+def observe(name: str, seconds: float, help: str = '', **labels):
+  """Records a duration in histogram `entropix_<name>_seconds`."""
+  if _enabled:
+    _get(Histogram, f'entropix_{name}_seconds', help).observe(seconds, **labels)
+
+
+def reset():
+  with _lock:
+    REGISTRY.clear()
+
+
+def phase(tokens) -> str:
+  """'prefill' for a multi-token forward pass, 'decode' for one token per row."""
+  return 'prefill' if tokens.shape[1] > 1 else 'decode'
+
+
+def _is_traced(leaves) -> bool:
+  return any(isinstance(leaf, jax.core.Tracer) for leaf in leaves)
+
+
+def _is_compiling() -> bool:
+  return 'torch' in sys.modules and sys.modules['torch'].compiler.is_compiling()
+
+
+def _wait(leaves):
+  for leaf in leaves:
+    if hasattr(leaf, 'block_until_ready'):
+      leaf.block_until_ready()
+    elif 'torch' in sys.modules and isinstance(leaf, sys.modules['torch'].Tensor) and leaf.device.type in ('cuda', 'mps'):
+      getattr(sys.modules['torch'], leaf.device.type).synchronize()
+      return
+
+
+def instrument(name: str, help: str = '', labels: Optional[Callable[..., dict]] = None):
+  """
+  Times every call of the decorated function into histogram `entropix_<name>_seconds`, labelled by
+  `labels(*args, **kwargs)`. Calls made while JAX traces (inside `jit` or `scan`) are not recorded,
+  their cost belongs to the compiled caller.
+  """
+  def decorate(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      if not _enabled or _is_compiling():
+        return fn(*args, **kwargs)
+      start = time.perf_counter()
+      out = fn(*args, **kwargs)
+      leaves = jax.tree_util.tree_leaves(out)
+      if _is_traced(leaves):
+        return out
+      if _sync:
+        _wait(leaves)
+      observe(name, time.perf_counter() - start, help, **(labels(*args, **kwargs) if labels is not None else {}))
+      return out
+    return wrapper
+  return decorate
+
+
+class TokenTimer:
+  """Time to first token and inter-token latency of one sequence, counted from construction."""
+
+  def __init__(self):
+    self.start = self.last = time.perf_counter()
+    self.n_tokens = 0
+
+  def token(self):
+    """Call as each generated token reaches the caller."""
+    if not _enabled:
+      return
+    now = time.perf_counter()
+    if self.n_tokens == 0:
+      observe('time_to_first_token', now - self.start, 'Request start to first generated token')
+    else:
+      observe('inter_token_latency', now - self.last, 'Time between generated tokens')
+    self.last = now
+    self.n_tokens += 1
+
+
+def to_json() -> dict:
+  """Every series with its count, sum, mean and cumulative bucket counts keyed by upper bound."""
+  out = {}
+  with _lock:
+    for name, metric in sorted(REGISTRY.items()):
+      if isinstance(metric, Counter):
+        series = [{'labels': dict(key), 'value': value} for key, value in metric.values.items()]
+        out[name] = {'type': 'counter', 'help': metric.help, 'series': series}
+        continue
+      series = []
+      for key, (counts, total) in metric.series.items():
+        cumulative, buckets = 0, {}
+        for bound, n in zip(BUCKETS + (float('inf'),), counts):
+          cumulative += n
+          buckets['+Inf' if bound == float('inf') else f'{bound:.6g}'] = cumulative
+        series.append({'labels': dict(key), 'count': cumulative, 'sum': total, 'mean': total / max(cumulative, 1), 'buckets': buckets})
+      out[name] = {'type': 'histogram', 'help': metric.help, 'series': series}
+  return out
+
+
+def _label_text(labels: dict, **extra) -> str:
+  labels = {**labels, **extra}
+  return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}' if labels else ''
+
+
+def to_prometheus() -> str:
+  """The registry in the Prometheus text exposition format."""
+  lines = []
+  for name, metric in to_json().items():
+    lines.append(f'# HELP {name} {metric["help"] or name}')
+    lines.append(f'# TYPE {name} {metric["type"]}')
+    for series in metric['series']:
+      if metric['type'] == 'counter':
+        lines.append(f'{name}{_label_text(series["labels"])} {series["value"]}')
+        continue
+      for bound, n in series['buckets'].items():
+        lines.append(f'{name}_bucket{_label_text(series["labels"], le=bound)} {n}')
+      lines.append(f'{name}_sum{_label_text(series["labels"])} {series["sum"]}')
+      lines.append(f'{name}_count{_label_text(series["labels"])} {series["count"]}')
+  return '\n'.join(lines) + '\n'
+
+
+def dump(path: str):
+  """Writes the registry to `path`, as JSON for a `.json` suffix and Prometheus text otherwise."""
+  with open(path, 'w') as f:
+    f.write(json.dumps(to_json(), indent=2) if str(path).endswith('.json') else to_prometheus())
@@ -0,0 +1,78 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import jax
+import jax.numpy as jnp
+import tyro
+
+from entropix.config import LLAMA_1B_PARAMS
+from entropix.kvcache import KVCache, QuantizedKVCache, bucket_len
+from entropix.main import DEFAULT_WEIGHTS_PATH, build_attn_mask, precompute_freqs_cis
+from entropix.model import xfmr
+from entropix.prompts import prompt
+from entropix.tokenizer import Tokenizer
+from entropix.weights import load_weights
+
+
+def run_cache(xfmr_weights, model_params, prompt_tokens: List[int], kvcache, n_steps: int, targets: Optional[List[int]] = None):
+  """
+  Prefills `prompt_tokens` and decodes `n_steps` tokens greedily, or feeds `targets` when given so two
+  caches see the same token stream. Returns the tokens, (n_steps, vocab) logits and the per-step
+  (n_steps, n_layers, n_heads) attention entropy and varentropy.
+  """
+  tokens = jnp.array([prompt_tokens], jnp.int32)
+  seqlen = tokens.shape[1]
+  freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  logits, kvcache, _ = xfmr(xfmr_weights, model_params, tokens, 0, freqs_cis[:seqlen], kvcache, attn_mask=build_attn_mask(seqlen, 0), with_stats=False)
+  next_token = targets[0] if targets is not None else int(jnp.argmax(logits[0, -1]))
+  out_tokens, out_logits, entropy, varentropy = [next_token], [], [], []
+  for step in range(n_steps):
+    cur_pos = seqlen + step
+    kv_len = bucket_len(cur_pos + 1, model_params.max_seq_len)
+    logits, kvcache, stats = xfmr(xfmr_weights, model_params, jnp.array([[next_token]], jnp.int32), cur_pos, freqs_cis[cur_pos:cur_pos+1], kvcache, kv_len=kv_len)
+    out_logits.append(logits[0, -1].astype(jnp.float32))
+    entropy.append(stats.entropy[0])
+    varentropy.append(stats.varentropy[0])
+    next_token = targets[step + 1] if targets is not None else int(jnp.argmax(logits[0, -1]))
+    out_tokens.append(next_token)
+  return out_tokens, jnp.stack(out_logits), jnp.stack(entropy), jnp.stack(varentropy)
+
+
+def compare_kv_caches(xfmr_weights, model_params, prompt_tokens: List[int], n_steps: int = 64, per_head: bool = True) -> Dict[str, Dict[str, float]]:
+  """Drift of the int8 and fp8 caches from the bf16 cache, all fed the tokens the bf16 run chose."""
+  dims = (model_params.n_layers, 1, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim)
+  baseline = KVCache.new(*dims)
+  targets, ref_logits, ref_entropy, ref_varentropy = run_cache(xfmr_weights, model_params, prompt_tokens, baseline, n_steps)
+  report = {'bf16': {'cache_bytes': sum(a.nbytes for a in baseline)}}
+  ref_logp = jax.nn.log_softmax(ref_logits, axis=-1)
+  for dtype in ('int8', 'fp8'):
+    kvcache = QuantizedKVCache.new(*dims, dtype=dtype, per_head=per_head)
+    _, logits, entropy, varentropy = run_cache(xfmr_weights, model_params, prompt_tokens, kvcache, n_steps, targets=targets)
+    logp = jax.nn.log_softmax(logits, axis=-1)
+    report[dtype] = {
+      'cache_bytes': sum(a.nbytes for a in kvcache),
+      'logits_max_abs_err': float(jnp.max(jnp.abs(logits - ref_logits))),
+      'kl_mean': float(jnp.mean(jnp.sum(jnp.exp(ref_logp) * (ref_logp - logp), axis=-1))),
+      'top1_agreement': float(jnp.mean(jnp.argmax(logits, -1) == jnp.argmax(ref_logits, -1))),
+      'attn_entropy_mean_abs_err': float(jnp.mean(jnp.abs(entropy - ref_entropy))),
+      'attn_entropy_max_abs_err': float(jnp.max(jnp.abs(entropy - ref_entropy))),
+      'attn_varentropy_mean_abs_err': float(jnp.mean(jnp.abs(varentropy - ref_varentropy))),
+      'attn_varentropy_max_abs_err': float(jnp.max(jnp.abs(varentropy - ref_varentropy))),
+    }
+  return report
+
+
+def main(weights_path: Path = DEFAULT_WEIGHTS_PATH.joinpath('1B-Instruct'), n_steps: int = 64, per_head: bool = True, json_out: Optional[Path] = None):
+  model_params = LLAMA_1B_PARAMS
+  xfmr_weights = load_weights(weights_path.absolute())
+  tokenizer = Tokenizer('entropix/tokenizer.model')
+  tokens = tokenizer.encode(prompt, bos=False, eos=False, allowed_special='all')
+  report = compare_kv_caches(xfmr_weights, model_params, tokens, n_steps=n_steps, per_head=per_head)
+  for mode, metrics in report.items():
+    print(mode, ' '.join(f'{k}={v:.4g}' for k, v in metrics.items()))
+  if json_out is not None:
+    json_out.write_text(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+  tyro.cli(main)
@@ -1,8 +1,50 @@
-from typing import NamedTuple
+from typing import NamedTuple, Optional, Tuple
 
 import jax
 import jax.numpy as jnp
 
+from entropix import instrumentation
+
+
+def bucket_len(length: int, max_seq_len: int, min_len: int = 128) -> int:
+  """Smallest power-of-two multiple of `min_len` that holds `length` positions, capped at `max_seq_len`.
+
+  Decode attends to this many cache slots, so compiled steps see a handful of static shapes.
+  """
+  n = min_len
+  while n < length:
+    n *= 2
+  return min(n, max_seq_len)
+
+
+KV_QUANT_DTYPES = {'int8': jnp.int8, 'fp8': jnp.float8_e4m3fn}
+
+
+def quantize_kv(x: jax.Array, dtype: jnp.dtype, per_head: bool = True) -> Tuple[jax.Array, jax.Array]:
+  """Symmetric absmax quantization of (..., kv_heads, head_dim) keys or values.
+
+  Returns the quantized tensor and float32 scales shaped (..., kv_heads, 1) with `per_head`,
+  otherwise (..., 1, 1), one scale shared by every head of a position.
+  """
+  qmax = float(jnp.iinfo(dtype).max if jnp.issubdtype(dtype, jnp.integer) else jnp.finfo(dtype).max)
+  x = x.astype(jnp.float32)
+  scale = jnp.max(jnp.abs(x), axis=-1 if per_head else (-2, -1), keepdims=True)
+  scale = jnp.maximum(scale, 1e-6) / qmax
+  q = x / scale
+  if jnp.issubdtype(dtype, jnp.integer):
+    q = jnp.round(q)
+  return jnp.clip(q, -qmax, qmax).astype(dtype), scale
+
+
+def _write(cache: jax.Array, x: jax.Array, layer_idx: int, cur_pos: int | jax.Array) -> jax.Array:
+  """Writes `x` (bsz, seqlen, ...) into layer `layer_idx` of `cache` at `cur_pos`, shared or one per row."""
+  x = x.astype(cache.dtype)
+  if jnp.ndim(cur_pos) == 1:
+    # One write position per row, e.g. sequences at different lengths in a continuous batch.
+    write = jax.vmap(lambda c, x, p: jax.lax.dynamic_update_slice(c, x, (p,) + (0,) * (c.ndim - 1)))
+    return cache.at[layer_idx].set(write(cache[layer_idx], x, cur_pos))
+  return jax.lax.dynamic_update_slice(cache, x[None, ...], (layer_idx, 0, cur_pos) + (0,) * (cache.ndim - 3))
+
 
 class KVCache(NamedTuple):
   k: jax.Array
@@ -15,15 +57,79 @@ class KVCache(NamedTuple):
         v=jnp.zeros((layers, bsz, max_seq_len, kv_heads, head_dim), dtype=jnp.bfloat16)
     )
 
-  def update(self, xk: jax.Array, xv: jax.Array, layer_idx: int, cur_pos: int, n_rep: int):
-    ck = jax.lax.dynamic_update_slice(self.k, jnp.bfloat16(xk[None, ...]), (layer_idx, 0, cur_pos, 0, 0))
-    cv = jax.lax.dynamic_update_slice(self.v, jnp.bfloat16(xv[None, ...]), (layer_idx, 0, cur_pos, 0, 0))
-    if cur_pos == 0:
-      keys = jnp.repeat(xk, n_rep, axis=2)
-      values = jnp.repeat(xv, n_rep, axis=2)
+  @property
+  def max_seq_len(self) -> int:
+    return self.k.shape[2]
+
+  @instrumentation.instrument('kvcache_update', 'KV cache write and read', labels=lambda self, *args, **kwargs: {'cache': type(self).__name__})
+  def update(self, xk: jax.Array, xv: jax.Array, layer_idx: int, cur_pos: int | jax.Array, kv_len: Optional[int] = None):
+    ck = _write(self.k, xk, layer_idx, cur_pos)
+    cv = _write(self.v, xv, layer_idx, cur_pos)
+    # Only a static `cur_pos == 0` is a fresh prefill; traced and per-row positions read the cache.
+    # Keys/values keep n_kv_heads heads; `attention` groups the queries to match them.
+    # Reads stop at `kv_len` slots, the caller's bound on the filled prefix.
+    if isinstance(cur_pos, int) and cur_pos == 0:
+      keys, values = xk, xv
     else:
-      keys = jnp.repeat(ck[layer_idx], n_rep, axis=2)
-      values = jnp.repeat(cv[layer_idx], n_rep, axis=2)
+      keys, values = ck[layer_idx, :, :kv_len], cv[layer_idx, :, :kv_len]
 
     return keys, values, KVCache(k=ck, v=cv)
 
+  def insert(self, row: int, other: 'KVCache') -> 'KVCache':
+    """Copies the single-sequence cache `other` into batch row `row`, starting at position 0."""
+    return KVCache(
+      k=jax.lax.dynamic_update_slice(self.k, other.k, (0, row, 0, 0, 0)),
+      v=jax.lax.dynamic_update_slice(self.v, other.v, (0, row, 0, 0, 0))
+    )
+
+
+class QuantizedKVCache(NamedTuple):
+  """
+  KV cache stored as int8 or fp8 with float32 absmax scales per position and kv head
+  (`per_head=True`) or per position.
+
+  `update` quantizes what it writes and hands `attention` dequantized bf16 keys/values, so it
+  has the same contract as `KVCache.update`. A fresh prefill still attends to its unquantized keys.
+  """
+  k: jax.Array  # (layers, bsz, max_seq_len, kv_heads, head_dim)
+  v: jax.Array
+  k_scale: jax.Array  # (layers, bsz, max_seq_len, kv_heads or 1, 1)
+  v_scale: jax.Array
+
+  @classmethod
+  def new(cls, layers: int, bsz: int, max_seq_len: int, kv_heads: int, head_dim: int, dtype: str = 'int8', per_head: bool = True) -> 'QuantizedKVCache':
+    qdtype = KV_QUANT_DTYPES[dtype]
+    n_scales = kv_heads if per_head else 1
+    return cls(
+        k=jnp.zeros((layers, bsz, max_seq_len, kv_heads, head_dim), dtype=qdtype),
+        v=jnp.zeros((layers, bsz, max_seq_len, kv_heads, head_dim), dtype=qdtype),
+        k_scale=jnp.zeros((layers, bsz, max_seq_len, n_scales, 1), dtype=jnp.float32),
+        v_scale=jnp.zeros((layers, bsz, max_seq_len, n_scales, 1), dtype=jnp.float32)
+    )
+
+  @property
+  def max_seq_len(self) -> int:
+    return self.k.shape[2]
+
+  @instrumentation.instrument('kvcache_update', 'KV cache write and read', labels=lambda self, *args, **kwargs: {'cache': type(self).__name__})
+  def update(self, xk: jax.Array, xv: jax.Array, layer_idx: int, cur_pos: int | jax.Array, kv_len: Optional[int] = None):
+    per_head = self.k_scale.shape[3] > 1
+    qk, sk = quantize_kv(xk, self.k.dtype, per_head)
+    qv, sv = quantize_kv(xv, self.v.dtype, per_head)
+    cache = QuantizedKVCache(
+      k=_write(self.k, qk, layer_idx, cur_pos),
+      v=_write(self.v, qv, layer_idx, cur_pos),
+      k_scale=_write(self.k_scale, sk, layer_idx, cur_pos),
+      v_scale=_write(self.v_scale, sv, layer_idx, cur_pos)
+    )
+    if isinstance(cur_pos, int) and cur_pos == 0:
+      keys, values = xk, xv
+    else:
+      keys = (cache.k[layer_idx, :, :kv_len].astype(jnp.float32) * cache.k_scale[layer_idx, :, :kv_len]).astype(jnp.bfloat16)
+      values = (cache.v[layer_idx, :, :kv_len].astype(jnp.float32) * cache.v_scale[layer_idx, :, :kv_len]).astype(jnp.bfloat16)
+
+    return keys, values, cache
+
+  def insert(self, row: int, other: 'QuantizedKVCache') -> 'QuantizedKVCache':
+    """Copies the single-sequence cache `other` into batch row `row`, starting at position 0."""
+    return QuantizedKVCache(*(jax.lax.dynamic_update_slice(a, b, (0, row, 0, 0, 0)) for a, b in zip(self, other)))
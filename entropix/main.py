@@ -1,18 +1,22 @@
 import math
 from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 import tyro
 
+from entropix import instrumentation
 from entropix.config import LLAMA_1B_PARAMS
-from entropix.kvcache import KVCache
-from entropix.model import xfmr
-from entropix.sampler import SamplerConfig, sample
+from entropix.kvcache import KVCache, QuantizedKVCache, bucket_len
+from entropix.model import xfmr, xfmr_scan
+from entropix.prefix_cache import PrefixCache
+from entropix.sampler import SamplerConfig, sample, sample_jit, sample_plain, sample_positions, sample_rows
 from entropix.prompts import create_prompts_from_csv, prompt
 from entropix.sampler import sample
 from entropix.tokenizer import Tokenizer
-from entropix.weights import load_weights
+from entropix.weights import load_weights, stack_weights
 
 DEFAULT_WEIGHTS_PATH = Path(__file__).parent / '../weights'
 
@@ -60,49 +64,271 @@ def build_attn_mask(seqlen: int, start_pos: int) -> jax.Array:
   return mask
 
 
-def main(weights_path: Path = DEFAULT_WEIGHTS_PATH.joinpath('1B-Instruct')):
-  model_params = LLAMA_1B_PARAMS
-  xfmr_weights = load_weights(weights_path.absolute())
-  tokenizer = Tokenizer('entropix/tokenizer.model')
+def build_padded_batch(prompts: List[List[int]], pad_id: int) -> Tuple[jax.Array, jax.Array]:
+  """Left-pads `prompts` so every row's last prompt token lands in the same cache column."""
+  seqlen = max(len(p) for p in prompts)
+  pad_lens = [seqlen - len(p) for p in prompts]
+  tokens = jnp.array([[pad_id] * n + list(p) for n, p in zip(pad_lens, prompts)], jnp.int32)
+  return tokens, jnp.array(pad_lens, jnp.int32)
+
+
+def build_padded_attn_mask(seqlen: int, kv_len: int, pad_lens: jax.Array, start_pos: int = 0) -> jax.Array:
+  """(bsz, 1, seqlen, kv_len) causal mask that also hides each row's left padding."""
+  q_pos = start_pos + jnp.arange(seqlen)[:, None]
+  k_pos = jnp.arange(kv_len)[None, :]
+  visible = (k_pos <= q_pos)[None] & (k_pos[None] >= pad_lens[:, None, None])
+  return jnp.where(visible, 0.0, float('-inf'))[:, None].astype(jnp.float32)
+
+
+def build_tree_attn_mask(n_prefix: int, branch_slots: Sequence[Sequence[int]], kv_len: int) -> jax.Array:
+  """
+  (n_branches, kv_len) mask for branches packed into one sequence: row b sees the shared prefix
+  [0, n_prefix) and the cache slots in `branch_slots[b]`, its own and its ancestors' tokens.
+  """
+  visible = np.zeros((len(branch_slots), kv_len), dtype=bool)
+  visible[:, :n_prefix] = True
+  for row, slots in enumerate(branch_slots):
+    visible[row, list(slots)] = True
+  return jnp.where(jnp.asarray(visible), 0.0, float('-inf')).astype(jnp.float32)
+
 
-  # Create the batch of tokens
-  def generate(xfmr_weights, model_params, tokens):
-    gen_tokens = None
-    cur_pos = 0
-    tokens = jnp.array([tokens], jnp.int32)
-    bsz, seqlen = tokens.shape
-    attn_mask = build_attn_mask(seqlen, cur_pos)
-    freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+def prefill(forward, xfmr_weights, model_params, tokens: jax.Array, cur_pos: int, freqs_cis: jax.Array, kvcache, chunk_size: int = 0):
+  """
+  Writes `tokens` (bsz, seqlen) to the cache from `cur_pos` on, `chunk_size` tokens per forward pass.
+
+  A chunk at position 0 takes the fresh-key path with a causal mask; later chunks read the cached
+  prefix and are masked by position, so scores are (chunk_size, kv_len) instead of (seqlen, seqlen).
+  `chunk_size=0` runs everything in one pass. No attention statistics are computed.
+  Returns the last chunk's logits and the cache.
+  """
+  seqlen = tokens.shape[1]
+  chunk_size = chunk_size if chunk_size > 0 else seqlen
+  for start in range(0, seqlen, chunk_size):
+    chunk = tokens[:, start:start + chunk_size]
+    pos, n = cur_pos + start, chunk.shape[1]
+    if pos == 0:
+      logits, kvcache, _ = forward(xfmr_weights, model_params, chunk, 0, freqs_cis[:n], kvcache, attn_mask=build_attn_mask(n, 0), with_stats=False)
+    else:
+      kv_len = bucket_len(pos + n, kvcache.max_seq_len)
+      logits, kvcache, _ = forward(xfmr_weights, model_params, chunk, pos, freqs_cis[pos:pos + n], kvcache, kv_len=kv_len, with_stats=False)
+  return logits, kvcache
+
+
+def generate(xfmr_weights, model_params, tokens, tokenizer: Tokenizer, compiled: bool = False, chunk_size: int = 0,
+             prefix_cache: Optional[PrefixCache] = None, kv_dtype: str = 'bf16', kv_per_head: bool = True, with_stats: bool = True):
+  """
+  Greedy first token followed by entropy sampling until a stop token.
+
+  With `compiled=True`, `xfmr_weights` must come from `stack_weights` and the forward pass
+  runs through the jitted, layer-scanned `xfmr_scan` with the traceable `sample_jit`.
+  `chunk_size > 0` prefills the prompt in chunks of that many tokens. With a `prefix_cache`,
+  prefill starts after the longest cached prefix of the prompt and the prompt's KV is added to it.
+  `kv_dtype` 'int8' or 'fp8' stores the KV cache quantized, with scales per head or per position.
+  `with_stats=False` skips the attention statistics and samples plainly at the config's temperature.
+  """
+  timer = instrumentation.TokenTimer()
+  forward = xfmr_scan if compiled else xfmr
+  gen_tokens = None
+  cur_pos = 0
+  prompt_tokens = tokens
+  tokens = jnp.array([tokens], jnp.int32)
+  bsz, seqlen = tokens.shape
+  freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  if kv_dtype == 'bf16':
     kvcache = KVCache.new(model_params.n_layers, bsz, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim)
-    logits, kvcache, _, _ = xfmr(xfmr_weights, model_params, tokens, cur_pos, freqs_cis[:seqlen], kvcache, attn_mask=attn_mask)
-    next_token = jnp.argmax(logits[:, -1], axis=-1, keepdims=True).astype(jnp.int32)
-    gen_tokens = next_token
-    print(tokenizer.decode([next_token.item()]), end='', flush=True)
-    cur_pos = seqlen
-    stop = jnp.array([128001, 128008, 128009])
-    sampler_cfg = SamplerConfig()
-    while cur_pos < 8192:
-      cur_pos += 1
-      logits, kvcache, scores, stats = xfmr(xfmr_weights, model_params, next_token, cur_pos, freqs_cis[cur_pos:cur_pos+1], kvcache)
-      next_token = sample(gen_tokens, logits, scores, cfg=sampler_cfg)
-      gen_tokens = jnp.concatenate((gen_tokens, next_token))
-      print(tokenizer.decode(next_token.tolist()[0]), end='', flush=True)
-      if jnp.isin(next_token, stop).any():
-        break
+  elif prefix_cache is not None:
+    raise ValueError('The prefix cache stores bf16 KV entries, use kv_dtype="bf16" with it')
+  else:
+    kvcache = QuantizedKVCache.new(model_params.n_layers, bsz, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim,
+                                   dtype=kv_dtype, per_head=kv_per_head)
+  if prefix_cache is not None:
+    cur_pos, k, v = prefix_cache.match(prompt_tokens[:-1])  # the last prompt token always runs, its logits start decoding
+    if cur_pos > 0:
+      kvcache = kvcache.insert(0, KVCache(k=k[:, None], v=v[:, None]))
+  logits, kvcache = prefill(forward, xfmr_weights, model_params, tokens[:, cur_pos:], cur_pos, freqs_cis, kvcache, chunk_size=chunk_size)
+  if prefix_cache is not None:
+    prefix_cache.insert(prompt_tokens, kvcache.k[:, 0, :seqlen], kvcache.v[:, 0, :seqlen])
+  next_token = jnp.argmax(logits[:, -1], axis=-1, keepdims=True).astype(jnp.int32)
+  gen_tokens = next_token
+  detokenizer = tokenizer.stream()
+  print(detokenizer.decode([next_token.item()]), end='', flush=True)
+  timer.token()
+  cur_pos = seqlen
+  stop = jnp.array([128001, 128008, 128009])
+  sampler_cfg = SamplerConfig()
+  while cur_pos < 8192:
+    kv_len = bucket_len(cur_pos + 1, model_params.max_seq_len)
+    logits, kvcache, stats = forward(xfmr_weights, model_params, next_token, cur_pos, freqs_cis[cur_pos:cur_pos+1], kvcache, kv_len=kv_len, with_stats=with_stats)
+    cur_pos += 1
+    if not with_stats:
+      next_token = sample_plain(logits, sampler_cfg)
+    elif compiled:
+      next_token, _ = sample_jit(gen_tokens, logits, stats, cfg=sampler_cfg)
+    else:
+      next_token = sample(gen_tokens, logits, stats, cfg=sampler_cfg)
+    gen_tokens = jnp.concatenate((gen_tokens, next_token))
+    print(detokenizer.decode(next_token.tolist()[0]), end='', flush=True)
+    timer.token()
+    if jnp.isin(next_token, stop).any():
+      break
+  print(detokenizer.flush(), end='', flush=True)
+
+
+def propose_ngram(tokens: Sequence[int], k: int, max_ngram: int = 3) -> List[int]:
+  """
+  Up to `k` draft tokens: what followed the most recent earlier occurrence of the longest
+  (at most `max_ngram` tokens) suffix of `tokens`. Empty when no suffix reappears.
+  """
+  tokens = list(tokens)
+  for n in range(min(max_ngram, len(tokens) - 1), 0, -1):
+    suffix = tokens[-n:]
+    for start in range(len(tokens) - n - 1, -1, -1):
+      if tokens[start:start + n] == suffix:
+        return tokens[start + n:start + n + k]
+  return []
+
+
+def generate_lookup(xfmr_weights, model_params, tokens, tokenizer: Optional[Tokenizer] = None, compiled: bool = False, k: int = 4,
+                    max_ngram: int = 3, max_new_tokens: int = 8192, chunk_size: int = 0) -> Tuple[List[int], Dict[str, float]]:
+  """
+  `generate` with prompt-lookup speculative decoding.
+
+  Each step drafts up to `k` tokens with `propose_ngram` over the prompt and generated tokens and
+  feeds the last token plus the drafts through one forward pass. The entropy sampler then runs at
+  every position; drafts are kept while they equal what it samples there, and its token at the
+  first mismatch (or after the last draft) is appended, so the output is the one `k=0` gives.
+  Rejected drafts stay in the cache past `cur_pos`, where the position mask hides them until they
+  are overwritten. Returns the generated tokens and acceptance counts.
+  """
+  forward = xfmr_scan if compiled else xfmr
+  context = list(tokens)
+  seqlen = len(context)
+  freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  kvcache = KVCache.new(model_params.n_layers, 1, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim)
+  logits, kvcache = prefill(forward, xfmr_weights, model_params, jnp.array([context], jnp.int32), 0, freqs_cis, kvcache, chunk_size=chunk_size)
+  gen_tokens = [int(jnp.argmax(logits[0, -1]))]
+  detokenizer = tokenizer.stream() if tokenizer is not None else None
+  if detokenizer is not None:
+    print(detokenizer.decode(gen_tokens), end='', flush=True)
+  cur_pos = seqlen
+  stop = (128001, 128008, 128009)
+  sampler_cfg = SamplerConfig()
+  n_forward = n_proposed = n_accepted = 0
+  while gen_tokens[-1] not in stop and len(gen_tokens) < max_new_tokens and cur_pos < model_params.max_seq_len:
+    drafts = propose_ngram(context + gen_tokens, k, max_ngram)[:model_params.max_seq_len - cur_pos - 1]
+    if 0 < len(drafts) < k and cur_pos + k < model_params.max_seq_len:
+      drafts += drafts[-1:] * (k - len(drafts))  # keeps to two step shapes, 1 and k + 1 tokens
+    step_tokens = gen_tokens[-1:] + drafts
+    n = len(step_tokens)
+    kv_len = bucket_len(cur_pos + n, model_params.max_seq_len)
+    logits, kvcache, stats = forward(xfmr_weights, model_params, jnp.array([step_tokens], jnp.int32), cur_pos, freqs_cis[cur_pos:cur_pos + n], kvcache, kv_len=kv_len)
+    sampled, _ = sample_positions(jnp.array(step_tokens, jnp.int32), logits, stats, cfg=sampler_cfg)
+    sampled = sampled.tolist()
+    accepted = 0
+    while accepted < len(drafts) and drafts[accepted] == sampled[accepted] and drafts[accepted] not in stop:
+      accepted += 1
+    new_tokens = drafts[:accepted] + [sampled[accepted]]
+    n_forward += 1
+    n_proposed += len(drafts)
+    n_accepted += accepted
+    cur_pos += accepted + 1
+    gen_tokens += new_tokens
+    if detokenizer is not None:
+      print(detokenizer.decode(new_tokens), end='', flush=True)
+  if detokenizer is not None:
+    print(detokenizer.flush(), end='', flush=True)
+  gen_tokens = gen_tokens[:max_new_tokens]
+  stats = {
+    'n_forward': n_forward,
+    'n_proposed': n_proposed,
+    'n_accepted': n_accepted,
+    'acceptance_rate': n_accepted / max(n_proposed, 1),
+    'tokens_per_forward': (len(gen_tokens) - 1) / max(n_forward, 1),
+  }
+  return gen_tokens, stats
+
+
+def generate_batch(xfmr_weights, model_params, prompts: List[List[int]], tokenizer: Tokenizer, compiled: bool = False) -> List[List[int]]:
+  """
+  Generates for a batch of prompts of different lengths.
+
+  Prompts are left-padded so the cache is written at one shared column per step, while each row
+  keeps its own rotary positions and a padding mask. Rows sample their own entropy quadrant and
+  stop independently; the returned token lists exclude the stop token.
+  """
+  forward = xfmr_scan if compiled else xfmr
+  tokens, pad_lens = build_padded_batch(prompts, tokenizer.pad_id)
+  bsz, seqlen = tokens.shape
+  freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  kvcache = KVCache.new(model_params.n_layers, bsz, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim)
+  positions = jnp.maximum(jnp.arange(seqlen)[None, :] - pad_lens[:, None], 0)
+  attn_mask = build_padded_attn_mask(seqlen, seqlen, pad_lens)
+  logits, kvcache, _ = forward(xfmr_weights, model_params, tokens, 0, freqs_cis[positions], kvcache, attn_mask=attn_mask, with_stats=False)
+  next_token = jnp.argmax(logits[:, -1], axis=-1, keepdims=True).astype(jnp.int32)
+  gen_tokens = next_token
+  stop = jnp.array([128001, 128008, 128009])
+  done = jnp.isin(next_token[:, 0], stop)
+  sampler_cfg = SamplerConfig()
+  cur_pos = seqlen
+  while cur_pos < model_params.max_seq_len and not done.all():
+    kv_len = bucket_len(cur_pos + 1, model_params.max_seq_len)
+    attn_mask = build_padded_attn_mask(1, kv_len, pad_lens, start_pos=cur_pos)
+    logits, kvcache, stats = forward(xfmr_weights, model_params, next_token, cur_pos, freqs_cis[cur_pos - pad_lens][:, None], kvcache, attn_mask=attn_mask, kv_len=kv_len)
+    next_token, _ = sample_rows(gen_tokens, logits, stats, cfg=sampler_cfg)
+    next_token = jnp.where(done[:, None], tokenizer.pad_id, next_token)
+    gen_tokens = jnp.concatenate((gen_tokens, next_token), axis=1)
+    done = done | jnp.isin(next_token[:, 0], stop)
+    cur_pos += 1
+
+  outputs = []
+  for row in gen_tokens.tolist():
+    stops = [i for i, t in enumerate(row) if t in stop.tolist()]
+    outputs.append(row[:stops[0]] if stops else row)
+  return outputs
+
+
+def main(weights_path: Path = DEFAULT_WEIGHTS_PATH.joinpath('1B-Instruct'), compiled: bool = False, batch_size: int = 0, chunk_size: int = 0,
+         prefix_cache_mb: int = 0, kv_dtype: str = 'bf16', kv_per_head: bool = True, weights_quant: Optional[str] = None, lookup_k: int = 0,
+         metrics_out: Optional[Path] = None, with_stats: bool = True):
+  if metrics_out is not None:
+    instrumentation.enable()
+  model_params = LLAMA_1B_PARAMS
+  xfmr_weights = load_weights(weights_path.absolute(), quant=weights_quant)
+  if compiled:
+    xfmr_weights = stack_weights(xfmr_weights)
+  tokenizer = Tokenizer('entropix/tokenizer.model')
 
   csv_path = Path('entropix/data/prompts.csv')
   prompts = create_prompts_from_csv(csv_path)
   PROMPT_TEST = False
+  prefix_cache = PrefixCache(prefix_cache_mb << 20) if prefix_cache_mb > 0 else None
 
-  if PROMPT_TEST:
+  if batch_size > 0:
+    encoded = tokenizer.encode_batch(prompts, bos=False, eos=False, allowed_special='all')
+    for i in range(0, len(encoded), batch_size):
+      outputs = generate_batch(xfmr_weights, model_params, encoded[i:i + batch_size], tokenizer, compiled=compiled)
+      for p, out in zip(prompts[i:i + batch_size], outputs):
+        print(p)
+        print(tokenizer.decode(out))
+  elif PROMPT_TEST:
     for p in prompts:
       print(p)
       tokens = tokenizer.encode(p,  bos=False, eos=False, allowed_special='all')
-      generate(xfmr_weights, model_params, tokens)
+      generate(xfmr_weights, model_params, tokens, tokenizer, compiled=compiled, chunk_size=chunk_size, prefix_cache=prefix_cache,
+               kv_dtype=kv_dtype, kv_per_head=kv_per_head, with_stats=with_stats)
+    if prefix_cache is not None:
+      print(f'Prefix cache reused {prefix_cache.n_hit_tokens} of {prefix_cache.n_lookup_tokens} prompt tokens')
   else:
     print(prompt)
     tokens = tokenizer.encode(prompt,  bos=False, eos=False, allowed_special='all')
-    generate(xfmr_weights, model_params, tokens)
+    if lookup_k > 0:
+      _, stats = generate_lookup(xfmr_weights, model_params, tokens, tokenizer, compiled=compiled, k=lookup_k, chunk_size=chunk_size)
+      print(f"\nAccepted {stats['n_accepted']} of {stats['n_proposed']} drafts, {stats['tokens_per_forward']:.2f} tokens per forward pass")
+    else:
+      generate(xfmr_weights, model_params, tokens, tokenizer, compiled=compiled, chunk_size=chunk_size, prefix_cache=prefix_cache,
+               kv_dtype=kv_dtype, kv_per_head=kv_per_head, with_stats=with_stats)
+  if metrics_out is not None:
+    instrumentation.dump(metrics_out)
 
 if __name__ == '__main__':
   tyro.cli(main)
@@ -1,50 +1,105 @@
 import torch
-import torch.nn.functional as F
-from typing import Tuple
+from typing import Optional, Sequence
+
+from entropix.torch_kvcache import bucket_len
+from entropix.torch_sampler import _sample, _sample_n, calculate_varentropy_logsoftmax, device
+
+STOP_TOKENS = (128001, 128008, 128009)
+
+
+def build_tree_attn_mask(n_prefix: int, branch_slots: Sequence[Sequence[int]], kv_len: int) -> torch.Tensor:
+    """Torch `main.build_tree_attn_mask`: (n_branches, kv_len), row b sees [0, n_prefix) and `branch_slots[b]`."""
+    visible = torch.zeros((len(branch_slots), kv_len), dtype=torch.bool)
+    visible[:, :n_prefix] = True
+    for row, slots in enumerate(branch_slots):
+        visible[row, list(slots)] = True
+    return torch.zeros(visible.shape, dtype=torch.float32).masked_fill(~visible, float('-inf')).to(device)
 
-from entropix.torch_main import calculate_varentropy_logsoftmax, _sample
 
 class MCTSSearch:
-    def __init__(self, cxfmr, xfmr_weights, model_params, freqs_cis, kvcache):
-        self.cxfmr = cxfmr
+    """
+    Picks the next token in uncertain states by rolling out `n_branches` sampled candidates and
+    keeping the first one whose continuation returns to the normal entropy range.
+
+    All rollouts run as one batch of a bsz=1 cache: the caller's cache is forked by position
+    offset, each rollout step writing the branches' tokens to the next free slots past `cur_pos`
+    and a tree mask keeping every branch to the prefix and its own slots. Nothing before `cur_pos`
+    is touched, and the scratch slots are hidden by the length mask until the generate loop
+    overwrites them.
+    """
+    def __init__(self, xfmr, xfmr_weights, model_params, freqs_cis, max_depth: int = 6, n_branches: int = 5,
+                 budget: Optional[int] = None, temperature: float = 2.0, rollout_temperature: float = 1.0,
+                 max_ent: float = 5.0, max_vent: float = 5.0,
+                 generator: torch.Generator = torch.Generator(device=device).manual_seed(1337)):
+        self.xfmr = xfmr
         self.xfmr_weights = xfmr_weights
         self.model_params = model_params
         self.freqs_cis = freqs_cis
-        self.kvcache = kvcache
-        self.max_depth = 6
-        self.n_branches = 5
-
-    def _is_normal_range(self, ent: float, vent: float) -> bool:
-        return ent < 5.0 and vent < 5.0
-
-    def simulate_path(self, token: torch.Tensor, cur_pos: int, depth: int = 0) -> Tuple[torch.Tensor, bool]:
-        if depth >= self.max_depth:
-            return token, False
-
-        next_logits, _ = self.cxfmr(self.xfmr_weights, self.model_params, token.unsqueeze(0), 
-                                    cur_pos + depth + 1, 
-                                    self.freqs_cis[cur_pos + depth + 1:cur_pos + depth + 2], 
-                                    self.kvcache)
-        next_ent, next_vent = calculate_varentropy_logsoftmax(next_logits)
-        
-        if self._is_normal_range(next_ent.item(), next_vent.item()):
-            return token, True
-
-        next_token = _sample(next_logits, temperature=1.0)
-        return self.simulate_path(next_token.squeeze(), cur_pos, depth + 1)
-
-    def search(self, logits: torch.Tensor, cur_pos: int) -> torch.Tensor:
-        # Select initial candidates
-        candidates = []
-        for _ in range(self.n_branches):
-            candidates.append(_sample(logits, temperature=2))
-        
-        for candidate in candidates:
-            # Remove extra dimensions to get a 1D tensor
-            candidate_token = candidate.squeeze()
-            final_token, success = self.simulate_path(candidate_token, cur_pos)
-            if success:
-                return final_token.unsqueeze(0).unsqueeze(0)
-
-        # If no path leads to normal range, return the first candidate
-        return candidates[0]
\ No newline at end of file
+        self.max_depth = max_depth
+        self.n_branches = n_branches
+        self.budget = budget  # rollout tokens per search, n_branches * max_depth by default
+        self.temperature = temperature  # for the candidates
+        self.rollout_temperature = rollout_temperature
+        self.max_ent = max_ent
+        self.max_vent = max_vent
+        self.generator = generator
+        self.stats = {'searches': 0, 'early_exits': 0, 'rollout_tokens': 0, 'forward_passes': 0}
+
+    def _is_normal_range(self, ent: torch.Tensor, vent: torch.Tensor) -> torch.Tensor:
+        return (ent < self.max_ent) & (vent < self.max_vent)
+
+    def should_search(self, logits: torch.Tensor) -> bool:
+        """Whether the next-token distribution of (1, seqlen, vocab) `logits` is outside the normal range."""
+        ent, vent = calculate_varentropy_logsoftmax(logits[0, -1])
+        return not bool(self._is_normal_range(ent, vent))
+
+    def search(self, logits: torch.Tensor, kvcache, cur_pos: int) -> torch.Tensor:
+        """
+        Next token, (1, 1) int32, after the (1, seqlen, vocab) `logits` of a `kvcache` holding
+        `cur_pos` tokens.
+
+        Each step feeds every branch's newest token in one forward pass, at most `max_depth` steps
+        or `budget` tokens. A rollout succeeds when the distribution after its newest token is in the
+        normal range; the search stops at the first step with a success and returns that branch's
+        candidate (the lowest entropy one if several succeed at once). Otherwise it returns the
+        candidate whose rollout had the lowest mean entropy before reaching a stop token.
+        """
+        n = self.n_branches
+        candidates = _sample_n(logits, n, temperature=self.temperature, generator=self.generator)[:, 0, 0]
+        budget = self.budget if self.budget is not None else n * self.max_depth
+        max_depth = min(self.max_depth, budget // n, (self.model_params.max_seq_len - cur_pos) // n)
+        self.stats['searches'] += 1
+
+        step_tokens = candidates
+        slots = [[] for _ in range(n)]
+        ent_sum = torch.zeros(n, device=device)
+        n_steps = torch.zeros(n, device=device)
+        done = torch.zeros(n, dtype=torch.bool, device=device)
+        for depth in range(max_depth):
+            start = cur_pos + depth * n
+            for i in range(n):
+                slots[i].append(start + i)
+            kv_len = bucket_len(start + n, self.model_params.max_seq_len)
+            attn_mask = build_tree_attn_mask(cur_pos, slots, kv_len)
+            freqs_cis = self.freqs_cis[cur_pos + depth].expand(n, -1)
+            step_logits, kvcache, _ = self.xfmr(self.xfmr_weights, self.model_params, step_tokens.view(1, n), start, freqs_cis, kvcache,
+                                                attn_mask=attn_mask, kv_len=kv_len, with_stats=False)
+            self.stats['forward_passes'] += 1
+            self.stats['rollout_tokens'] += n
+            # A rollout that fed a stop token has ended; what follows it does not count.
+            done |= torch.isin(step_tokens, torch.tensor(STOP_TOKENS, device=device))
+            ent, vent = calculate_varentropy_logsoftmax(step_logits[0].float())
+            ok = self._is_normal_range(ent, vent) & ~done
+            if ok.any():
+                self.stats['early_exits'] += 1
+                best = torch.argmin(torch.where(ok, ent, float('inf')))
+                return candidates[best].view(1, 1).to(torch.int32)
+            ent_sum += torch.where(done, 0.0, ent)
+            n_steps += ~done
+            step_tokens = _sample(step_logits[0].unsqueeze(1), temperature=self.rollout_temperature, generator=self.generator)[:, 0]
+
+        if max_depth == 0:
+            return candidates[:1].view(1, 1).to(torch.int32)
+        # A rollout without a scored step, a stop token candidate, has no evidence for it; it only wins if all are such.
+        mean_ent = torch.where(n_steps > 0, ent_sum / n_steps.clamp(min=1), float('inf'))
+        return candidates[torch.argmin(mean_ent)].view(1, 1).to(torch.int32)
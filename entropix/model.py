@@ -6,9 +6,10 @@ import jax.numpy as jnp
 from functools import partial
 
 from entropix.config import ModelParams
+from entropix import instrumentation
 from entropix.kvcache import KVCache
-from entropix.stats import AttnStats
-from entropix.weights import XfmrWeights, LayerWeights
+from entropix.stats import AttnStats, LayerStats, layer_stats
+from entropix.weights import XfmrWeights, LayerWeights, QuantizedWeight, StackedXfmrWeights, dequantize
 
 
 DEFAULT_MASK_VALUE = -0.7 * float(jnp.finfo(jnp.dtype("float32")).max)
@@ -19,60 +20,145 @@ def rms_norm(x: jax.Array, w: jax.Array, eps: float = 1e-6) -> jax.Array:
   return w * (x * jax.lax.rsqrt(jax.lax.pow(x, 2).mean(-1, keepdims=True) + eps))
 
 
+def linear(x: jax.Array, w: jax.Array | QuantizedWeight) -> jax.Array:
+  """x @ w.T for a bf16 or weight-only quantized (out_features, in_features) weight, dequantized on the fly."""
+  if isinstance(w, QuantizedWeight):
+    w = dequantize(w, x.dtype)
+  return jnp.dot(x, w.T)
+
+
 #@partial(jax.jit, static_argnames=("dtype"))
 def apply_rotary_emb(xq: jax.Array, xk: jax.Array, freqs_cis: jax.Array, dtype: jnp.dtype = jnp.float32) -> Tuple[jax.Array, jax.Array]:
   reshape_xq = xq.astype(jnp.float32).reshape(*xq.shape[:-1], -1, 2)
   reshape_xk = xk.astype(jnp.float32).reshape(*xk.shape[:-1], -1, 2)
   xq_ = jax.lax.complex(reshape_xq[..., 0], reshape_xq[..., 1])
   xk_ = jax.lax.complex(reshape_xk[..., 0], reshape_xk[..., 1])
-  xq_out = xq_ * freqs_cis[None, :, None, :]
-  xk_out = xk_ * freqs_cis[None, :, None, :]
+  # (seqlen, head_dim // 2) is shared by the batch, (bsz, seqlen, head_dim // 2) holds per-row positions
+  freqs_cis = freqs_cis[None, :, None, :] if freqs_cis.ndim == 2 else freqs_cis[:, :, None, :]
+  xq_out = xq_ * freqs_cis
+  xk_out = xk_ * freqs_cis
   xq_out = jnp.stack((jnp.real(xq_out), jnp.imag(xq_out)), axis=-1).reshape(*xq_out.shape[:-1], -1)
   xk_out = jnp.stack((jnp.real(xk_out), jnp.imag(xk_out)), axis=-1).reshape(*xk_out.shape[:-1], -1)
   return xq_out.astype(dtype), xk_out.astype(dtype)
 
+def length_mask(cur_pos: int | jax.Array, seqlen: int, kv_len: int) -> jax.Array:
+  """(1 or bsz, 1, seqlen, kv_len) mask of the cache slots written at or before each query's position."""
+  q_pos = jnp.reshape(cur_pos, (-1, 1)) + jnp.arange(seqlen)[None, :]
+  return (jnp.arange(kv_len)[None, None, :] <= q_pos[..., None])[:, None]
+
 #@partial(jax.jit, static_argnames=("model_params", "cur_pos", "layer_idx"))
-def attention(x: jax.Array, layer_weights: LayerWeights, model_params, cur_pos: int, layer_idx: int, freqs_cis: jax.Array, kvcache: KVCache, attn_mask: Optional[jax.Array] = None) -> Tuple[jax.Array, KVCache]:
+@instrumentation.instrument('attention', 'Attention block per layer', labels=lambda *args, **kwargs: {'layer': args[4]})
+def attention(x: jax.Array, layer_weights: LayerWeights, model_params, cur_pos: int, layer_idx: int, freqs_cis: jax.Array, kvcache: KVCache, attn_mask: Optional[jax.Array] = None, kv_len: Optional[int] = None, with_stats: bool = True) -> Tuple[jax.Array, KVCache, Optional[LayerStats]]:
   bsz, _, _ = x.shape
   n_rep = model_params.n_local_heads // model_params.n_local_kv_heads
-  xq = jnp.dot(x, layer_weights.wq.T).reshape(bsz, -1, model_params.n_local_heads, model_params.head_dim)
-  xk = jnp.dot(x, layer_weights.wk.T).reshape(bsz, -1, model_params.n_local_kv_heads, model_params.head_dim)
-  xv = jnp.dot(x, layer_weights.wv.T).reshape(bsz, -1, model_params.n_local_kv_heads, model_params.head_dim)
+  xq = linear(x, layer_weights.wq).reshape(bsz, -1, model_params.n_local_heads, model_params.head_dim)
+  xk = linear(x, layer_weights.wk).reshape(bsz, -1, model_params.n_local_kv_heads, model_params.head_dim)
+  xv = linear(x, layer_weights.wv).reshape(bsz, -1, model_params.n_local_kv_heads, model_params.head_dim)
   xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
-  keys, values, kvcache = kvcache.update(xk, xv, layer_idx, cur_pos, n_rep)
-  xq = jnp.transpose(xq, (0, 2, 1, 3))  # (bs, n_heads, seqlen, head_dim)
-  keys = jnp.transpose(keys, (0, 2, 3, 1))  # (bs, n_heads, head_dim, cache_len + seqlen)
-  values = jnp.transpose(values, (0, 2, 1, 3))  # (bs, n_heads, cache_len + seqlen, head_dim)
-  scores = jnp.matmul(xq, keys)
+  keys, values, kvcache = kvcache.update(xk, xv, layer_idx, cur_pos, kv_len)  # (bs, cache_len, n_kv_heads, head_dim)
+  # Query head h reads kv head h // n_rep, so group the queries instead of repeating the cache.
+  xq = xq.reshape(bsz, -1, model_params.n_local_kv_heads, n_rep, model_params.head_dim)
+  scores = jnp.einsum('bqgrd,bkgd->bgrqk', xq, keys)
+  scores = scores.reshape(bsz, model_params.n_local_heads, xq.shape[1], -1)  # (bs, n_heads, seqlen, cache_len)
   pre_scores = scores / jnp.sqrt(model_params.head_dim)
   scores = pre_scores.astype(jnp.float32)  # Always do attention softmax at float32
-  if cur_pos == 0:
+  if attn_mask is not None:
     scores = scores + attn_mask
-  mask = jnp.where(scores != 0.0, scores, DEFAULT_MASK_VALUE)
-  padded_logits = jnp.where((mask >= DEFAULT_MASK_VALUE * 0.5), scores, DEFAULT_MASK_VALUE)
-  scores = jax.nn.softmax(padded_logits, axis=-1).astype(x.dtype)
-  output = jnp.matmul(scores, values)
-  output = jnp.swapaxes(output, 1, 2).reshape(xq.shape[0], xq.shape[2], -1)
-  out = jnp.dot(output, layer_weights.wo.T)
-  return out, kvcache, pre_scores
+  if not (isinstance(cur_pos, int) and cur_pos == 0):
+    # Slots past the filled prefix hold zeros or stale keys; hide them by position, not by value.
+    scores = jnp.where(length_mask(cur_pos, xq.shape[1], keys.shape[1]), scores, float('-inf'))
+  valid = scores >= DEFAULT_MASK_VALUE * 0.5
+  padded_logits = jnp.where(valid, scores, DEFAULT_MASK_VALUE)
+  probs = jax.nn.softmax(padded_logits, axis=-1)
+  stats = layer_stats(probs, pre_scores.astype(jnp.float32), valid) if with_stats else None
+  scores = probs.astype(x.dtype).reshape(bsz, model_params.n_local_kv_heads, n_rep, xq.shape[1], -1)
+  output = jnp.einsum('bgrqk,bkgd->bqgrd', scores, values)
+  output = output.reshape(bsz, xq.shape[1], -1)
+  out = linear(output, layer_weights.wo)
+  return out, kvcache, stats
 
 #@partial(jax.jit)
+@instrumentation.instrument('feed_forward', 'Feed-forward block')
 def feed_forward(x: jax.Array, layer_weights: LayerWeights) -> jax.Array:
- return jnp.dot(jax.nn.silu(jnp.dot(x, layer_weights.w1.T)) * jnp.dot(x, layer_weights.w3.T), layer_weights.w2.T)
+ return linear(jax.nn.silu(linear(x, layer_weights.w1)) * linear(x, layer_weights.w3), layer_weights.w2)
 
 #@partial(jax.jit, static_argnames=("model_params", "cur_pos"))
-def xfmr(xfmr_weights: XfmrWeights, model_params: ModelParams, tokens: jax.Array, cur_pos: int, freqs_cis: jax.Array, kvcache: KVCache, attn_mask: Optional[jax.Array]=None) -> Tuple[jax.Array, KVCache]:
+@instrumentation.instrument('xfmr', 'Forward pass', labels=lambda *args, **kwargs: {'phase': instrumentation.phase(args[2])})
+def xfmr(xfmr_weights: XfmrWeights, model_params: ModelParams, tokens: jax.Array, cur_pos: int, freqs_cis: jax.Array, kvcache: KVCache, attn_mask: Optional[jax.Array]=None, kv_len: Optional[int]=None, with_stats: bool = True) -> Tuple[jax.Array, KVCache, Optional[AttnStats]]:
+  """
+  Returns the logits, the updated cache and the `AttnStats` the sampler reads, or None for them
+  with `with_stats=False` (prefill, plain sampling), which skips the statistics altogether.
+  """
   h = xfmr_weights.tok_embeddings[tokens]
   attn_stats = AttnStats.new(
     bsz=tokens.shape[0],
     n_layers=model_params.n_layers,
-    n_heads=model_params.n_local_heads
-  )
+    n_heads=model_params.n_local_heads,
+    seqlen=tokens.shape[1]
+  ) if with_stats else None
   for i in range(model_params.n_layers):
     norm_x = rms_norm(h, xfmr_weights.layer_weights[i].attention_norm)
-    h_attn, kvcache, scores = attention(norm_x, xfmr_weights.layer_weights[i], model_params, cur_pos, i, freqs_cis, kvcache, attn_mask=attn_mask)
-    attn_stats = attn_stats.update(scores[:,:,-1,:], i)
+    h_attn, kvcache, stats = attention(norm_x, xfmr_weights.layer_weights[i], model_params, cur_pos, i, freqs_cis, kvcache, attn_mask=attn_mask, kv_len=kv_len, with_stats=with_stats)
+    if with_stats:
+      attn_stats = attn_stats.update(stats, i)
     h = h + h_attn
     h = h + feed_forward(rms_norm(h, xfmr_weights.layer_weights[i].ffn_norm), xfmr_weights.layer_weights[i])
-  logits = jnp.dot(rms_norm(h, xfmr_weights.norm), xfmr_weights.output.T)
-  return logits, kvcache, scores, attn_stats
+  logits = linear(rms_norm(h, xfmr_weights.norm), xfmr_weights.output)
+  return logits, kvcache, attn_stats
+
+
+
+def _xfmr_scan(xfmr_weights: StackedXfmrWeights, model_params: ModelParams, tokens: jax.Array, cur_pos: int | jax.Array, freqs_cis: jax.Array, kvcache: KVCache, attn_mask: Optional[jax.Array]=None, kv_len: Optional[int]=None, with_stats: bool = True):
+  bsz, seqlen = tokens.shape
+  h = xfmr_weights.tok_embeddings[tokens]
+  if isinstance(cur_pos, int) and cur_pos == 0:
+    kv_len = seqlen
+  elif kv_len is None:
+    kv_len = kvcache.max_seq_len
+  attn_stats = AttnStats.new(bsz=bsz, n_layers=model_params.n_layers, n_heads=model_params.n_local_heads, seqlen=seqlen)
+  # Only arrays go through the carry; without stats it holds no statistics at all.
+  init_stats = (attn_stats.entropy, attn_stats.varentropy, attn_stats.last_layer) if with_stats else ()
+
+  def layer_step(carry, layer):
+    h, kvcache, stats = carry
+    layer_idx, layer_weights = layer
+    norm_x = rms_norm(h, layer_weights.attention_norm)
+    h_attn, kvcache, new_stats = attention(norm_x, layer_weights, model_params, cur_pos, layer_idx, freqs_cis, kvcache, attn_mask=attn_mask, kv_len=kv_len, with_stats=with_stats)
+    if with_stats:
+      entropy, varentropy, _ = stats
+      stats = attn_stats._replace(entropy=entropy, varentropy=varentropy).update(new_stats, layer_idx)
+      stats = (stats.entropy, stats.varentropy, stats.last_layer)
+    h = h + h_attn
+    h = h + feed_forward(rms_norm(h, layer_weights.ffn_norm), layer_weights)
+    return (h, kvcache, stats), None
+
+  layers = (jnp.arange(model_params.n_layers), xfmr_weights.layer_weights)
+  (h, kvcache, stats), _ = jax.lax.scan(layer_step, (h, kvcache, init_stats), layers)
+  logits = linear(rms_norm(h, xfmr_weights.norm), xfmr_weights.output)
+  return logits, kvcache, stats
+
+
+# Prefill keeps `cur_pos` static (the fresh keys are attended directly), decode traces it.
+_xfmr_scan_prefill = jax.jit(_xfmr_scan, static_argnames=("model_params", "cur_pos", "kv_len", "with_stats"), donate_argnames=("kvcache",))
+_xfmr_scan_decode = jax.jit(_xfmr_scan, static_argnames=("model_params", "kv_len", "with_stats"), donate_argnames=("kvcache",))
+
+
+@instrumentation.instrument('xfmr', 'Forward pass', labels=lambda *args, **kwargs: {'phase': instrumentation.phase(args[2])})
+def xfmr_scan(xfmr_weights: StackedXfmrWeights, model_params: ModelParams, tokens: jax.Array, cur_pos: int | jax.Array, freqs_cis: jax.Array, kvcache: KVCache, attn_mask: Optional[jax.Array]=None, kv_len: Optional[int]=None, with_stats: bool = True) -> Tuple[jax.Array, KVCache, Optional[AttnStats]]:
+  """
+  Compiled drop-in for `xfmr` that scans over layers stacked by `weights.stack_weights`.
+
+  Prefill (`cur_pos == 0`) is traced once per prompt length. Every later call passes `cur_pos`
+  as a traced array so a single executable serves every decode position of a `kv_len` bucket.
+  The `kvcache` argument is donated and must not be reused by the caller.
+  """
+  if isinstance(cur_pos, int) and cur_pos == 0:
+    step = _xfmr_scan_prefill
+  else:
+    step, cur_pos = _xfmr_scan_decode, jnp.asarray(cur_pos, dtype=jnp.int32)
+  logits, kvcache, stats = step(xfmr_weights, model_params, tokens, cur_pos, freqs_cis, kvcache, attn_mask=attn_mask, kv_len=kv_len, with_stats=with_stats)
+  if not with_stats:
+    return logits, kvcache, None
+  entropy, varentropy, last_layer = stats
+  attn_stats = AttnStats(entropy=entropy, varentropy=varentropy, n_layers=model_params.n_layers, n_heads=model_params.n_local_heads, last_layer=last_layer)
+  return logits, kvcache, attn_stats
@@ -0,0 +1,123 @@
+import json
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+import ml_dtypes
+import numpy as np
+import tyro
+
+
+PACKED_NAME = 'weights.packed'
+ALIGNMENT = 4096
+MAGIC = b'ENTRPX01'
+
+
+def _dtype(name: str) -> np.dtype:
+  return np.dtype(getattr(ml_dtypes, name, name))
+
+
+def _aligned(n: int) -> int:
+  return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+class PackedWriter:
+  """
+  Writes a packed checkpoint: `MAGIC`, a little-endian u64 header length, a JSON header of
+  name -> {dtype, shape, offset, nbytes}, then every tensor at an `ALIGNMENT`-aligned offset
+  (relative to the data start, itself aligned).
+
+  Every tensor's dtype and shape are declared up front, so `write` can be called in any order,
+  from several threads, and the file is never rewritten.
+
+  With `resume`, written names are logged to `<path>.written`; reopening a file with the same header
+  keeps its data and `written` lists what an interrupted run already finished.
+  """
+
+  def __init__(self, path: Path, specs: Dict[str, Tuple[str, Sequence[int]]], resume: bool = False):
+    tensors, offset = {}, 0
+    for name, (dtype, shape) in specs.items():
+      nbytes = int(np.prod(shape, dtype=np.int64)) * _dtype(dtype).itemsize
+      tensors[name] = {'dtype': dtype, 'shape': list(shape), 'offset': offset, 'nbytes': nbytes}
+      offset = _aligned(offset + nbytes)
+    header = json.dumps({'alignment': ALIGNMENT, 'tensors': tensors}).encode()
+    self.tensors = tensors
+    self.data_start = _aligned(len(MAGIC) + 8 + len(header))
+    self.journal = Path(f'{path}.written') if resume else None
+    self.written = set()
+    self._lock = threading.Lock()
+    if resume and path.exists() and self.journal.exists() and read_index(path) == (tensors, self.data_start):
+      self.written = set(self.journal.read_text().split())
+      self.fd = os.open(path, os.O_RDWR)
+      return
+    self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.pwrite(self.fd, MAGIC + struct.pack('<Q', len(header)) + header, 0)
+    os.ftruncate(self.fd, self.data_start + offset)
+    if self.journal is not None:
+      self.journal.write_text('')
+
+  def write(self, name: str, array: np.ndarray):
+    spec = self.tensors[name]
+    if array.dtype != _dtype(spec['dtype']) or list(array.shape) != spec['shape']:
+      raise ValueError(f'{name}: got {array.dtype}{list(array.shape)}, header says {spec["dtype"]}{spec["shape"]}')
+    os.pwrite(self.fd, np.ascontiguousarray(array).tobytes(), self.data_start + spec['offset'])
+    if self.journal is not None:
+      with self._lock, open(self.journal, 'a') as f:
+        f.write(name + '\n')
+        self.written.add(name)
+
+  def close(self):
+    os.close(self.fd)
+
+  def __enter__(self) -> 'PackedWriter':
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def read_index(path: Path) -> Tuple[Dict[str, dict], int]:
+  """Returns the header's tensor entries and the file offset their `offset`s are relative to."""
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f'{path} is not a packed checkpoint')
+    (n,) = struct.unpack('<Q', f.read(8))
+    header = json.loads(f.read(n))
+  return header['tensors'], _aligned(len(MAGIC) + 8 + n)
+
+
+def load_packed(path: Path) -> Dict[str, np.ndarray]:
+  """Zero-copy views of every tensor over a single copy-on-write mapping of `path`."""
+  tensors, data_start = read_index(path)
+  buf = np.memmap(path, dtype=np.uint8, mode='c')
+  views = {}
+  for name, spec in tensors.items():
+    start = data_start + spec['offset']
+    views[name] = buf[start:start + spec['nbytes']].view(_dtype(spec['dtype'])).reshape(spec['shape'])
+  return views
+
+
+def pack_checkpoint(ckpt_dir: Path, out: Optional[Path] = None):
+  """Packs a `.npy` per tensor checkpoint, and any `<name>.int<bits>.npz` quantized projections, into one file."""
+  arrays = {}
+  for file in sorted(os.listdir(ckpt_dir)):
+    if file.endswith('.npy'):
+      arrays[file[:-len('.npy')]] = np.load(ckpt_dir / file, mmap_mode='r').view(ml_dtypes.bfloat16)
+    elif file.endswith('.npz'):
+      with np.load(ckpt_dir / file) as qw:
+        for key in qw.files:
+          arrays[f'{file[:-len(".npz")]}.{key}'] = qw[key]
+  out = out or ckpt_dir / PACKED_NAME
+  with PackedWriter(out, {name: (a.dtype.name, a.shape) for name, a in arrays.items()}) as writer:
+    for name, a in arrays.items():
+      writer.write(name, a)
+  print(f'Packed {len(arrays)} tensors into {out}')
+
+
+def main(ckpt_dir: Path = Path('weights/1B-Instruct'), out: Optional[Path] = None):
+  pack_checkpoint(ckpt_dir, out)
+
+if __name__ == '__main__':
+  tyro.cli(main)
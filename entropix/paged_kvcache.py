@@ -0,0 +1,104 @@
+from typing import Dict, List, NamedTuple, Optional
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from entropix import instrumentation
+
+
+class BlockAllocator:
+  """
+  Free-list allocator for the fixed-size KV blocks of a paged cache pool.
+
+  Block 0 is never handed out: unused block table entries point at it, so it doubles as a
+  scratch block for padding rows. Sequences own their blocks until `free` is called.
+  """
+
+  def __init__(self, n_blocks: int, block_size: int):
+    self.block_size = block_size
+    self.free_blocks: List[int] = list(range(n_blocks - 1, 0, -1))
+    self.seq_blocks: Dict[int, List[int]] = {}
+
+  @property
+  def n_free(self) -> int:
+    return len(self.free_blocks)
+
+  def blocks_needed(self, seq_id: int, n_tokens: int) -> int:
+    return max(0, -(-n_tokens // self.block_size) - len(self.seq_blocks.get(seq_id, [])))
+
+  def allocate(self, seq_id: int, n_tokens: int) -> bool:
+    """Grows `seq_id` to hold `n_tokens` tokens; returns False (allocating nothing) if the pool is exhausted."""
+    needed = self.blocks_needed(seq_id, n_tokens)
+    if needed > len(self.free_blocks):
+      return False
+    blocks = self.seq_blocks.setdefault(seq_id, [])
+    for _ in range(needed):
+      blocks.append(self.free_blocks.pop())
+    return True
+
+  def free(self, seq_id: int):
+    self.free_blocks.extend(reversed(self.seq_blocks.pop(seq_id, [])))
+
+  def block_table(self, seq_ids: List[int | None], width: int) -> np.ndarray:
+    """(len(seq_ids), width) physical block ids; missing sequences and unused entries map to block 0."""
+    table = np.zeros((len(seq_ids), width), dtype=np.int32)
+    for row, seq_id in enumerate(seq_ids):
+      blocks = self.seq_blocks.get(seq_id, []) if seq_id is not None else []
+      table[row, :len(blocks)] = blocks
+    return table
+
+
+class PagedKVCache(NamedTuple):
+  """
+  KV cache stored as a shared pool of `block_size`-token blocks.
+
+  `block_table[b, i]` is the physical block holding logical positions [i * block_size,
+  (i + 1) * block_size) of row b. `update` has the same contract as `KVCache.update`, so
+  `attention` can use either; the returned keys/values are the row's logical view of the first
+  `kv_len` positions gathered through the table. Pool blocks are reused without being cleared;
+  `attention` masks positions past each row's length.
+  """
+  k: jax.Array  # (layers, n_blocks, block_size, kv_heads, head_dim)
+  v: jax.Array
+  block_table: jax.Array  # (bsz, max_blocks_per_seq)
+
+  @classmethod
+  def new(cls, layers: int, n_blocks: int, block_size: int, kv_heads: int, head_dim: int, block_table: jax.Array) -> 'PagedKVCache':
+    return cls(
+        k=jnp.zeros((layers, n_blocks, block_size, kv_heads, head_dim), dtype=jnp.bfloat16),
+        v=jnp.zeros((layers, n_blocks, block_size, kv_heads, head_dim), dtype=jnp.bfloat16),
+        block_table=jnp.asarray(block_table, dtype=jnp.int32)
+    )
+
+  @property
+  def block_size(self) -> int:
+    return self.k.shape[2]
+
+  @property
+  def max_seq_len(self) -> int:
+    return self.block_table.shape[1] * self.block_size
+
+  @instrumentation.instrument('kvcache_update', 'KV cache write and read', labels=lambda self, *args, **kwargs: {'cache': type(self).__name__})
+  def update(self, xk: jax.Array, xv: jax.Array, layer_idx: int, cur_pos: int | jax.Array, kv_len: Optional[int] = None):
+    bsz, seqlen = xk.shape[:2]
+    pos = jnp.reshape(cur_pos, (-1, 1)) + jnp.arange(seqlen)[None, :]  # (1 or bsz, seqlen)
+    pos = jnp.broadcast_to(pos, (bsz, seqlen))
+    blocks = jnp.take_along_axis(self.block_table, pos // self.block_size, axis=1)
+    offsets = pos % self.block_size
+    ck = self.k.at[layer_idx, blocks, offsets].set(jnp.bfloat16(xk))
+    cv = self.v.at[layer_idx, blocks, offsets].set(jnp.bfloat16(xv))
+    # Only a static `cur_pos == 0` is a fresh prefill; traced and per-row positions read the cache.
+    if isinstance(cur_pos, int) and cur_pos == 0:
+      keys, values = xk, xv
+    else:
+      keys, values = self.gather(ck[layer_idx], kv_len), self.gather(cv[layer_idx], kv_len)
+
+    return keys, values, self._replace(k=ck, v=cv)
+
+  def gather(self, pool: jax.Array, kv_len: Optional[int] = None) -> jax.Array:
+    """(n_blocks, block_size, ...) layer pool -> (bsz, kv_len, ...) logical view, all table slots by default."""
+    kv_len = self.max_seq_len if kv_len is None else kv_len
+    table = self.block_table[:, :-(-kv_len // self.block_size)]
+    bsz, width = table.shape
+    return pool[table].reshape(bsz, width * self.block_size, *pool.shape[2:])[:, :kv_len]
@@ -0,0 +1,167 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import jax
+import jax.numpy as jnp
+import tyro
+
+from entropix.config import LLAMA_1B_PARAMS, ModelParams
+from entropix.kvcache import KVCache, bucket_len
+from entropix.main import DEFAULT_WEIGHTS_PATH, build_tree_attn_mask, precompute_freqs_cis, prefill
+from entropix.model import xfmr, xfmr_scan
+from entropix.prompts import prompt
+from entropix.sampler import SamplerConfig, calculate_varentropy_logsoftmax, sample_positions
+from entropix.tokenizer import Tokenizer
+from entropix.weights import load_weights, random_weights, stack_weights
+
+STOP_TOKENS = (128001, 128008, 128009)
+
+
+class Branch:
+  """One reasoning branch of a packed sequence; forks share their parent's history in the cache."""
+
+  def __init__(self, branch_id: int, tokens: List[int], slots: List[int], entropy: List[float], log_probs: List[float], parent: Optional[int] = None):
+    self.id = branch_id
+    self.parent = parent
+    self.tokens = tokens  # generated tokens, inherited ones included; the last is not in the cache yet
+    self.slots = slots  # cache slots holding tokens[:-1]
+    self.entropy = entropy  # bits, of the distribution each token was drawn from
+    self.log_probs = log_probs  # of each token under that distribution
+    self.finished = False
+    self.pruned = False
+
+  def fork(self, branch_id: int, token: int, log_prob: float) -> 'Branch':
+    """A sibling with this branch's history that ends in `token` instead of its last token."""
+    return Branch(branch_id, self.tokens[:-1] + [token], list(self.slots), list(self.entropy), self.log_probs[:-1] + [log_prob], parent=self.id)
+
+  @property
+  def live(self) -> bool:
+    return not (self.finished or self.pruned)
+
+  @property
+  def mean_entropy(self) -> float:
+    return sum(self.entropy) / len(self.entropy)
+
+
+def generate_parallel_cot(xfmr_weights, model_params: ModelParams, tokens: List[int], cfg: SamplerConfig = SamplerConfig(),
+                          compiled: bool = False, max_branches: int = 4, spawn_ent: float = 3.0, prune_margin: float = 1.0,
+                          min_prune_len: int = 8, max_new_tokens: int = 256,
+                          key: jax.Array = jax.random.PRNGKey(1337)) -> Tuple[List[Branch], Dict[str, float]]:
+  """
+  Entropy-guided parallel chain-of-thought decoding from one prompt.
+
+  All branches are packed into a single sequence of one `KVCache`. The prompt is prefilled once.
+  Every step feeds each live branch's newest token at the next free cache slots in one forward
+  pass. Rotary positions continue each branch's own history, and `build_tree_attn_mask` lets each
+  branch see only the prompt and its own (and its ancestors') tokens. Each branch is sampled by
+  the entropy sampler with a key of its own.
+
+  A branch whose next-token entropy exceeds `spawn_ent` bits forks while fewer than `max_branches`
+  are live: the fork ends in the most likely token other than the sampled one. A live branch of at
+  least `min_prune_len` tokens is pruned once its mean entropy exceeds the lowest one among such
+  branches by `prune_margin` bits. Branches finish at a stop token or `max_new_tokens`. Slots of
+  pruned branches stay in the cache, masked out.
+
+  Returns the branches, finished ones by increasing mean entropy first, and step counts.
+  """
+  forward = xfmr_scan if compiled else xfmr
+  n_prompt = len(tokens)
+  freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  kvcache = KVCache.new(model_params.n_layers, 1, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim)
+  logits, kvcache = prefill(forward, xfmr_weights, model_params, jnp.array([tokens], jnp.int32), 0, freqs_cis, kvcache)
+  entropy, _ = calculate_varentropy_logsoftmax(logits[0, -1])
+  first = int(jnp.argmax(logits[0, -1]))
+  branches = [Branch(0, [first], [], [float(entropy)], [float(jax.nn.log_softmax(logits[0, -1])[first])])]
+  branches[0].finished = first in STOP_TOKENS or max_new_tokens <= 1
+  next_slot = n_prompt
+  n_forward = n_forks = n_pruned = 0
+
+  while True:
+    live = [b for b in branches if b.live]
+    n = len(live)
+    if n == 0 or next_slot + n > model_params.max_seq_len:
+      break
+    for i, b in enumerate(live):
+      b.slots.append(next_slot + i)
+    step_tokens = jnp.array([[b.tokens[-1] for b in live]], jnp.int32)
+    positions = jnp.array([n_prompt + len(b.tokens) - 1 for b in live])
+    kv_len = bucket_len(next_slot + n, model_params.max_seq_len)
+    attn_mask = build_tree_attn_mask(n_prompt, [b.slots for b in live], kv_len)
+    logits, kvcache, stats = forward(xfmr_weights, model_params, step_tokens, next_slot, freqs_cis[positions], kvcache, attn_mask=attn_mask, kv_len=kv_len)
+    next_slot += n
+    n_forward += 1
+
+    keys = jax.random.split(jax.random.fold_in(key, n_forward), n)
+    sampled, _ = sample_positions(step_tokens[0], logits, stats, cfg=cfg, key=keys)
+    entropy, _ = calculate_varentropy_logsoftmax(logits[0])
+    log_probs = jax.nn.log_softmax(logits[0].astype(jnp.float32), axis=-1)
+    top2 = jax.lax.top_k(logits[0], 2)[1]
+    # The fork's token: the most likely one the branch did not sample.
+    alts = jnp.where(top2[:, 0] == sampled, top2[:, 1], top2[:, 0])
+    rows = jnp.arange(n)
+    sampled, alts, entropy = sampled.tolist(), alts.tolist(), entropy.tolist()
+    sampled_lp, alt_lp = log_probs[rows, jnp.array(sampled)].tolist(), log_probs[rows, jnp.array(alts)].tolist()
+
+    n_live = n
+    for i, b in enumerate(live):
+      b.tokens.append(sampled[i])
+      b.entropy.append(entropy[i])
+      b.log_probs.append(sampled_lp[i])
+      b.finished = sampled[i] in STOP_TOKENS or len(b.tokens) >= max_new_tokens
+      if b.finished:
+        n_live -= 1
+      elif entropy[i] > spawn_ent and n_live < max_branches:
+        fork = b.fork(len(branches), alts[i], alt_lp[i])
+        fork.finished = alts[i] in STOP_TOKENS
+        branches.append(fork)
+        n_forks += 1
+        n_live += not fork.finished
+
+    candidates = [b for b in branches if b.live and len(b.tokens) >= min_prune_len]
+    if len(candidates) > 1:
+      best = min(b.mean_entropy for b in candidates)
+      for b in candidates:
+        if b.mean_entropy > best + prune_margin:
+          b.pruned = True
+          n_pruned += 1
+
+  stats = {
+    'n_forward': n_forward,
+    'n_branches': len(branches),
+    'n_forks': n_forks,
+    'n_pruned': n_pruned,
+    'cache_slots': next_slot - n_prompt,
+    'tokens_per_forward': (next_slot - n_prompt) / max(n_forward, 1),
+    'unpacked_cache_slots': sum(len(b.slots) for b in branches),  # what separate caches per branch would hold past the prompt
+  }
+  return sorted(branches, key=lambda b: (not b.finished, b.pruned, b.mean_entropy)), stats
+
+
+def main(weights_path: Path = DEFAULT_WEIGHTS_PATH.joinpath('1B-Instruct'), max_branches: int = 4, spawn_ent: float = 3.0,
+         prune_margin: float = 1.0, min_prune_len: int = 8, max_new_tokens: int = 256, compiled: bool = False, random_model: bool = False):
+  """
+  Parallel CoT decoding of the default prompt, printing every branch best first. `random_model`
+  runs a 4-layer random-weight model on CPU instead of the checkpoint.
+  """
+  tokenizer = None
+  if random_model:
+    model_params = ModelParams(n_layers=4, n_local_heads=8, n_local_kv_heads=2, head_dim=64, max_seq_len=1024, rope_theta=500000.0, use_scaled_rope=True)
+    xfmr_weights = random_weights(model_params, 4096)
+    tokens = jax.random.randint(jax.random.PRNGKey(0), (64,), 0, 4096).tolist()
+  else:
+    model_params = LLAMA_1B_PARAMS
+    xfmr_weights = load_weights(weights_path.absolute())
+    tokenizer = Tokenizer('entropix/tokenizer.model')
+    tokens = tokenizer.encode(prompt, bos=False, eos=False, allowed_special='all')
+  if compiled:
+    xfmr_weights = stack_weights(xfmr_weights)
+  branches, stats = generate_parallel_cot(xfmr_weights, model_params, tokens, compiled=compiled, max_branches=max_branches, spawn_ent=spawn_ent,
+                                          prune_margin=prune_margin, min_prune_len=min_prune_len, max_new_tokens=max_new_tokens)
+  for b in branches:
+    status = 'finished' if b.finished else 'pruned' if b.pruned else 'cut off'
+    print(f'--- branch {b.id} (from {b.parent}), {status}, mean entropy {b.mean_entropy:.3f} bits, {len(b.tokens)} tokens')
+    print(tokenizer.decode(b.tokens) if tokenizer is not None else b.tokens)
+  print(' '.join(f'{name}={value:.4g}' for name, value in stats.items()))
+
+if __name__ == '__main__':
+  tyro.cli(main)
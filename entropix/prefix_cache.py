@@ -0,0 +1,113 @@
+import itertools
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import jax
+import jax.numpy as jnp
+
+
+class _Node:
+  __slots__ = ('tokens', 'k', 'v', 'parent', 'children', 'last_used')
+
+  def __init__(self, tokens: Tuple[int, ...], k: Optional[jax.Array], v: Optional[jax.Array], parent: Optional['_Node']):
+    self.tokens = tokens  # edge label, the token ids this node adds to its parent's prefix
+    self.k = k  # (layers, len(tokens), kv_heads, head_dim)
+    self.v = v
+    self.parent = parent
+    self.children: Dict[int, '_Node'] = {}
+    self.last_used = 0
+
+  @property
+  def n_bytes(self) -> int:
+    return self.k.nbytes + self.v.nbytes
+
+
+def _common_len(a: Sequence[int], b: Sequence[int]) -> int:
+  n = 0
+  for x, y in zip(a, b):
+    if x != y:
+      break
+    n += 1
+  return n
+
+
+class PrefixCache:
+  """
+  Radix tree over prompt token ids whose edges hold the KV entries computed for those tokens.
+
+  Keys and values at a position only depend on the tokens up to it, so any cached prefix of a new
+  prompt can be copied into its `KVCache` and prefill resumes right after it. Leaves are evicted
+  least recently used first once the stored entries exceed `max_bytes`.
+  """
+
+  def __init__(self, max_bytes: int):
+    self.root = _Node((), None, None, None)
+    self.max_bytes = max_bytes
+    self.n_bytes = 0
+    self.n_lookup_tokens = 0
+    self.n_hit_tokens = 0
+    self._clock = itertools.count(1)
+
+  def match(self, tokens: Sequence[int]) -> Tuple[int, Optional[jax.Array], Optional[jax.Array]]:
+    """Returns the length of the longest cached prefix of `tokens` and its (layers, n, kv_heads, head_dim) keys/values."""
+    tick = next(self._clock)
+    node, n = self.root, 0
+    ks: List[jax.Array] = []
+    vs: List[jax.Array] = []
+    while n < len(tokens) and (child := node.children.get(tokens[n])) is not None:
+      m = _common_len(child.tokens, tokens[n:])
+      child.last_used = tick
+      ks.append(child.k[:, :m])
+      vs.append(child.v[:, :m])
+      n += m
+      if m < len(child.tokens):
+        break
+      node = child
+    self.n_lookup_tokens += len(tokens)
+    self.n_hit_tokens += n
+    if n == 0:
+      return 0, None, None
+    return n, jnp.concatenate(ks, axis=1), jnp.concatenate(vs, axis=1)
+
+  def insert(self, tokens: Sequence[int], k: jax.Array, v: jax.Array):
+    """Stores `k`, `v` (layers, len(tokens), kv_heads, head_dim) for `tokens`, keeping entries already cached."""
+    tick = next(self._clock)
+    node, n = self.root, 0
+    while n < len(tokens):
+      child = node.children.get(tokens[n])
+      if child is None:
+        child = _Node(tuple(tokens[n:]), k[:, n:], v[:, n:], node)
+        node.children[tokens[n]] = child
+        self.n_bytes += child.n_bytes
+        child.last_used = tick
+        break
+      m = _common_len(child.tokens, tokens[n:])
+      if m < len(child.tokens):
+        child = self._split(child, m)
+      child.last_used = tick
+      node, n = child, n + m
+    self._evict()
+
+  def _split(self, node: _Node, m: int) -> _Node:
+    """Cuts `node`'s edge after `m` tokens and returns the new parent holding the first part."""
+    head = _Node(node.tokens[:m], node.k[:, :m], node.v[:, :m], node.parent)
+    head.last_used = node.last_used
+    node.parent.children[node.tokens[0]] = head
+    node.tokens, node.k, node.v, node.parent = node.tokens[m:], node.k[:, m:], node.v[:, m:], head
+    head.children[node.tokens[0]] = node
+    return head
+
+  def _evict(self):
+    while self.n_bytes > self.max_bytes:
+      leaves = []
+      stack = list(self.root.children.values())
+      while stack:
+        node = stack.pop()
+        if node.children:
+          stack.extend(node.children.values())
+        else:
+          leaves.append(node)
+      if not leaves:
+        return
+      leaf = min(leaves, key=lambda node: node.last_used)
+      del leaf.parent.children[leaf.tokens[0]]
+      self.n_bytes -= leaf.n_bytes
@@ -39,6 +39,12 @@ Certainly. I'll now provide my expert response to the task, drawing upon my exte
 
 """
 
+def create_chat_prompt(messages: List[Dict[str, str]]) -> str:
+    prompt = "<|begin_of_text|>"
+    for message in messages:
+        prompt += f"<|start_header_id|>{message['role']}<|end_header_id|>\n{message['content']}<|eot_id|>"
+    return prompt + "<|start_header_id|>assistant<|end_header_id|>\n"
+
 def create_prompts_from_csv(csv_path: str) -> List[str]:
     prompts = []
     with open(csv_path, 'r') as csvfile:
@@ -1,8 +1,15 @@
 from typing import Dict, Tuple
 
+from functools import partial
+
 import chex
 import jax
+import jax.extend
 import jax.numpy as jnp
+import numpy as np
+
+from entropix import instrumentation
+from entropix.stats import AttnStats, LayerStats
 
 LN_2 = 0.69314718056  # ln(2) = 1.0 / LOG2_E
 
@@ -45,25 +52,46 @@ def _sample( logits: jax.Array, *, temperature: float | jax.Array, top_p: float
     next_token_g = jnp.take_along_axis(probs_idx, next_token.reshape(bsz, 1), axis=-1)
     return next_token_g.astype(jnp.int32)
 
-def calculate_metrics(logits: jnp.ndarray, attention_scores: jnp.ndarray) -> Dict[str, jnp.ndarray]:
+def _sample_n(logits: jax.Array, *, temperature: float | jax.Array, top_p: float | jax.Array, top_k: int, keys: jax.Array) -> jax.Array:
+    """
+    `_sample` once per key in `keys` (n, 2) from a single softmax and top-k: (n, bsz, 1) tokens.
+
+    Each draw uses the noise `_sample` draws with that key, so the tokens are the ones n calls give.
+    Like `_sample`, min_p is not applied.
+    """
+    logit = logits[:, -1]
+    probs = jax.nn.softmax(logit / temperature, axis=-1)
+    top_k_probs, top_k_indices = jax.lax.top_k(probs, k=top_k)
+    probs_sort = jnp.flip(top_k_probs, axis=-1)
+    probs_idx = jnp.flip(top_k_indices, axis=-1)
+    probs_sum = jnp.cumsum(probs_sort, axis=-1)
+    mask = jnp.where(probs_sum - probs_sort > top_p, 1.0, 0.0)
+    probs_sort = probs_sort * (1 - mask)
+    probs_sort = probs_sort / jnp.sum(probs_sort, axis=-1, keepdims=True)
+    next_tokens = jax.vmap(lambda key: multinomial_sample_one(probs_sort, key))(keys)
+    return jnp.take_along_axis(jnp.broadcast_to(probs_idx, (keys.shape[0],) + probs_idx.shape), next_tokens, axis=-1).astype(jnp.int32)
+
+def _best_of_n(logits: jax.Array, samples: jax.Array, confidence_score: jax.Array) -> jax.Array:
+    """The (bsz, 1) sample out of (n, bsz, 1) `samples` with the highest log-prob plus `confidence_score`, first on ties."""
+    log_probs = jax.nn.log_softmax(logits[:, -1], axis=-1)
+    sample_log_probs = jnp.take_along_axis(jnp.broadcast_to(log_probs, (samples.shape[0],) + log_probs.shape), samples, axis=-1)
+    sample_scores = jnp.sum(sample_log_probs, axis=(1, 2)) + jnp.mean(confidence_score)
+    return samples[jnp.argmax(sample_scores)]
+
+def calculate_metrics(logits: jnp.ndarray, attn_stats: LayerStats) -> Dict[str, jnp.ndarray]:
+    """Sampler metrics from the logits and the last layer's statistics that `attention` computed."""
     entropy, varentropy = calculate_varentropy_logsoftmax(logits)
 
-    attention_probs = jax.nn.softmax(attention_scores, axis=-1)
-    attn_entropy = -jnp.sum(attention_probs * jnp.log2(jnp.clip(attention_probs, 1e-10, 1.0)), axis=-1)
+    attn_entropy = attn_stats.entropy / LN_2  # (bsz, n_heads, seqlen), base-2
     attn_varentropy = jnp.var(attn_entropy, axis=1)
 
-    mean_attention = jnp.mean(attention_probs, axis=1)
-    agreement = jnp.mean(jnp.abs(attention_probs - mean_attention[:, None, :]), axis=(1, 2))
-
-    interaction_strength = jnp.mean(jnp.abs(attention_scores), axis=(1, 2, 3))
-
     return {
         "logits_entropy": jnp.mean(entropy),
         "logits_varentropy": jnp.mean(varentropy),
         "attn_entropy": jnp.mean(attn_entropy),
         "attn_varentropy": jnp.mean(attn_varentropy),
-        "agreement": jnp.mean(agreement),
-        "interaction_strength": interaction_strength
+        "agreement": jnp.mean(attn_stats.agreement),
+        "interaction_strength": jnp.mean(attn_stats.interaction_strength, axis=-1)
     }
 
 @chex.dataclass(kw_only=True, frozen=True)
@@ -115,10 +143,22 @@ class SamplerConfig:
     ada_score_int: float = 0.6
 
 
-def sample(gen_tokens: jax.Array, logits: jax.Array, attention_scores: jax.Array, cfg: SamplerConfig,
+# Quadrant names in branch id order (the ids `sample_jit` returns).
+BRANCH_NAMES = ('low_ent_low_vent', 'high_ent_low_vent', 'low_ent_high_vent', 'high_ent_high_vent', 'adaptive')
+
+
+def count_branches(branches: jax.Array):
+    """Adds branch ids returned by `sample_jit`/`sample_rows` to the sampler branch counter."""
+    if instrumentation.enabled() and not isinstance(branches, jax.core.Tracer):
+        for branch in np.asarray(branches).ravel().tolist():
+            instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[branch])
+
+
+@instrumentation.instrument('sample', 'Sampling one token')
+def sample(gen_tokens: jax.Array, logits: jax.Array, attn_stats: AttnStats, cfg: SamplerConfig,
            clarifying_question_token: int = 2564, key=jax.random.PRNGKey(1337)) -> jax.Array:
 
-    metrics = calculate_metrics(logits, attention_scores)
+    metrics = calculate_metrics(logits, attn_stats.last_layer)
     ent, vent = metrics["logits_entropy"], metrics["logits_varentropy"]
     attn_ent, attn_vent = metrics["attn_entropy"], metrics["attn_varentropy"]
     agreement = metrics["agreement"]
@@ -126,10 +166,12 @@ def sample(gen_tokens: jax.Array, logits: jax.Array, attention_scores: jax.Array
 
     # Low Entropy, Low Varentropy: "flowing with unspoken intent"
     if ent < cfg.low_ent_thresh and vent < cfg.low_vent_thresh:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[0])
         return jnp.argmax(logits[:, -1], axis=-1, keepdims=True).astype(jnp.int32)
 
     # High Entropy, Low Varentropy: "treading carefully, asking clarifying questions"
     elif ent > cfg.high_ent_thresh and vent < cfg.low_vent_thresh:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[1])
         # Insert a clarifying question token if not already present
         if not jnp.isin(gen_tokens[:,-1], clarifying_question_token).any():
             return jnp.array([[clarifying_question_token]])
@@ -140,12 +182,14 @@ def sample(gen_tokens: jax.Array, logits: jax.Array, attention_scores: jax.Array
 
     # Low Entropy, High Varentropy: "exploring forks in the path"
     elif ent < cfg.high_ent_thresh and vent > cfg.high_vent_thresh:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[2])
         temp_adj = cfg.lehv_interaction_strength_offset + cfg.lehv_interaction_strength_coef * interaction_strength  # Increase temperature based on interaction strength
         top_k_adj = max(5, int(cfg.top_k * (1 + 0.5 * (1 - agreement))))  # Increase top_k when agreement is low
         return _sample(logits, temperature=min(1.5, cfg.temp * temp_adj), top_p=cfg.top_p, top_k=top_k_adj, min_p=cfg.min_p, key=key)
 
     # High Entropy, High Varentropy: "resampling in the mist"
     elif ent > cfg.med_ent_thresh and vent > cfg.high_vent_thresh:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[3])
         # Use high temperature and adjusted top_p based on attention metrics
         temp_adj = cfg.hehv_attn_vent_offset + cfg.hehv_attn_vent_coef * attn_vent  # Increase temperature based on attention varentropy
         top_p_adj = max(0.5, cfg.top_p - cfg.hehv_attn_ent_coef * attn_ent)  # Decrease top_p when attention entropy is high
@@ -153,6 +197,7 @@ def sample(gen_tokens: jax.Array, logits: jax.Array, attention_scores: jax.Array
 
     # Middle ground: use adaptive sampling
     else:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[4])
         logits_uncertainty = metrics["logits_entropy"] + metrics["logits_varentropy"]
         attn_uncertainty = metrics["attn_entropy"] + metrics["attn_varentropy"]
 
@@ -163,27 +208,225 @@ def sample(gen_tokens: jax.Array, logits: jax.Array, attention_scores: jax.Array
             a_min=1,
             a_max=100
         ))
-        min_p = jnp.clip(cfg.min_p * (1 - cfg.ada_min_p * logits_uncertainty), 0.01, 0.5)
+        keys = jax.random.split(key, cfg.n_adaptive_samples)
+        samples = _sample_n(logits, temperature=temperature, top_p=top_p, top_k=top_k, keys=keys)
+
+        confidence_score = (
+            (1 - metrics["logits_entropy"]) * cfg.ada_score_logits_ent +
+            (1 - metrics["attn_entropy"]) * cfg.ada_score_attn_ent +
+            (1 - metrics["logits_varentropy"]) * cfg.ada_score_logits_vent +
+            (1 - metrics["attn_varentropy"]) * cfg.ada_score_attn_vent +
+            metrics["agreement"] * cfg.ada_score_agree +
+            metrics["interaction_strength"] * cfg.ada_score_int
+        )
+        return _best_of_n(logits, samples, confidence_score)
+
+
+def sample_plain(logits: jax.Array, cfg: SamplerConfig, key=jax.random.PRNGKey(1337)) -> jax.Array:
+    """Temperature/top-k/top-p sampling at `cfg`'s base settings, for forward passes run with `with_stats=False`."""
+    return _sample(logits, temperature=cfg.temp, top_p=cfg.top_p, top_k=cfg.top_k, min_p=cfg.min_p, key=key)
+
+def _max_top_k(cfg: SamplerConfig) -> int:
+    """Upper bound on any top_k `sample` can pick (the adaptive branch clips at 100)."""
+    return max(100, cfg.top_k, int(cfg.top_k * 1.5))
+
+def _exponential_noise_table(key: jax.Array, bsz: int, max_k: int) -> jax.Array:
+    """
+    Row k - 1 equals `jax.random.exponential(key, (bsz, k))` padded with ones to `max_k` columns.
+
+    Threefry's bit stream depends on the requested size, so a padded draw cannot reproduce a
+    smaller one. Instead, the counter pairs `random_bits` would hash for every size are laid out
+    up front and hashed in a single `threefry_2x32` call. That layout is the non-partitionable
+    one; with `jax_threefry_partitionable` on, the table is built from one draw per size instead.
+    """
+    if jax.config.jax_threefry_partitionable:
+        return jnp.stack([jnp.pad(jax.random.exponential(key, (bsz, k)), ((0, 0), (0, max_k - k)), constant_values=1.0)
+                          for k in range(1, max_k + 1)])
+    n_pairs = sum((bsz * k + 1) // 2 for k in range(1, max_k + 1))
+    firsts, seconds = [], []
+    index = np.zeros((max_k, bsz, max_k), dtype=np.int64)
+    offset = 0
+    for k in range(1, max_k + 1):
+        n = bsz * k
+        half = (n + 1) // 2
+        counts = np.concatenate([np.arange(n), np.zeros(n % 2, dtype=np.int64)])
+        firsts.append(counts[:half])
+        seconds.append(counts[half:])
+        flat = np.arange(bsz)[:, None] * k + np.arange(k)[None, :]
+        index[k - 1, :, :k] = np.where(flat < half, offset + flat, n_pairs + offset + flat - half)
+        offset += half
+    counts = jnp.asarray(np.concatenate(firsts + seconds).astype(np.uint32))
+    bits = jax.extend.random.threefry_2x32(key, counts)[index]
+    # Same mantissa trick as `jax.random.uniform`, then `jax.random.exponential`'s -log1p(-u).
+    floats = jax.lax.bitcast_convert_type((bits >> 9) | np.uint32(0x3F800000), jnp.float32) - 1.0
+    noise = -jnp.log1p(-jnp.maximum(0.0, floats))
+    valid = np.arange(max_k)[None, None, :] < np.arange(1, max_k + 1)[:, None, None]
+    return jnp.where(valid, noise, 1.0)
+
+def _sample_dynamic_k(logits: jax.Array, *, temperature: float | jax.Array, top_p: float | jax.Array, top_k: jax.Array,
+                      max_k: int, key=jax.random.PRNGKey(1337)) -> jax.Array:
+    """
+    `_sample` for a traced `top_k` in [1, max_k].
+
+    The top-k slice is padded to `max_k` in the same ascending order `_sample` uses, and the
+    exponential noise is the one `_sample` would draw at shape `(bsz, top_k)`, so both
+    functions agree token for token under the same key. `_sample` never applies `min_p`, so neither does this.
+    """
+    return _sample_dynamic_k_n(logits, temperature=temperature, top_p=top_p, top_k=top_k, max_k=max_k, keys=key[None])[0]
+
+def _sample_dynamic_k_n(logits: jax.Array, *, temperature: float | jax.Array, top_p: float | jax.Array, top_k: jax.Array,
+                        max_k: int, keys: jax.Array) -> jax.Array:
+    """`_sample_dynamic_k` once per key in `keys` (n, 2) from a single softmax and top-k: (n, bsz, 1) tokens."""
+    bsz = logits.shape[0]
+    logit = logits[:, -1]
+    probs = jax.nn.softmax(logit / temperature, axis=-1)
+    max_k = min(max_k, probs.shape[-1])
+    top_k = jnp.clip(top_k, 1, max_k)
+    top_k_probs, top_k_indices = jax.lax.top_k(probs, k=max_k)
+    # Entry i is the (top_k - 1 - i)-th largest, i.e. `_sample`'s flipped top-k followed by padding.
+    valid = jnp.arange(max_k) < top_k
+    order = jnp.where(valid, top_k - 1 - jnp.arange(max_k), 0)
+    probs_sort = jnp.where(valid, top_k_probs[:, order], 0)
+    probs_idx = top_k_indices[:, order]
+    probs_sum = jnp.cumsum(probs_sort, axis=-1)
+    mask = jnp.where(probs_sum - probs_sort > top_p, 1.0, 0.0)
+    probs_sort = probs_sort * (1 - mask)
+    probs_sort = probs_sort / jnp.sum(probs_sort, axis=-1, keepdims=True)
+
+    q = jax.vmap(lambda key: _exponential_noise_table(key, bsz, max_k)[top_k - 1])(keys)
+    next_tokens = jnp.argmax(probs_sort / q, axis=-1, keepdims=True).astype(jnp.int32)
+    return jnp.take_along_axis(jnp.broadcast_to(probs_idx, (keys.shape[0],) + probs_idx.shape), next_tokens, axis=-1).astype(jnp.int32)
+
+def _select_min(bound: float, value: jax.Array, fn):
+    """Traceable `fn(min(bound, value))` that keeps `bound` a Python scalar like the eager path does."""
+    return jax.lax.cond(jnp.all(value < bound), lambda: fn(value), lambda: fn(bound))
+
+def _select_max(bound: float, value: jax.Array, fn):
+    """Traceable `fn(max(bound, value))` that keeps `bound` a Python scalar like the eager path does."""
+    return jax.lax.cond(jnp.all(value > bound), lambda: fn(value), lambda: fn(bound))
+
+@partial(jax.jit, static_argnames=("cfg", "clarifying_question_token"))
+def _sample_jit(asked_question: jax.Array, logits: jax.Array, attn_stats: LayerStats, cfg: SamplerConfig,
+                clarifying_question_token: int, key: jax.Array) -> Tuple[jax.Array, jax.Array]:
+    bsz = logits.shape[0]
+    metrics = calculate_metrics(logits, attn_stats)
+    ent, vent = metrics["logits_entropy"], metrics["logits_varentropy"]
+    attn_ent, attn_vent = metrics["attn_entropy"], metrics["attn_varentropy"]
+    agreement = metrics["agreement"]
+    interaction_strength = metrics["interaction_strength"]
+
+    def low_ent_low_vent():
+        return jnp.argmax(logits[:, -1], axis=-1, keepdims=True).astype(jnp.int32)
+
+    def high_ent_low_vent():
+        temp_adj = cfg.helv_attn_ent_offset + cfg.helv_attn_ent_coef * attn_ent
+
+        def resample():
+            return _select_min(1.5, cfg.temp * temp_adj, lambda temperature: _sample(
+                logits, temperature=temperature, top_p=cfg.top_p, top_k=cfg.top_k, min_p=cfg.min_p, key=key))
+
+        def ask():
+            return jnp.full((bsz, 1), clarifying_question_token, dtype=jnp.int32)
+
+        return jax.lax.cond(asked_question, resample, ask)
+
+    def low_ent_high_vent():
+        temp_adj = cfg.lehv_interaction_strength_offset + cfg.lehv_interaction_strength_coef * interaction_strength
+        top_k_adj = jnp.maximum(5, (cfg.top_k * (1 + 0.5 * (1 - agreement))).astype(jnp.int32))
+        return _select_min(1.5, cfg.temp * temp_adj, lambda temperature: _sample_dynamic_k(
+            logits, temperature=temperature, top_p=cfg.top_p, top_k=top_k_adj, max_k=_max_top_k(cfg), key=key))
+
+    def high_ent_high_vent():
+        temp_adj = cfg.hehv_attn_vent_offset + cfg.hehv_attn_vent_coef * attn_vent
+        return _select_max(2.0, cfg.temp * temp_adj, lambda temperature: _select_max(
+            0.5, cfg.top_p - cfg.hehv_attn_ent_coef * attn_ent, lambda top_p: _sample(
+                logits, temperature=temperature, top_p=top_p, top_k=cfg.top_k, min_p=cfg.min_p, key=key)))
+
+    def adaptive():
+        logits_uncertainty = metrics["logits_entropy"] + metrics["logits_varentropy"]
+        attn_uncertainty = metrics["attn_entropy"] + metrics["attn_varentropy"]
+
+        temperature = cfg.temp * (1 + cfg.ada_temp_logits * logits_uncertainty + cfg.ada_temp_attn * attn_uncertainty - cfg.ada_temp_agree * metrics["agreement"])
+        top_p = jnp.clip(cfg.top_p * (1 + cfg.ada_top_p * metrics["attn_varentropy"]), 0.1, 1.0)
+        top_k = jnp.clip(
+            jnp.round(cfg.top_k * (1 + cfg.ada_top_k_int * jnp.mean(metrics["interaction_strength"]) - cfg.ada_top_k_agree * metrics["agreement"])),
+            a_min=1,
+            a_max=100
+        ).astype(jnp.int32)
 
         keys = jax.random.split(key, cfg.n_adaptive_samples)
+        samples = _sample_dynamic_k_n(logits, temperature=temperature, top_p=top_p, top_k=top_k, max_k=_max_top_k(cfg), keys=keys)
+
+        confidence_score = (
+            (1 - metrics["logits_entropy"]) * cfg.ada_score_logits_ent +
+            (1 - metrics["attn_entropy"]) * cfg.ada_score_attn_ent +
+            (1 - metrics["logits_varentropy"]) * cfg.ada_score_logits_vent +
+            (1 - metrics["attn_varentropy"]) * cfg.ada_score_attn_vent +
+            metrics["agreement"] * cfg.ada_score_agree +
+            metrics["interaction_strength"] * cfg.ada_score_int
+        )
+        return _best_of_n(logits, samples, confidence_score)
+
+    branch = jnp.select(
+        [
+            (ent < cfg.low_ent_thresh) & (vent < cfg.low_vent_thresh),
+            (ent > cfg.high_ent_thresh) & (vent < cfg.low_vent_thresh),
+            (ent < cfg.high_ent_thresh) & (vent > cfg.high_vent_thresh),
+            (ent > cfg.med_ent_thresh) & (vent > cfg.high_vent_thresh),
+        ],
+        [0, 1, 2, 3],
+        default=4,
+    )
+    branches = [low_ent_low_vent, high_ent_low_vent, low_ent_high_vent, high_ent_high_vent, adaptive]
+    return jax.lax.switch(branch, branches), branch
+
+def sample_jit(gen_tokens: jax.Array, logits: jax.Array, attn_stats: AttnStats, cfg: SamplerConfig,
+               clarifying_question_token: int = 2564, key=jax.random.PRNGKey(1337)) -> Tuple[jax.Array, jax.Array]:
+    """
+    Traceable drop-in for `sample`: the quadrant is picked on device with `lax.switch`.
+
+    Returns the sampled token and the branch id (0: low ent/low vent, 1: high ent/low vent,
+    2: low ent/high vent, 3: high ent/high vent, 4: adaptive). The clarifying question check on
+    `gen_tokens` is reduced to a flag first so a growing `gen_tokens` does not retrace the sampler.
+    """
+    asked_question = jnp.isin(gen_tokens[:, -1], clarifying_question_token).any()
+    next_token, branch = _sample_jit(asked_question, logits, attn_stats.last_layer, cfg, clarifying_question_token, key)
+    count_branches(branch)
+    return next_token, branch
+
+@partial(jax.jit, static_argnames=("cfg", "clarifying_question_token"))
+def _sample_rows_jit(asked_question: jax.Array, logits: jax.Array, attn_stats: LayerStats, cfg: SamplerConfig,
+                     clarifying_question_token: int, keys: jax.Array) -> Tuple[jax.Array, jax.Array]:
+    def sample_row(asked, row_logits, row_stats, key):
+        return _sample_jit(asked, row_logits[None], jax.tree.map(lambda x: x[None], row_stats), cfg, clarifying_question_token, key)
+    tokens, branches = jax.vmap(sample_row)(asked_question, logits, attn_stats, keys)
+    return tokens.reshape(-1, 1), branches
+
+def sample_rows(gen_tokens: jax.Array, logits: jax.Array, attn_stats: AttnStats, cfg: SamplerConfig,
+                clarifying_question_token: int = 2564, key=jax.random.PRNGKey(1337)) -> Tuple[jax.Array, jax.Array]:
+    """
+    Batched `sample_jit` where every row picks its own quadrant from its own metrics.
 
-        samples = []
-        for sample_key in keys:
-            sample = _sample(logits, temperature=temperature, top_p=top_p, top_k=top_k, min_p=min_p, key=sample_key)
-            samples.append(sample)
-
-        def score_sample(sample):
-            log_prob = jnp.sum(jax.nn.log_softmax(logits) * jax.nn.one_hot(sample, logits.shape[-1]))
-            confidence_score = (
-                (1 - metrics["logits_entropy"]) * cfg.ada_score_logits_ent +
-                (1 - metrics["attn_entropy"]) * cfg.ada_score_attn_ent +
-                (1 - metrics["logits_varentropy"]) * cfg.ada_score_logits_vent +
-                (1 - metrics["attn_varentropy"]) * cfg.ada_score_attn_vent +
-                metrics["agreement"] * cfg.ada_score_agree +
-                metrics["interaction_strength"] * cfg.ada_score_int
-            )
-            return log_prob + confidence_score
-
-        sample_scores = [score_sample(sample) for sample in samples]
-        best_sample_idx = jnp.argmax(jnp.array(sample_scores))
-        return samples[best_sample_idx]
+    `gen_tokens` is (bsz, n_generated); returns (bsz, 1) tokens and (bsz,) branch ids.
+    """
+    asked_question = gen_tokens[:, -1] == clarifying_question_token
+    keys = jax.random.split(key, logits.shape[0])
+    next_tokens, branches = _sample_rows_jit(asked_question, logits, attn_stats.last_layer, cfg, clarifying_question_token, keys)
+    count_branches(branches)
+    return next_tokens, branches
+
+def sample_positions(input_tokens: jax.Array, logits: jax.Array, attn_stats: AttnStats, cfg: SamplerConfig,
+                     clarifying_question_token: int = 2564, key=jax.random.PRNGKey(1337)) -> Tuple[jax.Array, jax.Array]:
+    """
+    `sample_jit` at every position of one sequence's multi-token forward pass, as if each position
+    had been decoded on its own step with the same `key`, or with its own key when `key` is (seqlen, 2).
+
+    `input_tokens` (seqlen,) are the tokens fed at those positions, `logits` (1, seqlen, vocab) and
+    `attn_stats` the forward pass's statistics. Returns (seqlen,) tokens and branch ids.
+    """
+    asked_question = input_tokens == clarifying_question_token
+    keys = key if key.ndim == 2 else jnp.broadcast_to(key, (logits.shape[1],) + key.shape)
+    # Each position becomes a row of its own: (1, ..., seqlen) -> (seqlen, ..., 1)
+    row_stats = jax.tree.map(lambda x: jnp.moveaxis(x[0], -1, 0)[..., None], attn_stats.last_layer)
+    tokens, branches = _sample_rows_jit(asked_question, logits[0][:, None], row_stats, cfg, clarifying_question_token, keys)
+    return tokens[:, 0], branches
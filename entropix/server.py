@@ -0,0 +1,336 @@
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import tyro
+
+from entropix import instrumentation
+from entropix.config import LLAMA_1B_PARAMS, ModelParams
+from entropix.kvcache import KVCache, bucket_len
+from entropix.main import DEFAULT_WEIGHTS_PATH, precompute_freqs_cis, prefill
+from entropix.model import xfmr, xfmr_scan
+from entropix.paged_kvcache import BlockAllocator, PagedKVCache
+from entropix.prompts import create_chat_prompt
+from entropix.sampler import SamplerConfig, sample_rows
+from entropix.tokenizer import Tokenizer
+from entropix.weights import load_weights, stack_weights
+
+STOP_TOKENS = (128001, 128008, 128009)
+
+
+class Request:
+  """A single generation request; the engine thread pushes text pieces, then None, onto `output`."""
+
+  def __init__(self, tokens: List[int], max_tokens: int):
+    self.id = uuid.uuid4().hex
+    self.tokens = tokens
+    self.max_tokens = max_tokens
+    self.generated: List[int] = []
+    self.finish_reason: Optional[str] = None
+    self.cancelled = False
+    self.timer = instrumentation.TokenTimer()
+    self.output: queue.Queue = queue.Queue()
+
+  def stream(self) -> Iterator[str]:
+    while (piece := self.output.get()) is not None:
+      yield piece
+
+
+class Engine:
+  """
+  Continuous-batching decode loop over a fixed set of `max_batch` cache rows.
+
+  Every step first prefills waiting requests into free rows, then runs one batched decode step
+  for all occupied rows, each at its own position, and evicts rows that finished.
+
+  With `chunk_size > 0` a step prefills at most `chunk_size` prompt tokens per new row, so a
+  long prompt is spread over several steps instead of stalling the rows already decoding.
+
+  With `block_size > 0` the rows share a `PagedKVCache` pool of `n_blocks` blocks instead of
+  each owning a dense `max_seq_len` cache row, so memory follows the tokens actually in flight.
+  """
+
+  def __init__(self, xfmr_weights, model_params: ModelParams, tokenizer: Tokenizer, max_batch: int = 8,
+               compiled: bool = False, sampler_cfg: SamplerConfig = SamplerConfig(), seed: int = 1337,
+               block_size: int = 0, n_blocks: int = 0, chunk_size: int = 0):
+    self.xfmr_weights = xfmr_weights
+    self.model_params = model_params
+    self.tokenizer = tokenizer
+    self.detokenizer = tokenizer.stream()
+    self.forward = xfmr_scan if compiled else xfmr
+    self.chunk_size = chunk_size
+    self.sampler_cfg = sampler_cfg
+    self.key = jax.random.PRNGKey(seed)
+    self.freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+    self.allocator = BlockAllocator(n_blocks, block_size) if block_size > 0 else None
+    self.table_width = model_params.max_seq_len // block_size if block_size > 0 else 0
+    self.n_blocks, self.block_size = n_blocks, block_size
+    self.slots: List[Optional[Request]] = [None] * max_batch
+    self.kvcache = self._new_kvcache()
+    self.positions = np.zeros(max_batch, dtype=np.int32)  # cache column the row's next token is written to
+    self.prefilling: Dict[int, int] = {}  # slot -> prompt tokens already in the cache
+    self.last_tokens = np.full(max_batch, tokenizer.pad_id, dtype=np.int32)
+    self.pending: queue.Queue = queue.Queue()
+    self.waiting: deque = deque()
+    self.n_steps = 0
+
+  def _new_kvcache(self):
+    params = self.model_params
+    if self.allocator is None:
+      return KVCache.new(params.n_layers, len(self.slots), params.max_seq_len, params.n_local_kv_heads, params.head_dim)
+    block_table = self.allocator.block_table([None] * len(self.slots), self.table_width)
+    return PagedKVCache.new(params.n_layers, self.n_blocks, self.block_size, params.n_local_kv_heads, params.head_dim, block_table)
+
+  def submit(self, tokens: List[int], max_tokens: int) -> Request:
+    request = Request(tokens[-(self.model_params.max_seq_len - 1):], max_tokens)
+    self.pending.put(request)
+    return request
+
+  def _emit(self, slot: int, token: int):
+    request = self.slots[slot]
+    request.generated.append(token)
+    self.last_tokens[slot] = token
+    if token in STOP_TOKENS:
+      request.finish_reason = 'stop'
+    else:
+      request.timer.token()
+      piece = self.detokenizer.decode([token], request.id)
+      if piece:
+        request.output.put(piece)
+      if len(request.generated) >= request.max_tokens or self.positions[slot] >= self.model_params.max_seq_len - 1:
+        request.finish_reason = 'length'
+    if request.cancelled and request.finish_reason is None:
+      request.finish_reason = 'cancelled'
+    if request.finish_reason is not None:
+      self._evict(slot)
+
+  def _evict(self, slot: int):
+    piece = self.detokenizer.flush(self.slots[slot].id)
+    if piece:
+      self.slots[slot].output.put(piece)
+    self.slots[slot].output.put(None)
+    self.slots[slot] = None
+    self.prefilling.pop(slot, None)
+    if self.allocator is not None:
+      self.allocator.free(slot)
+
+  def _prefill(self, slot: int):
+    """Writes the next prompt chunk of `slot` to the cache and emits the first token after the last one."""
+    request = self.slots[slot]
+    start = self.prefilling[slot]
+    end = len(request.tokens) if self.chunk_size <= 0 else min(start + self.chunk_size, len(request.tokens))
+    tokens = jnp.array([request.tokens[start:end]], jnp.int32)
+    if self.allocator is not None:
+      kvcache = self.kvcache._replace(block_table=jnp.asarray(self.allocator.block_table([slot], self.table_width)))
+    elif start == 0 and end == len(request.tokens):
+      kvcache = KVCache.new(self.model_params.n_layers, 1, end, self.model_params.n_local_kv_heads, self.model_params.head_dim)
+    else:
+      kvcache = KVCache(k=self.kvcache.k[:, slot:slot + 1], v=self.kvcache.v[:, slot:slot + 1])
+    logits, kvcache = prefill(self.forward, self.xfmr_weights, self.model_params, tokens, start, self.freqs_cis, kvcache)
+    self.kvcache = kvcache if self.allocator is not None else self.kvcache.insert(slot, kvcache)
+    # Decode steps still write this row at `positions`; the next chunk overwrites that column.
+    self.positions[slot] = end
+    if end < len(request.tokens):
+      self.prefilling[slot] = end
+      return
+    del self.prefilling[slot]
+    self._emit(slot, int(jnp.argmax(logits[0, -1])))
+
+  def _admit(self, block: bool):
+    if block and not self.waiting:
+      self.waiting.append(self.pending.get())
+    while not self.pending.empty():
+      self.waiting.append(self.pending.get_nowait())
+    for slot in range(len(self.slots)):
+      if not self.waiting:
+        return
+      if self.slots[slot] is not None:
+        continue
+      request = self.waiting[0]
+      if self.allocator is not None and not self.allocator.allocate(slot, len(request.tokens) + 1):
+        if any(r is not None for r in self.slots):
+          return  # wait for running sequences to give blocks back
+        self.waiting.popleft()
+        print(f'Request {request.id} does not fit in the KV block pool')
+        request.finish_reason = 'length'
+        request.output.put(None)
+        continue
+      self.waiting.popleft()
+      self.slots[slot] = request
+      self.prefilling[slot] = 0
+
+  def step(self) -> bool:
+    """Admits waiting requests, advances their prefill and decodes one token for every running row; False when idle."""
+    self._admit(block=False)
+    for slot in list(self.prefilling):
+      try:
+        self._prefill(slot)
+      except Exception as e:
+        print(f'Prefill failed for request {self.slots[slot].id}: {e!r}')
+        self.slots[slot].finish_reason = 'error'
+        self._evict(slot)
+    active = [i for i, r in enumerate(self.slots) if r is not None and i not in self.prefilling]
+    if self.allocator is not None:
+      for slot in list(active):
+        if not self.allocator.allocate(slot, int(self.positions[slot]) + 1):
+          self.slots[slot].finish_reason = 'length'  # the pool is exhausted
+          self._evict(slot)
+          active.remove(slot)
+      block_table = self.allocator.block_table([i if i in active else None for i in range(len(self.slots))], self.table_width)
+      self.kvcache = self.kvcache._replace(block_table=jnp.asarray(block_table))
+    if not active:
+      return bool(self.prefilling)
+    positions = jnp.array(self.positions)
+    tokens = jnp.array(self.last_tokens)[:, None]
+    kv_len = bucket_len(max(int(self.positions[i]) for i in active) + 1, self.kvcache.max_seq_len)
+    try:
+      logits, self.kvcache, stats = self.forward(self.xfmr_weights, self.model_params, tokens, positions, self.freqs_cis[positions][:, None], self.kvcache, kv_len=kv_len)
+      next_tokens, _ = sample_rows(tokens, logits, stats, cfg=self.sampler_cfg, key=jax.random.fold_in(self.key, self.n_steps))
+      next_tokens = next_tokens[:, 0].tolist()
+    except Exception as e:
+      print(f'Decode failed for requests {[self.slots[slot].id for slot in active]}: {e!r}')
+      for slot in active:
+        self.slots[slot].finish_reason = 'error'
+        self._evict(slot)
+      # A compiled forward donated the cache, so no row of it can be trusted; rows still in prefill start over.
+      self.kvcache = self._new_kvcache()
+      for slot in self.prefilling:
+        self.prefilling[slot] = 0
+      return True
+    self.n_steps += 1
+    for slot in active:
+      self.positions[slot] += 1
+      self._emit(slot, next_tokens[slot])
+    return True
+
+  def run(self):
+    while True:
+      if not self.step():
+        self._admit(block=True)
+
+
+def _completion_chunk(request_id: str, model: str, piece: str, finish_reason: Optional[str], chat: bool) -> dict:
+  if chat:
+    choice = {'index': 0, 'delta': {'content': piece} if piece else {}, 'finish_reason': finish_reason}
+  else:
+    choice = {'index': 0, 'text': piece, 'finish_reason': finish_reason}
+  return {'id': request_id, 'object': 'chat.completion.chunk' if chat else 'text_completion',
+          'created': int(time.time()), 'model': model, 'choices': [choice]}
+
+
+def make_handler(engine: Engine, model: str):
+  tokenizer = engine.tokenizer
+
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status: int, body: dict):
+      data = json.dumps(body).encode()
+      self.send_response(status)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def do_GET(self):
+      if self.path == '/v1/models':
+        self._send_json(200, {'object': 'list', 'data': [{'id': model, 'object': 'model', 'owned_by': 'entropix'}]})
+      elif self.path == '/metrics':
+        data = instrumentation.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+      else:
+        self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+    def do_POST(self):
+      chat = self.path == '/v1/chat/completions'
+      if not chat and self.path != '/v1/completions':
+        self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+        return
+      try:
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        prompt = create_chat_prompt(body['messages']) if chat else body['prompt']
+        if not isinstance(prompt, str):
+          raise TypeError('prompt must be a string')
+        max_tokens = body.get('max_tokens')
+        max_tokens = 256 if max_tokens is None else max_tokens
+        if type(max_tokens) is not int or max_tokens < 1:
+          raise ValueError('max_tokens must be a positive integer')
+        tokens = tokenizer.encode(prompt, bos=False, eos=False, allowed_special='all')
+      except (KeyError, TypeError, ValueError) as e:
+        self._send_json(400, {'error': {'message': f'Invalid request: {e}'}})
+        return
+      if not tokens:
+        self._send_json(400, {'error': {'message': 'Invalid request: empty prompt'}})
+        return
+      request = engine.submit(tokens, max_tokens=max_tokens)
+      request_id = ('chatcmpl-' if chat else 'cmpl-') + request.id
+      if body.get('stream'):
+        self._stream(request, request_id, chat)
+      else:
+        text = ''.join(request.stream())
+        choice = {'index': 0, 'finish_reason': request.finish_reason}
+        choice.update({'message': {'role': 'assistant', 'content': text}} if chat else {'text': text})
+        n_completion = len(request.generated) - (request.finish_reason == 'stop')
+        self._send_json(200, {
+          'id': request_id, 'object': 'chat.completion' if chat else 'text_completion', 'created': int(time.time()),
+          'model': model, 'choices': [choice],
+          'usage': {'prompt_tokens': len(tokens), 'completion_tokens': n_completion, 'total_tokens': len(tokens) + n_completion},
+        })
+
+    def _stream(self, request: Request, request_id: str, chat: bool):
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/event-stream')
+      self.send_header('Cache-Control', 'no-cache')
+      self.send_header('Connection', 'close')
+      self.end_headers()
+      self.close_connection = True
+      try:
+        if chat:
+          first = _completion_chunk(request_id, model, '', None, chat)
+          first['choices'][0]['delta'] = {'role': 'assistant'}
+          self.wfile.write(f'data: {json.dumps(first)}\n\n'.encode())
+        for piece in request.stream():
+          self.wfile.write(f'data: {json.dumps(_completion_chunk(request_id, model, piece, None, chat))}\n\n'.encode())
+          self.wfile.flush()
+        last = _completion_chunk(request_id, model, '', request.finish_reason, chat)
+        self.wfile.write(f'data: {json.dumps(last)}\n\ndata: [DONE]\n\n'.encode())
+        self.wfile.flush()
+      except (BrokenPipeError, ConnectionResetError):
+        request.cancelled = True
+
+  return Handler
+
+
+def main(weights_path: Path = DEFAULT_WEIGHTS_PATH.joinpath('1B-Instruct'), host: str = '127.0.0.1', port: int = 8000,
+         max_batch: int = 8, compiled: bool = False, model: str = 'llama-3.2-1b-instruct',
+         block_size: int = 0, n_blocks: int = 1024, chunk_size: int = 0, metrics: bool = False):
+  """`metrics` turns on the timing hooks; `GET /metrics` serves them in the Prometheus text format."""
+  if metrics:
+    instrumentation.enable()
+  model_params = LLAMA_1B_PARAMS
+  xfmr_weights = load_weights(weights_path.absolute())
+  if compiled:
+    xfmr_weights = stack_weights(xfmr_weights)
+  tokenizer = Tokenizer('entropix/tokenizer.model')
+  engine = Engine(xfmr_weights, model_params, tokenizer, max_batch=max_batch, compiled=compiled, block_size=block_size, n_blocks=n_blocks, chunk_size=chunk_size)
+  threading.Thread(target=engine.run, daemon=True).start()
+  server = ThreadingHTTPServer((host, port), make_handler(engine, model))
+  print(f'Serving {model} on http://{host}:{port}/v1')
+  server.serve_forever()
+
+
+if __name__ == '__main__':
+  tyro.cli(main)
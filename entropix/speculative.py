@@ -0,0 +1,141 @@
+from typing import Dict, List, Optional, Tuple
+
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+
+from entropix.config import ModelParams
+from entropix.kvcache import KVCache, bucket_len
+from entropix.main import precompute_freqs_cis, prefill
+from entropix.model import xfmr, xfmr_scan
+from entropix.sampler import SamplerConfig
+from entropix.tokenizer import Tokenizer
+
+
+@partial(jax.jit, static_argnames=("top_k",))
+def sampling_probs(logits: jax.Array, temperature: float, top_p: float, top_k: int) -> jax.Array:
+  """
+  (n, vocab) distribution `sampler._sample` draws from for (n, vocab) `logits` at these settings.
+
+  Same filtering as `_sample`: top-k, then its top-p mask over the ascending top-k probabilities.
+  Like `_sample`, min_p is not applied.
+  """
+  probs = jax.nn.softmax(logits.astype(jnp.float32) / temperature, axis=-1)
+  top_k_probs, top_k_indices = jax.lax.top_k(probs, k=top_k)
+  probs_sort = jnp.flip(top_k_probs, axis=-1)
+  probs_idx = jnp.flip(top_k_indices, axis=-1)
+  probs_sum = jnp.cumsum(probs_sort, axis=-1)
+  probs_sort = jnp.where(probs_sum - probs_sort > top_p, 0.0, probs_sort)
+  probs_sort = probs_sort / jnp.sum(probs_sort, axis=-1, keepdims=True)
+  rows = jnp.arange(logits.shape[0])[:, None]
+  return jnp.zeros_like(probs).at[rows, probs_idx].set(probs_sort)
+
+
+@jax.jit
+def verify_drafts(key: jax.Array, target_probs: jax.Array, draft_probs: jax.Array, drafts: jax.Array) -> Tuple[jax.Array, jax.Array]:
+  """
+  Speculative sampling correction for `drafts` (gamma,) sampled from `draft_probs` (gamma, vocab),
+  given the target's `target_probs` (gamma + 1, vocab) at the same positions and one past them.
+
+  Draft i is kept with probability min(1, p(x) / q(x)). The first rejected draft is replaced by a
+  sample from max(0, p - q) renormalized, and if all are kept a bonus token is drawn from the last
+  target distribution, so every emitted token is distributed exactly as the target's. Returns the
+  number of kept drafts and the token that follows them.
+  """
+  gamma = drafts.shape[0]
+  accept_key, sample_key = jax.random.split(key)
+  rows = jnp.arange(gamma)
+  ratio = target_probs[rows, drafts] / draft_probs[rows, drafts]
+  accepted = jax.random.uniform(accept_key, (gamma,)) < ratio
+  n_accepted = jnp.argmin(jnp.append(accepted, False))
+  # A zero row past the drafts turns the residual into the plain target distribution for the bonus token.
+  draft_probs = jnp.concatenate([draft_probs, jnp.zeros_like(target_probs[:1])])
+  residual = jnp.maximum(target_probs[n_accepted] - draft_probs[n_accepted], 0.0)
+  residual = jnp.where(jnp.sum(residual) > 0, residual, target_probs[n_accepted])
+  return n_accepted, jax.random.categorical(sample_key, jnp.log(residual))
+
+
+def generate_speculative(target_weights, target_params: ModelParams, draft_weights, draft_params: ModelParams, tokens: List[int],
+                         cfg: SamplerConfig = SamplerConfig(), gamma: int = 4, max_new_tokens: int = 256, compiled: bool = False,
+                         key: jax.Array = jax.random.PRNGKey(1337), tokenizer: Optional[Tokenizer] = None) -> Tuple[List[int], Dict[str, float]]:
+  """
+  Samples from the target model at `cfg`'s temperature/top-k/top-p, `gamma` tokens drafted by the
+  draft model per target forward pass. The two models must share a tokenizer.
+
+  Each model keeps its own `KVCache` holding every token but the newest. The draft catches up on
+  the tokens it has not seen and samples `gamma` tokens one at a time; the target scores the newest
+  token plus the drafts in one pass and `verify_drafts` decides what is kept. Rejected drafts stay
+  in both caches past the valid length, hidden by the position mask until overwritten.
+  `gamma=0` is plain sampling from the target. Returns the generated tokens and acceptance counts.
+  """
+  forward = xfmr_scan if compiled else xfmr
+  stop = (128001, 128008, 128009)
+  seq = list(tokens)
+  n_prompt = len(seq)
+  target_freqs = precompute_freqs_cis(target_params.head_dim, target_params.max_seq_len, target_params.rope_theta, target_params.use_scaled_rope)
+  draft_freqs = precompute_freqs_cis(draft_params.head_dim, draft_params.max_seq_len, draft_params.rope_theta, draft_params.use_scaled_rope)
+  target_cache = KVCache.new(target_params.n_layers, 1, target_params.max_seq_len, target_params.n_local_kv_heads, target_params.head_dim)
+  draft_cache = KVCache.new(draft_params.n_layers, 1, draft_params.max_seq_len, draft_params.n_local_kv_heads, draft_params.head_dim)
+  if n_prompt > 1:
+    prompt = jnp.array([seq[:-1]], jnp.int32)
+    _, target_cache = prefill(forward, target_weights, target_params, prompt, 0, target_freqs, target_cache)
+    if gamma > 0:
+      _, draft_cache = prefill(forward, draft_weights, draft_params, prompt, 0, draft_freqs, draft_cache)
+  target_pos = draft_pos = n_prompt - 1  # cache lengths; seq[-1] is in neither cache
+  max_len = min(target_params.max_seq_len, draft_params.max_seq_len)
+  n_rounds = n_drafted = n_accepted = 0
+
+  detokenizer = tokenizer.stream() if tokenizer is not None else None
+
+  def probs(logits):
+    return sampling_probs(logits[0], cfg.temp, cfg.top_p, cfg.top_k)
+
+  while len(seq) - n_prompt < max_new_tokens and len(seq) < max_len and (len(seq) == n_prompt or seq[-1] not in stop):
+    key, round_key = jax.random.split(key)
+    draft_keys = jax.random.split(round_key, gamma + 1)
+    n_draft = min(gamma, max_len - len(seq))
+    drafts, draft_probs = [], []
+    step = seq[draft_pos:]
+    for i in range(n_draft):
+      n = len(step)
+      logits, draft_cache, _ = forward(draft_weights, draft_params, jnp.array([step], jnp.int32), draft_pos, draft_freqs[draft_pos:draft_pos + n],
+                                       draft_cache, kv_len=bucket_len(draft_pos + n, draft_params.max_seq_len), with_stats=False)
+      draft_pos += n
+      q = probs(logits[:, -1:])[0]
+      drafts.append(int(jax.random.categorical(draft_keys[i], jnp.log(q))))
+      draft_probs.append(q)
+      step = drafts[-1:]
+
+    step = seq[-1:] + drafts
+    n = len(step)
+    logits, target_cache, _ = forward(target_weights, target_params, jnp.array([step], jnp.int32), target_pos, target_freqs[target_pos:target_pos + n],
+                                      target_cache, kv_len=bucket_len(target_pos + n, target_params.max_seq_len), with_stats=False)
+    draft_probs = jnp.stack(draft_probs) if drafts else jnp.zeros((0, logits.shape[-1]), jnp.float32)
+    accepted, next_token = verify_drafts(draft_keys[-1], probs(logits), draft_probs, jnp.array(drafts, jnp.int32))
+    accepted, next_token = int(accepted), int(next_token)
+    new_tokens = drafts[:accepted] + [next_token]
+    for i, token in enumerate(new_tokens):
+      if token in stop:
+        new_tokens = new_tokens[:i + 1]
+        break
+    seq += new_tokens
+    target_pos = len(seq) - 1
+    draft_pos = min(draft_pos, len(seq) - 1)
+    n_rounds += 1
+    n_drafted += len(drafts)
+    n_accepted += accepted
+    if detokenizer is not None:
+      print(detokenizer.decode(new_tokens), end='', flush=True)
+  if detokenizer is not None:
+    print(detokenizer.flush(), end='', flush=True)
+
+  gen_tokens = seq[n_prompt:n_prompt + max_new_tokens]
+  stats = {
+    'n_target_forward': n_rounds,
+    'n_drafted': n_drafted,
+    'n_accepted': n_accepted,
+    'acceptance_rate': n_accepted / max(n_drafted, 1),
+    'tokens_per_target_forward': len(gen_tokens) / max(n_rounds, 1),
+  }
+  return gen_tokens, stats
@@ -0,0 +1,81 @@
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import jax
+import tyro
+
+from entropix.config import LLAMA_1B_PARAMS, ModelParams
+from entropix.main import DEFAULT_WEIGHTS_PATH, generate_lookup
+from entropix.prompts import prompt
+from entropix.speculative import generate_speculative
+from entropix.tokenizer import Tokenizer
+from entropix.weights import load_weights, random_weights, stack_weights
+
+
+def compare_lookup(xfmr_weights, model_params, prompt_tokens: List[int], k: int = 4, max_new_tokens: int = 256,
+                   compiled: bool = False) -> Dict[str, Dict[str, float]]:
+  """Wall time of prompt-lookup decoding against plain decoding (`k=0`) of the same prompt, plus its acceptance counts."""
+  report, outputs = {}, {}
+  for name, draft_k in (('baseline', 0), ('lookup', k)):
+    generate_lookup(xfmr_weights, model_params, prompt_tokens, compiled=compiled, k=draft_k, max_new_tokens=max_new_tokens)  # warm-up
+    start = time.perf_counter()
+    outputs[name], stats = generate_lookup(xfmr_weights, model_params, prompt_tokens, compiled=compiled, k=draft_k, max_new_tokens=max_new_tokens)
+    elapsed = time.perf_counter() - start
+    report[name] = {**stats, 'n_tokens': len(outputs[name]), 'seconds': elapsed, 'tokens_per_sec': len(outputs[name]) / elapsed}
+  report['lookup']['speedup'] = report['baseline']['seconds'] / report['lookup']['seconds']
+  report['lookup']['same_tokens'] = float(outputs['lookup'] == outputs['baseline'])
+  return report
+
+
+def compare_draft(target_weights, target_params, draft_weights, draft_params, prompt_tokens: List[int], gamma: int = 4,
+                  max_new_tokens: int = 256, compiled: bool = False) -> Dict[str, Dict[str, float]]:
+  """Wall time of draft-model speculative sampling against sampling from the target alone (`gamma=0`), plus its acceptance counts."""
+  report = {}
+  for name, draft_gamma in (('baseline', 0), ('draft', gamma)):
+    def run(gamma=draft_gamma):
+      return generate_speculative(target_weights, target_params, draft_weights, draft_params, prompt_tokens, gamma=gamma,
+                                  max_new_tokens=max_new_tokens, compiled=compiled)
+
+    run()  # warm-up
+    start = time.perf_counter()
+    out, stats = run()
+    elapsed = time.perf_counter() - start
+    report[name] = {**stats, 'n_tokens': len(out), 'seconds': elapsed, 'tokens_per_sec': len(out) / elapsed}
+  report['draft']['speedup'] = report['baseline']['seconds'] / report['draft']['seconds']
+  return report
+
+
+def main(weights_path: Path = DEFAULT_WEIGHTS_PATH.joinpath('1B-Instruct'), k: int = 4, max_new_tokens: int = 256, compiled: bool = False,
+         json_out: Optional[Path] = None, draft_weights_path: Optional[Path] = None, random_models: bool = False):
+  """
+  Prompt-lookup decoding against plain decoding by default. With `draft_weights_path` (a second
+  checkpoint of the same config) or `random_models` (a 4-layer target and 1-layer draft with random
+  weights, runs on CPU), draft-model speculative sampling with `k` drafts per round instead.
+  """
+  if random_models:
+    target_params = ModelParams(n_layers=4, n_local_heads=8, n_local_kv_heads=2, head_dim=64, max_seq_len=1024, rope_theta=500000.0, use_scaled_rope=True)
+    draft_params = target_params._replace(n_layers=1, n_local_heads=4, head_dim=32)
+    target_weights, draft_weights = random_weights(target_params, 4096, seed=0), random_weights(draft_params, 4096, seed=1)
+    tokens = jax.random.randint(jax.random.PRNGKey(0), (64,), 0, 4096).tolist()
+  else:
+    target_params = draft_params = LLAMA_1B_PARAMS
+    target_weights = load_weights(weights_path.absolute())
+    draft_weights = load_weights(draft_weights_path.absolute()) if draft_weights_path is not None else None
+    tokenizer = Tokenizer('entropix/tokenizer.model')
+    tokens = tokenizer.encode(prompt, bos=False, eos=False, allowed_special='all')
+  if compiled:
+    target_weights = stack_weights(target_weights)
+    draft_weights = stack_weights(draft_weights) if draft_weights is not None else None
+  if draft_weights is None:
+    report = compare_lookup(target_weights, target_params, tokens, k=k, max_new_tokens=max_new_tokens, compiled=compiled)
+  else:
+    report = compare_draft(target_weights, target_params, draft_weights, draft_params, tokens, gamma=k, max_new_tokens=max_new_tokens, compiled=compiled)
+  for mode, metrics in report.items():
+    print(mode, ' '.join(f'{name}={value:.4g}' for name, value in metrics.items()))
+  if json_out is not None:
+    json_out.write_text(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+  tyro.cli(main)
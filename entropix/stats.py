@@ -1,20 +1,55 @@
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 import jax
 import jax.numpy as jnp
 
+class LayerStats(NamedTuple):
+  entropy: jax.Array  # (bsz, num_heads, seqlen)
+  varentropy: jax.Array  # (bsz, num_heads, seqlen)
+  agreement: jax.Array  # (bsz, seqlen)
+  interaction_strength: jax.Array  # (bsz, seqlen)
+
+  @classmethod
+  def new(cls, bsz: int, n_heads: int, seqlen: int) -> 'LayerStats':
+    return cls(
+        entropy=jnp.zeros((bsz, n_heads, seqlen), dtype=jnp.float32),
+        varentropy=jnp.zeros((bsz, n_heads, seqlen), dtype=jnp.float32),
+        agreement=jnp.zeros((bsz, seqlen), dtype=jnp.float32),
+        interaction_strength=jnp.zeros((bsz, seqlen), dtype=jnp.float32)
+    )
+
+
+def layer_stats(probs: jax.Array, scores: jax.Array, valid: jax.Array) -> LayerStats:
+  """
+  Per query position statistics of one attention layer, from the float32 `probs` it attends with.
+
+  `scores` are the unmasked scaled scores and `valid` the slots the query can see, all
+  (bsz, n_heads, seqlen, kv_len). Masked slots carry no weight.
+  """
+  probs = jnp.where(valid, probs, 0)
+  log_probs = jnp.log(jnp.where(probs > 0, probs, 1))
+  entropy = -jnp.sum(probs * log_probs, axis=-1)
+  varentropy = jnp.sum(probs * (log_probs + entropy[..., None])**2, axis=-1)
+  mean_probs = jnp.mean(probs, axis=1, keepdims=True)
+  agreement = jnp.sum(jnp.mean(jnp.abs(probs - mean_probs), axis=1), axis=-1) / jnp.sum(valid.any(axis=1), axis=-1)
+  interaction_strength = jnp.sum(jnp.where(valid, jnp.abs(scores), 0), axis=(1, 3)) / jnp.sum(valid, axis=(1, 3))
+  return LayerStats(entropy=entropy, varentropy=varentropy, agreement=agreement, interaction_strength=interaction_strength)
+
+
 class AttnStats(NamedTuple):
-  entropy: jax.Array  # (bsz, n_layers, num_heads)
+  entropy: jax.Array  # (bsz, n_layers, num_heads), at the last query position
   varentropy: jax.Array  # (bsz, n_layers, num_heads)
   n_layers: int
   n_heads: int
+  last_layer: Optional[LayerStats] = None  # every query position of the final layer, what the sampler reads
 
   @classmethod
-  def new(cls, bsz: int, n_layers: int, n_heads: int) -> 'AttnStats':
+  def new(cls, bsz: int, n_layers: int, n_heads: int, seqlen: int = 1) -> 'AttnStats':
     return cls(
         entropy=jnp.zeros((bsz, n_layers, n_heads), dtype=jnp.float32),
         varentropy=jnp.zeros((bsz, n_layers, n_heads), dtype=jnp.float32),
         n_layers=n_layers,
-        n_heads=n_heads
+        n_heads=n_heads,
+        last_layer=LayerStats.new(bsz, n_heads, seqlen)
     )
 
   @property
@@ -25,21 +60,10 @@ class AttnStats(NamedTuple):
   def std_error(self):
     return jnp.sqrt(jnp.mean(self.varentropy)) / (self.n_heads * self.n_layers)
 
-  def update(self, scores: jax.Array, layer_idx: int):
-    # scores shape: (bsz, n_heads, seqlen, n_words)
-    probs = jax.nn.softmax(scores, axis=-1)
-    new_entropy = -jnp.sum(jnp.where(probs > 0, probs * jnp.log(probs), 0), axis=-1)
-    new_varentropy = jnp.sum(probs * (jnp.log(probs) + new_entropy[..., None])**2, axis=-1)
-
-    # print(f"Layer {layer_idx} - Scores shape: {scores.shape}, Probs shape: {probs.shape}")
-    # print(f"Layer {layer_idx} - New entropy shape: {new_entropy.shape}, Min: {jnp.min(new_entropy)}, Max: {jnp.max(new_entropy)}")
-
-    updated_stats = self._replace(
-        entropy=self.entropy.at[:, layer_idx, :].set(new_entropy),
-        varentropy=self.varentropy.at[:, layer_idx, :].set(new_varentropy)
+  def update(self, stats: LayerStats, layer_idx: int):
+    # stats come from `attention`, layers are visited in order so the last update is the final layer
+    return self._replace(
+        entropy=self.entropy.at[:, layer_idx, :].set(stats.entropy[:, :, -1]),
+        varentropy=self.varentropy.at[:, layer_idx, :].set(stats.varentropy[:, :, -1]),
+        last_layer=stats
     )
-
-    # print(f"Layer {layer_idx} - Updated entropy shape: {updated_stats.entropy.shape}")
-    # print(f"Layer {layer_idx} - Updated entropy for this layer: {updated_stats.entropy[:, layer_idx, :]}")
-
-    return updated_stats
\ No newline at end of file
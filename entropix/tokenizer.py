@@ -1,4 +1,7 @@
 import os
+import re
+import threading
+from collections import OrderedDict
 from logging import getLogger
 from pathlib import Path
 from typing import (
@@ -6,6 +9,8 @@ from typing import (
   cast,
   Collection,
   Dict,
+  FrozenSet,
+  Hashable,
   Iterator,
   List,
   Literal,
@@ -30,6 +35,11 @@ TIKTOKEN_MAX_ENCODE_CHARS = 400_000
 # of max consecutive non-whitespace or whitespace characters.
 MAX_NO_WHITESPACES_CHARS = 25_000
 
+# Longest text between special tokens kept in the encode cache.
+MAX_CACHED_CHARS = 4096
+
+_RUN = re.compile(r'\s+|\S+')
+
 
 class Tokenizer:
   """
@@ -42,12 +52,13 @@ class Tokenizer:
 
   pat_str = r"(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"  # noqa: E501
 
-  def __init__(self, model_path: str):
+  def __init__(self, model_path: str, cache_size: int = 1024):
     """
     Initializes the Tokenizer with a Tiktoken model.
 
     Args:
         model_path (str): The path to the Tiktoken model file.
+        cache_size (int): Number of encoded text pieces kept by `encode`.
     """
     assert os.path.isfile(model_path), model_path
 
@@ -92,6 +103,10 @@ class Tokenizer:
       self.special_tokens['<|eom_id|>'],
       self.special_tokens['<|eot_id|>'],
     ]
+    self.cache_size = cache_size
+    self._cache: OrderedDict[str, List[int]] = OrderedDict()
+    self._cache_lock = threading.Lock()
+    self._special_regexes: Dict[FrozenSet[str], re.Pattern[str]] = {}
 
   def encode(
     self,
@@ -123,31 +138,81 @@ class Tokenizer:
     - Setting `allowed_special` to "all" will treat all text corresponding
       to special tokens to be encoded as special tokens.
     """
+    return self.encode_batch(
+      [s], bos=bos, eos=eos, allowed_special=allowed_special, disallowed_special=disallowed_special, num_threads=1
+    )[0]
+
+  def encode_batch(
+    self,
+    texts: Sequence[str],
+    *,
+    bos: bool,
+    eos: bool,
+    allowed_special: Optional[Union[Literal['all'], AbstractSet[str]]] = None,
+    disallowed_special: Union[Literal['all'], Collection[str]] = (),
+    num_threads: int = 8,
+  ) -> List[List[int]]:
+    """
+    Encodes several strings, same arguments and result as `encode` for each.
+
+    Text between special tokens is encoded on `num_threads` threads with tiktoken's batch encoder,
+    each distinct piece once. Pieces up to `MAX_CACHED_CHARS` long, like the fixed parts of a prompt
+    template, are kept in an LRU cache of `cache_size` entries and not encoded again.
+    """
     if allowed_special is None:
       allowed_special = set()
-    assert isinstance(s, str)
-
-    substrs = (
-      substr
-      for i in range(0, len(s), TIKTOKEN_MAX_ENCODE_CHARS)
-      for substr in self._split_whitespaces_or_nonwhitespaces(
-        s[i : i + TIKTOKEN_MAX_ENCODE_CHARS], MAX_NO_WHITESPACES_CHARS
-      )
-    )
-    t: List[int] = []
-    for substr in substrs:
-      t.extend(
-        self.model.encode(
-          substr,
-          allowed_special=allowed_special,
-          disallowed_special=disallowed_special,
-        )
-      )
-    if bos:
-      t.insert(0, self.bos_id)
-    if eos:
-      t.append(self.eos_id)
-    return t
+    allowed = self.model.special_tokens_set if allowed_special == 'all' else set(allowed_special)
+    disallowed = self.model.special_tokens_set - allowed if disallowed_special == 'all' else set(disallowed_special)
+
+    # Each text becomes a list of special token ids and ordinary text pieces.
+    parts: List[List[Union[int, str]]] = []
+    for s in texts:
+      assert isinstance(s, str)
+      if disallowed and (match := self._special_regex(disallowed).search(s)):
+        raise ValueError(f'Encountered text corresponding to disallowed special token {match.group()!r}')
+      text_parts: List[Union[int, str]] = []
+      for i in range(0, len(s), TIKTOKEN_MAX_ENCODE_CHARS):
+        for substr in self._split_whitespaces_or_nonwhitespaces(s[i : i + TIKTOKEN_MAX_ENCODE_CHARS], MAX_NO_WHITESPACES_CHARS):
+          pieces = self._special_regex(allowed).split(substr) if allowed else [substr]
+          for j, piece in enumerate(pieces):
+            if j % 2:
+              text_parts.append(self.special_tokens[piece])
+            elif piece:
+              text_parts.append(piece)
+      parts.append(text_parts)
+
+    encoded: Dict[str, List[int]] = {}
+    with self._cache_lock:
+      for text_parts in parts:
+        for piece in text_parts:
+          if isinstance(piece, str) and piece not in encoded and piece in self._cache:
+            self._cache.move_to_end(piece)
+            encoded[piece] = self._cache[piece]
+    todo = list({piece: None for text_parts in parts for piece in text_parts if isinstance(piece, str) and piece not in encoded})
+    if num_threads > 1 and len(todo) > 1:
+      results = self.model.encode_ordinary_batch(todo, num_threads=num_threads)
+    else:
+      results = [self.model.encode_ordinary(piece) for piece in todo]
+    encoded.update(zip(todo, results))
+    with self._cache_lock:
+      for piece, tokens in zip(todo, results):
+        if len(piece) <= MAX_CACHED_CHARS:
+          self._cache[piece] = tokens
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+
+    out = []
+    for text_parts in parts:
+      t: List[int] = [self.bos_id] if bos else []
+      for piece in text_parts:
+        if isinstance(piece, str):
+          t.extend(encoded[piece])
+        else:
+          t.append(piece)
+      if eos:
+        t.append(self.eos_id)
+      out.append(t)
+    return out
 
   def decode(self, t: Sequence[int]) -> str:
     """
@@ -162,26 +227,89 @@ class Tokenizer:
     # Typecast is safe here. Tiktoken doesn't do anything list-related with the sequence.
     return self.model.decode(cast(List[int], t))
 
+  def decode_batch(self, batch: Sequence[Sequence[int]], num_threads: int = 8) -> List[str]:
+    """`decode` of several token lists on `num_threads` threads."""
+    return self.model.decode_batch(cast(List[List[int]], batch), num_threads=num_threads)
+
+  def stream(self) -> 'StreamingDetokenizer':
+    """A `StreamingDetokenizer` for printing tokens as they are generated."""
+    return StreamingDetokenizer(self)
+
+  def _special_regex(self, tokens: AbstractSet[str]) -> 're.Pattern[str]':
+    """Pattern matching any of `tokens`, with a group so `split` keeps them."""
+    key = frozenset(tokens)
+    if key not in self._special_regexes:
+      self._special_regexes[key] = re.compile('(' + '|'.join(map(re.escape, sorted(key))) + ')')
+    return self._special_regexes[key]
+
   @staticmethod
   def _split_whitespaces_or_nonwhitespaces(s: str, max_consecutive_slice_len: int) -> Iterator[str]:
     """
     Splits the string `s` so that each substring contains no more than `max_consecutive_slice_len`
     consecutive whitespaces or consecutive non-whitespaces.
     """
-    current_slice_len = 0
-    current_slice_is_space = s[0].isspace() if len(s) > 0 else False
-    slice_start = 0
-
-    for i in range(len(s)):
-      is_now_space = s[i].isspace()
-
-      if current_slice_is_space ^ is_now_space:
-        current_slice_len = 1
-        current_slice_is_space = is_now_space
-      else:
-        current_slice_len += 1
-        if current_slice_len > max_consecutive_slice_len:
-          yield s[slice_start:i]
-          slice_start = i
-          current_slice_len = 1
+    if len(s) <= max_consecutive_slice_len:
+      yield s
+      return
+    # Only matches at the start of a run, so the scan stays linear in len(s).
+    long_run = re.compile(rf'(?<!\s)\s{{{max_consecutive_slice_len + 1}}}|(?<!\S)\S{{{max_consecutive_slice_len + 1}}}')
+    slice_start = pos = 0
+    while match := long_run.search(s, pos):
+      run_end = _RUN.match(s, match.start()).end()
+      for cut in range(match.start() + max_consecutive_slice_len, run_end, max_consecutive_slice_len):
+        yield s[slice_start:cut]
+        slice_start = cut
+      pos = run_end
     yield s[slice_start:]
+
+def _complete_utf8_len(buf: bytearray) -> int:
+  """Length of the longest prefix of `buf` that does not end inside a UTF-8 character."""
+  for i in range(len(buf) - 1, max(len(buf) - 4, 0) - 1, -1):
+    b = buf[i]
+    if b & 0xC0 == 0x80:  # continuation byte
+      continue
+    need = 2 if b >> 5 == 0b110 else 3 if b >> 4 == 0b1110 else 4 if b >> 3 == 0b11110 else 1
+    return len(buf) if len(buf) - i >= need else i
+  return len(buf)  # no lead byte in reach, the tail is invalid either way
+
+
+class StreamingDetokenizer:
+  """
+  Incremental decoding of generated tokens, one byte buffer per sequence.
+
+  A token can end partway through a multi-byte UTF-8 character (emoji, CJK, byte-fallback
+  tokens); decoding it alone gives replacement characters. The bytes of each new token are
+  appended to its sequence's buffer and only the complete characters are returned, the rest is
+  held until the tokens that finish them arrive. Concatenating every returned piece and `flush`
+  gives `Tokenizer.decode` of the whole sequence.
+  """
+
+  def __init__(self, tokenizer: Tokenizer):
+    self.tokenizer = tokenizer
+    self.buffers: Dict[Hashable, bytearray] = {}
+
+  def decode(self, tokens: Sequence[int], seq_id: Hashable = 0) -> str:
+    """Text completed by `tokens`, the next tokens of sequence `seq_id`."""
+    data = self.tokenizer.model.decode_bytes(cast(List[int], tokens))
+    buf = self.buffers.get(seq_id)
+    if not buf and data[-1:] < b'\x80':  # nothing held and ends in ASCII, the common case
+      return data.decode('utf-8', errors='replace')
+    if buf is None:
+      buf = self.buffers[seq_id] = bytearray()
+    buf += data
+    n = _complete_utf8_len(buf)
+    if n == 0:
+      return ''
+    text = buf[:n].decode('utf-8', errors='replace')
+    del buf[:n]
+    return text
+
+  def decode_batch(self, tokens: Sequence[Sequence[int]], seq_ids: Optional[Sequence[Hashable]] = None) -> List[str]:
+    """`decode` of the new tokens of several sequences, `seq_ids` defaulting to their index."""
+    seq_ids = range(len(tokens)) if seq_ids is None else seq_ids
+    return [self.decode(t, seq_id) for t, seq_id in zip(tokens, seq_ids)]
+
+  def flush(self, seq_id: Hashable = 0) -> str:
+    """Whatever sequence `seq_id` still holds, incomplete characters replaced; forgets the sequence."""
+    buf = self.buffers.pop(seq_id, None)
+    return buf.decode('utf-8', errors='replace') if buf else ''
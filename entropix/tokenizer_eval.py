@@ -0,0 +1,50 @@
+import json
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import tyro
+
+from entropix.prompts import create_prompts_from_csv
+from entropix.tokenizer import Tokenizer
+
+
+def throughput(fn: Callable[[], object], n_bytes: int, repeat: int) -> float:
+  """Best of `repeat` runs of `fn`, in MB/s of `n_bytes` text."""
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    best = min(best, time.perf_counter() - start)
+  return n_bytes / best / 1e6
+
+
+def compare_encoders(texts: List[str], model_path: str = 'entropix/tokenizer.model', num_threads: int = 8, repeat: int = 5) -> Dict[str, float]:
+  """MB/s of encoding `texts` one at a time against `encode_batch`, without and with the piece cache, and of decoding them back."""
+  n_bytes = sum(len(s.encode()) for s in texts)
+  uncached, cached = Tokenizer(model_path, cache_size=0), Tokenizer(model_path)
+  kwargs = dict(bos=False, eos=False, allowed_special='all')
+  encoded = uncached.encode_batch(texts, **kwargs, num_threads=num_threads)
+  cached.encode_batch(texts, **kwargs)  # fills the cache
+  if [uncached.encode(s, **kwargs) for s in texts] != encoded or cached.encode_batch(texts, **kwargs) != encoded:
+    raise AssertionError('encode_batch disagrees with encode')
+  return {
+    'encode': throughput(lambda: [uncached.encode(s, **kwargs) for s in texts], n_bytes, repeat),
+    'encode_batch': throughput(lambda: uncached.encode_batch(texts, **kwargs, num_threads=num_threads), n_bytes, repeat),
+    'encode_batch_cached': throughput(lambda: cached.encode_batch(texts, **kwargs, num_threads=num_threads), n_bytes, repeat),
+    'decode': throughput(lambda: [uncached.decode(t) for t in encoded], n_bytes, repeat),
+    'decode_batch': throughput(lambda: uncached.decode_batch(encoded, num_threads=num_threads), n_bytes, repeat),
+  }
+
+
+def main(csv_path: Path = Path('entropix/data/prompts.csv'), num_threads: int = 8, repeat: int = 5, json_out: Optional[Path] = None):
+  texts = create_prompts_from_csv(csv_path)
+  report = compare_encoders(texts, num_threads=num_threads, repeat=repeat)
+  print(f'{len(texts)} prompts, {sum(len(s.encode()) for s in texts) / 1e6:.2f} MB')
+  for name, mb_per_sec in report.items():
+    print(f'{name}: {mb_per_sec:.1f} MB/s')
+  if json_out is not None:
+    json_out.write_text(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+  tyro.cli(main)
@@ -0,0 +1,126 @@
+import math
+import time
+from typing import Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from entropix import instrumentation
+from entropix.config import ModelParams
+from entropix.torch_kvcache import KVCache, bucket_len
+from entropix.torch_model import DEFAULT_MASK_VALUE, feed_forward, linear, rms_norm
+from entropix.torch_stats import AttnStats, LayerStats, layer_stats
+from entropix.torch_weights import XfmrWeights
+
+# Device selection, tree is like first apple silicion, then cuda, fallback is cpu.
+if torch.backends.mps.is_available():
+    device = torch.device("mps")
+elif torch.cuda.is_available():
+    device = torch.device("cuda")
+else:
+    device = torch.device("cpu")
+
+
+def rotate(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+    """`apply_rotary_emb` of one (bsz, 1, heads, head_dim) tensor with real (1, head_dim // 2) tables, float32 out."""
+    x = x.float().reshape(*x.shape[:-1], -1, 2)
+    x0, x1 = x[..., 0], x[..., 1]
+    cos, sin = cos.view(1, 1, 1, -1), sin.view(1, 1, 1, -1)
+    return torch.stack((x0 * cos - x1 * sin, x0 * sin + x1 * cos), dim=-1).flatten(-2)
+
+
+class StaticDecoder:
+    """
+    One-token decode step of `torch_model.xfmr` for `torch.compile`.
+
+    Shapes are fixed per `kv_len` bucket, so a generation compiles one graph per bucket it reaches.
+    The position lives in a preallocated one-element tensor that is filled in place, so a new `cur_pos`
+    neither recompiles nor breaks the graph. Rotary tables are real cos/sin buffers indexed by
+    that tensor, and the length mask compares it with a preallocated arange of cache slots.
+    Keys and values are written into `kvcache` in place. Every row of the batch is at `cur_pos`;
+    left-padded batches and extra attention masks stay on `xfmr`.
+
+    `compile=False` runs the same step eagerly.
+    """
+    def __init__(self, xfmr_weights: XfmrWeights, model_params: ModelParams, kvcache: KVCache, freqs_cis: torch.Tensor,
+                 with_stats: bool = True, compile: bool = True, mode: Optional[str] = None):
+        self.xfmr_weights = xfmr_weights
+        self.model_params = model_params
+        self.kvcache = kvcache
+        self.with_stats = with_stats
+        self.cos = freqs_cis.real.float().contiguous()
+        self.sin = freqs_cis.imag.float().contiguous()
+        self.pos = torch.zeros(1, dtype=torch.long, device=device)
+        self.slots = torch.arange(model_params.max_seq_len, device=device)
+        self.layers = torch.arange(model_params.n_layers, device=device).view(-1, 1)
+        self.rows = torch.arange(kvcache.k.shape[1], device=device).view(1, -1)
+        self.step = torch.compile(self._step, fullgraph=True, dynamic=False, mode=mode) if compile else self._step
+
+    def _step(self, tokens: torch.Tensor, pos: torch.Tensor, kv_len: int):
+        params = self.model_params
+        bsz = tokens.shape[0]
+        n_rep = params.n_local_heads // params.n_local_kv_heads
+        cos, sin = self.cos.index_select(0, pos), self.sin.index_select(0, pos)
+        visible = (self.slots[:kv_len] <= pos).view(1, 1, 1, kv_len)
+        h = self.xfmr_weights.tok_embeddings[tokens]
+        entropy, varentropy = [], []
+        stats = None
+        for i, layer_weights in enumerate(self.xfmr_weights.layer_weights):
+            x = rms_norm(h, layer_weights.attention_norm)
+            xq = rotate(linear(x, layer_weights.wq).view(bsz, 1, params.n_local_heads, params.head_dim), cos, sin)
+            xk = rotate(linear(x, layer_weights.wk).view(bsz, 1, params.n_local_kv_heads, params.head_dim), cos, sin)
+            xv = linear(x, layer_weights.wv).view(bsz, 1, params.n_local_kv_heads, params.head_dim)
+            # Writes go through the whole buffer: `index_copy_` into a view of it compiles to a copy of all of it.
+            self.kvcache.k.index_put_((self.layers[i], self.rows, pos), xk[:, 0].to(self.kvcache.k.dtype))
+            self.kvcache.v.index_put_((self.layers[i], self.rows, pos), xv[:, 0].to(self.kvcache.v.dtype))
+            keys, values = self.kvcache.k[i, :, :kv_len], self.kvcache.v[i, :, :kv_len]
+            xq = xq.view(bsz, 1, params.n_local_kv_heads, n_rep, params.head_dim)
+            scores = torch.einsum('bqgrd,bkgd->bgrqk', xq.to(keys.dtype), keys).to(torch.float32)
+            pre_scores = scores.reshape(bsz, params.n_local_heads, 1, kv_len) / math.sqrt(params.head_dim)
+            valid = visible.expand(bsz, params.n_local_heads, 1, kv_len)
+            probs = F.softmax(torch.where(valid, pre_scores, DEFAULT_MASK_VALUE), dim=-1)
+            if self.with_stats:
+                stats = layer_stats(probs, pre_scores, valid)
+                entropy.append(stats.entropy[:, :, -1])
+                varentropy.append(stats.varentropy[:, :, -1])
+            probs = probs.to(values.dtype).view(bsz, params.n_local_kv_heads, n_rep, 1, kv_len)
+            out = torch.einsum('bgrqk,bkgd->bqgrd', probs, values).to(x.dtype).reshape(bsz, 1, -1)
+            h = h + linear(out, layer_weights.wo)
+            h = h + feed_forward(rms_norm(h, layer_weights.ffn_norm), layer_weights)
+        logits = linear(rms_norm(h, self.xfmr_weights.norm), self.xfmr_weights.output)
+        if not self.with_stats:
+            return logits, None
+        return logits, (torch.stack(entropy, dim=1), torch.stack(varentropy, dim=1), stats)
+
+    @instrumentation.instrument('xfmr', 'Forward pass', labels=lambda *args, **kwargs: {'phase': 'decode_compiled'})
+    def decode(self, tokens: torch.Tensor, cur_pos: int, kv_len: Optional[int] = None) -> Tuple[torch.Tensor, Optional[AttnStats]]:
+        """
+        `xfmr(tokens, cur_pos, ...)` for (bsz, 1) `tokens`: the logits and `AttnStats` (None without
+        `with_stats`). `kv_len` defaults to `bucket_len(cur_pos + 1)`.
+        """
+        kv_len = kv_len or bucket_len(cur_pos + 1, self.model_params.max_seq_len)
+        with torch.inference_mode():
+            self.pos.fill_(cur_pos)
+            logits, stats = self.step(tokens, self.pos, kv_len)
+        if stats is None:
+            return logits, None
+        entropy, varentropy, last_layer = stats
+        return logits, AttnStats(entropy=entropy, varentropy=varentropy, n_layers=self.model_params.n_layers,
+                                 n_heads=self.model_params.n_local_heads, last_layer=LayerStats(*last_layer))
+
+    def warmup(self, kv_lens: Optional[Sequence[int]] = None) -> float:
+        """
+        Compiles the step for `kv_lens`, every bucket up to `max_seq_len` by default, and returns
+        the seconds it took. The dummy steps write the last cache slot, which decoding overwrites
+        before it can see it, so this is safe before or after prefill.
+        """
+        max_seq_len = self.model_params.max_seq_len
+        if kv_lens is None:
+            kv_lens = sorted({bucket_len(n, max_seq_len) for n in range(1, max_seq_len + 1)})
+        tokens = torch.zeros((self.kvcache.k.shape[1], 1), dtype=torch.int32, device=device)  # the sampler's dtype
+        start = time.perf_counter()
+        for kv_len in kv_lens:
+            with torch.inference_mode():
+                self.pos.fill_(max_seq_len - 1)
+                self.step(tokens, self.pos, kv_len)
+        return time.perf_counter() - start
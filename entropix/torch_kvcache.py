@@ -1,6 +1,10 @@
 import torch
 import torch.nn as nn
 
+from typing import Optional, Tuple
+
+from entropix import instrumentation
+
 # Device selection, tree is like first apple silicion, then cuda, fallback is cpu.
 if torch.backends.mps.is_available():
     device = torch.device("mps")
@@ -11,6 +15,26 @@ else:
 
 #print(f"Using device: {device}")
 
+def bucket_len(length: int, max_seq_len: int, min_len: int = 128) -> int:
+    """Smallest power-of-two multiple of `min_len` that holds `length` positions, capped at `max_seq_len`."""
+    n = min_len
+    while n < length:
+        n *= 2
+    return min(n, max_seq_len)
+
+KV_QUANT_DTYPES = {'int8': torch.int8, 'fp8': torch.float8_e4m3fn}
+
+def quantize_kv(x: torch.Tensor, dtype: torch.dtype, per_head: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric absmax quantization of (..., kv_heads, head_dim) keys or values; see `kvcache.quantize_kv`."""
+    qmax = float(torch.finfo(dtype).max if dtype.is_floating_point else torch.iinfo(dtype).max)
+    x = x.float()
+    scale = x.abs().amax(dim=-1 if per_head else (-2, -1), keepdim=True)
+    scale = scale.clamp(min=1e-6) / qmax
+    q = x / scale
+    if not dtype.is_floating_point:
+        q = q.round()
+    return q.clamp(-qmax, qmax).to(dtype), scale
+
 class KVCache(nn.Module):
     def __init__(self, layers: int, bsz: int, max_seq_len: int, kv_heads: int, head_dim: int):
         super(KVCache, self).__init__()
@@ -37,13 +61,14 @@ class KVCache(nn.Module):
         """Creates a new KVCache instance with initialized k and v tensors."""
         return cls(layers, bsz, max_seq_len, kv_heads, head_dim)
 
+    @instrumentation.instrument('kvcache_update', 'KV cache write and read', labels=lambda self, *args, **kwargs: {'cache': type(self).__name__})
     def update(
         self,
         xk: torch.Tensor,
         xv: torch.Tensor,
         layer_idx: int,
         cur_pos: int,
-        n_rep: int
+        kv_len: Optional[int] = None
     ):
         """
         Updates the cache with new key and value tensors.
@@ -53,12 +78,12 @@ class KVCache(nn.Module):
             xv (torch.Tensor): New value tensor to insert. Shape should align with (bsz, insert_len, kv_heads, head_dim).
             layer_idx (int): The index of the layer to update.
             cur_pos (int): The current position in the sequence to start inserting.
-            n_rep (int): The number of times to repeat the keys and values along the sequence dimension.
+            kv_len (Optional[int]): Number of cache positions to read back, the whole cache by default.
 
         Returns:
-            Tuple[torch.Tensor, torch.Tensor]:
-                - keys: Updated or repeated keys tensor.
-                - values: Updated or repeated values tensor.
+            Tuple[torch.Tensor, torch.Tensor, KVCache]:
+                - keys: The new keys at position 0, otherwise the layer's first `kv_len` cached keys (kv_heads heads, not repeated).
+                - values: The new values at position 0, otherwise the layer's cached values.
         """
         # Ensure xk and xv have the correct device and dtype
         xk = xk.to(self.k.dtype)
@@ -70,13 +95,13 @@ class KVCache(nn.Module):
         self.v[layer_idx, :, cur_pos:cur_pos+insert_len, :, :] = xv
 
         if cur_pos == 0:
-            # If inserting at the beginning, repeat the new keys and values
-            keys = xk.repeat_interleave(n_rep, dim=2)
-            values = xv.repeat_interleave(n_rep, dim=2)
+            # If inserting at the beginning, attend to the new keys and values only
+            keys = xk
+            values = xv
         else:
-            # Otherwise, repeat the existing keys and values from the cache
-            keys = self.k[layer_idx].repeat_interleave(n_rep, dim=2)
-            values = self.v[layer_idx].repeat_interleave(n_rep, dim=2)
+            # Otherwise, read the existing keys and values from the cache; attention groups the queries per kv head
+            keys = self.k[layer_idx, :, :kv_len]
+            values = self.v[layer_idx, :, :kv_len]
 
         return keys, values, self
 
@@ -84,3 +109,57 @@ class KVCache(nn.Module):
         """Resets the k and v caches to zeros."""
         self.k.zero_()
         self.v.zero_()
+
+
+class QuantizedKVCache(nn.Module):
+    """
+    KV cache stored as int8 or fp8 with float32 absmax scales per position and kv head
+    (`per_head=True`) or per position. Same contract as `KVCache.update`: writes are quantized,
+    reads come back as dequantized bf16, and a fresh prefill attends to its unquantized keys.
+    """
+    def __init__(self, layers: int, bsz: int, max_seq_len: int, kv_heads: int, head_dim: int, dtype: str = 'int8', per_head: bool = True):
+        super(QuantizedKVCache, self).__init__()
+        qdtype = KV_QUANT_DTYPES[dtype]
+        n_scales = kv_heads if per_head else 1
+        self.register_buffer('k', torch.zeros((layers, bsz, max_seq_len, kv_heads, head_dim), dtype=qdtype, device=device))
+        self.register_buffer('v', torch.zeros((layers, bsz, max_seq_len, kv_heads, head_dim), dtype=qdtype, device=device))
+        self.register_buffer('k_scale', torch.zeros((layers, bsz, max_seq_len, n_scales, 1), dtype=torch.float32, device=device))
+        self.register_buffer('v_scale', torch.zeros((layers, bsz, max_seq_len, n_scales, 1), dtype=torch.float32, device=device))
+
+    @classmethod
+    def new(cls, layers: int, bsz: int, max_seq_len: int, kv_heads: int, head_dim: int, dtype: str = 'int8', per_head: bool = True) -> 'QuantizedKVCache':
+        return cls(layers, bsz, max_seq_len, kv_heads, head_dim, dtype, per_head)
+
+    @instrumentation.instrument('kvcache_update', 'KV cache write and read', labels=lambda self, *args, **kwargs: {'cache': type(self).__name__})
+    def update(
+        self,
+        xk: torch.Tensor,
+        xv: torch.Tensor,
+        layer_idx: int,
+        cur_pos: int,
+        kv_len: Optional[int] = None
+    ):
+        per_head = self.k_scale.size(3) > 1
+        qk, sk = quantize_kv(xk, self.k.dtype, per_head)
+        qv, sv = quantize_kv(xv, self.v.dtype, per_head)
+        insert_len = xk.size(1)
+        self.k[layer_idx, :, cur_pos:cur_pos+insert_len] = qk
+        self.v[layer_idx, :, cur_pos:cur_pos+insert_len] = qv
+        self.k_scale[layer_idx, :, cur_pos:cur_pos+insert_len] = sk
+        self.v_scale[layer_idx, :, cur_pos:cur_pos+insert_len] = sv
+
+        if cur_pos == 0:
+            keys = xk.to(torch.bfloat16)
+            values = xv.to(torch.bfloat16)
+        else:
+            keys = (self.k[layer_idx, :, :kv_len].float() * self.k_scale[layer_idx, :, :kv_len]).to(torch.bfloat16)
+            values = (self.v[layer_idx, :, :kv_len].float() * self.v_scale[layer_idx, :, :kv_len]).to(torch.bfloat16)
+
+        return keys, values, self
+
+    def clear(self):
+        """Resets the caches and scales to zeros."""
+        self.k.zero_()
+        self.v.zero_()
+        self.k_scale.zero_()
+        self.v_scale.zero_()
@@ -1,4 +1,4 @@
-from typing import NamedTuple, Optional, Tuple
+from typing import List, NamedTuple, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -9,13 +9,16 @@ import tyro
 from pathlib import Path
 from functools import partial
 
+from entropix import instrumentation
 from entropix.config import LLAMA_1B_PARAMS
+from entropix.mcts import MCTSSearch
 from entropix.tokenizer import Tokenizer
-from entropix.torch_kvcache import KVCache
+from entropix.torch_decode import StaticDecoder
+from entropix.torch_kvcache import KVCache, bucket_len
 from entropix.torch_model import xfmr
 from entropix.torch_weights import XfmrWeights, LayerWeights, load_weights
-from entropix.torch_sampler import sample
-from entropix.prompts import prompt, bp1
+from entropix.torch_sampler import sample, sample_rows
+from entropix.prompts import create_prompts_from_csv, prompt, bp1
 
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -89,7 +92,73 @@ def build_attn_mask(seqlen: int, start_pos: int) -> torch.Tensor:
 
 
 
-def main():
+def build_padded_batch(prompts: List[List[int]], pad_id: int) -> Tuple[torch.Tensor, torch.Tensor]:
+  """Left-pads `prompts` so every row's last prompt token lands in the same cache column."""
+  seqlen = max(len(p) for p in prompts)
+  pad_lens = [seqlen - len(p) for p in prompts]
+  tokens = torch.tensor([[pad_id] * n + list(p) for n, p in zip(pad_lens, prompts)], dtype=torch.long, device=device)
+  return tokens, torch.tensor(pad_lens, dtype=torch.long, device=device)
+
+
+
+def build_padded_attn_mask(seqlen: int, kv_len: int, pad_lens: torch.Tensor, start_pos: int = 0) -> torch.Tensor:
+  """(bsz, 1, seqlen, kv_len) causal mask that also hides each row's left padding."""
+  q_pos = start_pos + torch.arange(seqlen, device=device).unsqueeze(1)
+  k_pos = torch.arange(kv_len, device=device).unsqueeze(0)
+  visible = (k_pos <= q_pos).unsqueeze(0) & (k_pos.unsqueeze(0) >= pad_lens.view(-1, 1, 1))
+  mask = torch.zeros(visible.shape, dtype=torch.float32, device=device).masked_fill(~visible, float("-inf"))
+  return mask.unsqueeze(1)
+
+
+
+def generate_batch(xfmr_weights, model_params, prompts: List[List[int]], pad_id: int) -> List[List[int]]:
+  """
+  Generates for a batch of prompts of different lengths.
+
+  Prompts are left-padded so the cache is written at one shared column per step, while each row
+  keeps its own rotary positions and a padding mask. Every row picks its own entropy quadrant in one
+  `sample_rows` call and stops independently; the returned token lists exclude the stop token.
+  """
+  tokens, pad_lens = build_padded_batch(prompts, pad_id)
+  bsz, seqlen = tokens.shape
+  freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  kvcache = KVCache.new(model_params.n_layers, bsz, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim).to(DEVICE)
+  positions = (torch.arange(seqlen, device=device).unsqueeze(0) - pad_lens.unsqueeze(1)).clamp(min=0)
+  attn_mask = build_padded_attn_mask(seqlen, seqlen, pad_lens)
+  logits, kvcache, _ = xfmr(xfmr_weights, model_params, tokens, 0, freqs_cis[positions], kvcache, attn_mask=attn_mask, with_stats=False)
+  next_token = torch.argmax(logits[:, -1], dim=-1, keepdim=True).to(torch.int32)
+  gen_tokens = next_token
+  stop = torch.tensor([128001, 128008, 128009], device=device, dtype=torch.int32)
+  done = torch.isin(next_token[:, 0], stop)
+  generator = torch.Generator(device=device).manual_seed(1337)
+  cur_pos = seqlen
+  while cur_pos < model_params.max_seq_len and not done.all():
+    kv_len = bucket_len(cur_pos + 1, model_params.max_seq_len)
+    attn_mask = build_padded_attn_mask(1, kv_len, pad_lens, start_pos=cur_pos)
+    logits, kvcache, stats = xfmr(xfmr_weights, model_params, next_token, cur_pos, freqs_cis[cur_pos - pad_lens].unsqueeze(1), kvcache, attn_mask=attn_mask, kv_len=kv_len)
+    next_token, _ = sample_rows(gen_tokens, logits, stats, generator=generator)
+    next_token = torch.where(done.unsqueeze(1), torch.full_like(next_token, pad_id), next_token)
+    gen_tokens = torch.cat((gen_tokens, next_token), dim=1)
+    done = done | torch.isin(next_token[:, 0], stop)
+    cur_pos += 1
+
+  outputs = []
+  for row in gen_tokens.tolist():
+    stops = [i for i, t in enumerate(row) if t in stop.tolist()]
+    outputs.append(row[:stops[0]] if stops else row)
+  return outputs
+
+
+
+def main(metrics_out: Optional[Path] = None, mcts: bool = False, mcts_budget: Optional[int] = None, compiled: bool = False, batch_size: int = 0):
+  """
+  `batch_size` > 0 generates for the prompts of `prompts.csv`, that many at a time (`generate_batch`),
+  instead of the single default prompt. `mcts` picks tokens in out-of-range entropy states by batched
+  rollouts (`MCTSSearch`), `mcts_budget` rollout tokens per search at most. `compiled` decodes with
+  the `torch.compile`d `StaticDecoder`.
+  """
+  if metrics_out is not None:
+    instrumentation.enable()
   with torch.inference_mode():
     model_params = LLAMA_1B_PARAMS
     xfmr_weights = load_weights()
@@ -100,7 +169,8 @@ def main():
     base_raw_tokens1 = tokenizer.encode(bp1, bos=True, eos=False, allowed_special='all')
 
 
-    def generate(xfmr_weights, model_params, tokens):
+    def generate(xfmr_weights, model_params, tokens, compiled=False):
+      timer = instrumentation.TokenTimer()
       gen_tokens = None
       cur_pos = 0
       tokens = torch.tensor([tokens], dtype=torch.long).to(device)
@@ -108,23 +178,52 @@ def main():
       attn_mask = build_attn_mask(seqlen, cur_pos)
       freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
       kvcache = KVCache.new(model_params.n_layers, bsz, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim).to(DEVICE)
-      logits, kvcache, _, _ = xfmr(xfmr_weights, model_params, tokens, cur_pos, freqs_cis[:seqlen], kvcache, attn_mask=attn_mask)
+      searcher = MCTSSearch(xfmr, xfmr_weights, model_params, freqs_cis, budget=mcts_budget) if mcts else None
+      decoder = None
+      if compiled:
+        decoder = StaticDecoder(xfmr_weights, model_params, kvcache, freqs_cis)
+        print(f'compiled decode step in {decoder.warmup([bucket_len(seqlen + 1, model_params.max_seq_len)]):.1f}s')
+      logits, kvcache, _ = xfmr(xfmr_weights, model_params, tokens, cur_pos, freqs_cis[:seqlen], kvcache, attn_mask=attn_mask, with_stats=False)
       next_token = torch.argmax(logits[:, -1], dim=-1, keepdim=True).to(torch.int32)
       gen_tokens = next_token
-      print(tokenizer.decode([next_token.item()]), end='', flush=True)
+      detokenizer = tokenizer.stream()
+      print(detokenizer.decode([next_token.item()]), end='', flush=True)
+      timer.token()
       cur_pos = seqlen
       stop = torch.tensor([128001, 128008, 128009], device=device, dtype=torch.int32)
       while cur_pos < 8192:
+        kv_len = bucket_len(cur_pos + 1, model_params.max_seq_len)
+        if decoder is not None:
+          logits, stats = decoder.decode(next_token, cur_pos, kv_len)
+        else:
+          logits, kvcache, stats = xfmr(xfmr_weights, model_params, next_token, cur_pos, freqs_cis[cur_pos:cur_pos+1], kvcache, kv_len=kv_len)
         cur_pos += 1
-        logits, kvcache, scores, stats = xfmr(xfmr_weights, model_params, next_token, cur_pos, freqs_cis[cur_pos:cur_pos+1], kvcache)
-        next_token = sample(gen_tokens, logits, scores)
+        if searcher is not None and searcher.should_search(logits):
+          next_token = searcher.search(logits, kvcache, cur_pos)
+        else:
+          next_token = sample(gen_tokens, logits, stats)
         gen_tokens = torch.cat((gen_tokens, next_token), dim=1)
-        print(tokenizer.decode(next_token.tolist()[0]), end='', flush=True)
+        print(detokenizer.decode(next_token.tolist()[0]), end='', flush=True)
+        timer.token()
         if torch.isin(next_token, stop).any():
           break
-
-    print(prompt)
-    generate(xfmr_weights, model_params, raw_tokens1)
+      print(detokenizer.flush(), end='', flush=True)
+      if searcher is not None:
+        print(f'\nmcts: {searcher.stats}')
+
+    if batch_size > 0:
+      prompts = create_prompts_from_csv(Path('entropix/data/prompts.csv'))
+      encoded = tokenizer.encode_batch(prompts, bos=False, eos=False, allowed_special='all')
+      for i in range(0, len(encoded), batch_size):
+        outputs = generate_batch(xfmr_weights, model_params, encoded[i:i + batch_size], tokenizer.pad_id)
+        for p, out in zip(prompts[i:i + batch_size], outputs):
+          print(p)
+          print(tokenizer.decode(out))
+    else:
+      print(prompt)
+      generate(xfmr_weights, model_params, raw_tokens1, compiled=compiled)
+  if metrics_out is not None:
+    instrumentation.dump(metrics_out)
 
 if __name__ == '__main__':
   tyro.cli(main)
\ No newline at end of file
@@ -3,10 +3,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from entropix import instrumentation
 from entropix.config import ModelParams
 from entropix.torch_kvcache import KVCache
-from entropix.torch_weights import XfmrWeights, LayerWeights
-from entropix.torch_stats import AttnStats
+from entropix.torch_weights import XfmrWeights, LayerWeights, QuantizedWeight, dequantize
+from entropix.torch_stats import AttnStats, LayerStats, layer_stats
 
 DEFAULT_MASK_VALUE = -0.7 * float(torch.finfo(torch.float32).max)
 
@@ -25,56 +26,83 @@ from typing import Tuple, Optional
 def rms_norm(x: torch.Tensor, w: torch.Tensor, eps: float = 1e-6) -> torch.Tensor:
   return w * (x * torch.rsqrt(torch.pow(x, 2).mean(-1, keepdim=True) + eps))
 
+def linear(x: torch.Tensor, w: torch.Tensor | QuantizedWeight) -> torch.Tensor:
+    """F.linear for a bf16 or weight-only quantized (out_features, in_features) weight, dequantized on the fly."""
+    if isinstance(w, QuantizedWeight):
+        w = dequantize(w, x.dtype)
+    return F.linear(x, w)
+
 def apply_rotary_emb(xq: torch.Tensor, xk: torch.Tensor, freqs_cis: torch.Tensor, dtype: torch.dtype = torch.float32) -> Tuple[torch.Tensor, torch.Tensor]:
     reshape_xq = xq.float().reshape(*xq.shape[:-1], -1, 2)
     reshape_xk = xk.float().reshape(*xk.shape[:-1], -1, 2)
     xq_ = torch.complex(reshape_xq[..., 0], reshape_xq[..., 1])
     xk_ = torch.complex(reshape_xk[..., 0], reshape_xk[..., 1])
-    xq_out = xq_ * freqs_cis.unsqueeze(0).unsqueeze(2)
-    xk_out = xk_ * freqs_cis.unsqueeze(0).unsqueeze(2)
+    # (seqlen, head_dim // 2) is shared by the batch, (bsz, seqlen, head_dim // 2) holds per-row positions
+    freqs_cis = freqs_cis.unsqueeze(0).unsqueeze(2) if freqs_cis.dim() == 2 else freqs_cis.unsqueeze(2)
+    xq_out = xq_ * freqs_cis
+    xk_out = xk_ * freqs_cis
     xq_out = torch.stack((xq_out.real, xq_out.imag), dim=-1).reshape(*xq_out.shape[:-1], -1)
     xk_out = torch.stack((xk_out.real, xk_out.imag), dim=-1).reshape(*xk_out.shape[:-1], -1)
     return xq_out.to(dtype), xk_out.to(dtype)
 
-def attention(x: torch.Tensor, layer_weights: LayerWeights, model_params, cur_pos: int, layer_idx: int, freqs_cis: torch.Tensor, kvcache: KVCache, attn_mask: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, KVCache, torch.Tensor]:
+def length_mask(cur_pos: int | torch.Tensor, seqlen: int, kv_len: int) -> torch.Tensor:
+    """(1 or bsz, 1, seqlen, kv_len) mask of the cache slots written at or before each query's position."""
+    q_pos = torch.as_tensor(cur_pos, device=device).view(-1, 1) + torch.arange(seqlen, device=device)
+    return (torch.arange(kv_len, device=device) <= q_pos.unsqueeze(-1)).unsqueeze(1)
+
+@instrumentation.instrument('attention', 'Attention block per layer', labels=lambda *args, **kwargs: {'layer': args[4]})
+def attention(x: torch.Tensor, layer_weights: LayerWeights, model_params, cur_pos: int, layer_idx: int, freqs_cis: torch.Tensor, kvcache: KVCache, attn_mask: Optional[torch.Tensor] = None, kv_len: Optional[int] = None, with_stats: bool = True) -> Tuple[torch.Tensor, KVCache, Optional[LayerStats]]:
     bsz, _, _ = x.shape
     n_rep = model_params.n_local_heads // model_params.n_local_kv_heads
-    xq = F.linear(x, layer_weights.wq).reshape(bsz, -1, model_params.n_local_heads, model_params.head_dim)
-    xk = F.linear(x, layer_weights.wk).reshape(bsz, -1, model_params.n_local_kv_heads, model_params.head_dim)
-    xv = F.linear(x, layer_weights.wv).reshape(bsz, -1, model_params.n_local_kv_heads, model_params.head_dim)
+    xq = linear(x, layer_weights.wq).reshape(bsz, -1, model_params.n_local_heads, model_params.head_dim)
+    xk = linear(x, layer_weights.wk).reshape(bsz, -1, model_params.n_local_kv_heads, model_params.head_dim)
+    xv = linear(x, layer_weights.wv).reshape(bsz, -1, model_params.n_local_kv_heads, model_params.head_dim)
     xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
-    keys, values, kvcache = kvcache.update(xk, xv, layer_idx, cur_pos, n_rep)
-    xq = torch.permute(xq, (0, 2, 1, 3))  # (bs, n_heads, seqlen, head_dim)
-    keys = torch.permute(keys, (0, 2, 3, 1))  # (bs, n_heads, head_dim, cache_len + seqlen)
-    values = torch.permute(values, (0, 2, 1, 3))  # (bs, n_heads, cache_len + seqlen, head_dim)
-    scores = torch.matmul(xq, keys)
+    keys, values, kvcache = kvcache.update(xk, xv, layer_idx, cur_pos, kv_len)  # (bs, cache_len, n_kv_heads, head_dim)
+    # Query head h reads kv head h // n_rep, so group the queries instead of repeating the cache.
+    # The query is cast to the cache dtype rather than upcasting the whole cache.
+    xq = xq.reshape(bsz, -1, model_params.n_local_kv_heads, n_rep, model_params.head_dim)
+    scores = torch.einsum('bqgrd,bkgd->bgrqk', xq.to(keys.dtype), keys).to(torch.float32)
+    scores = scores.reshape(bsz, model_params.n_local_heads, xq.shape[1], -1)  # (bs, n_heads, seqlen, cache_len)
     pre_scores = scores / math.sqrt(model_params.head_dim)
     scores = pre_scores.to(torch.float32)  # Always do attention softmax at float32
-    if cur_pos == 0:
+    if attn_mask is not None:
         scores = scores + attn_mask
-    mask = torch.where(scores != 0.0, scores, DEFAULT_MASK_VALUE)
-    padded_logits = torch.where((mask >= DEFAULT_MASK_VALUE * 0.5), scores, DEFAULT_MASK_VALUE)
-    scores = F.softmax(padded_logits, dim=-1).to(torch.float32)
-    output = torch.matmul(scores, values)
-    output = output.transpose(1, 2).reshape(xq.shape[0], xq.shape[2], -1)
-    out = F.linear(output, layer_weights.wo)
-    return out, kvcache, pre_scores
+    if not (isinstance(cur_pos, int) and cur_pos == 0):
+        # Slots past the filled prefix hold zeros or stale keys; hide them by position, not by value.
+        scores = torch.where(length_mask(cur_pos, xq.shape[1], keys.shape[1]), scores, float('-inf'))
+    valid = scores >= DEFAULT_MASK_VALUE * 0.5
+    padded_logits = torch.where(valid, scores, DEFAULT_MASK_VALUE)
+    probs = F.softmax(padded_logits, dim=-1)
+    stats = layer_stats(probs, pre_scores, valid) if with_stats else None
+    scores = probs.to(values.dtype).reshape(bsz, model_params.n_local_kv_heads, n_rep, xq.shape[1], -1)
+    output = torch.einsum('bgrqk,bkgd->bqgrd', scores, values).to(x.dtype)
+    output = output.reshape(bsz, xq.shape[1], -1)
+    out = linear(output, layer_weights.wo)
+    return out, kvcache, stats
 
+@instrumentation.instrument('feed_forward', 'Feed-forward block')
 def feed_forward(x: torch.Tensor, layer_weights: LayerWeights) -> torch.Tensor:
- return F.linear(F.silu(F.linear(x, layer_weights.w1)) * F.linear(x, layer_weights.w3), layer_weights.w2)
+ return linear(F.silu(linear(x, layer_weights.w1)) * linear(x, layer_weights.w3), layer_weights.w2)
 
-def xfmr(xfmr_weights: XfmrWeights, model_params: ModelParams, tokens: torch.Tensor, cur_pos: int, freqs_cis: torch.Tensor, kvcache: KVCache, attn_mask: Optional[torch.Tensor]=None) -> Tuple[torch.Tensor, KVCache, torch.Tensor, AttnStats]:
+@instrumentation.instrument('xfmr', 'Forward pass', labels=lambda *args, **kwargs: {'phase': instrumentation.phase(args[2])})
+def xfmr(xfmr_weights: XfmrWeights, model_params: ModelParams, tokens: torch.Tensor, cur_pos: int, freqs_cis: torch.Tensor, kvcache: KVCache, attn_mask: Optional[torch.Tensor]=None, kv_len: Optional[int]=None, with_stats: bool = True) -> Tuple[torch.Tensor, KVCache, Optional[AttnStats]]:
+    """
+    Returns the logits, the updated cache and the `AttnStats` the sampler reads, or None for them
+    with `with_stats=False` (prefill, plain sampling), which skips the statistics altogether.
+    """
     h = xfmr_weights.tok_embeddings[tokens]
     attn_stats = AttnStats.new(
         bsz=tokens.shape[0],
         n_layers=model_params.n_layers,
         n_heads=model_params.n_local_heads
-    )
+    ) if with_stats else None
     for i in range(model_params.n_layers):
         norm_x = rms_norm(h, xfmr_weights.layer_weights[i].attention_norm)
-        h_attn, kvcache, scores = attention(norm_x, xfmr_weights.layer_weights[i], model_params, cur_pos, i, freqs_cis, kvcache, attn_mask=attn_mask)
-        attn_stats = attn_stats.update(scores[:,:,-1,:], i)
+        h_attn, kvcache, stats = attention(norm_x, xfmr_weights.layer_weights[i], model_params, cur_pos, i, freqs_cis, kvcache, attn_mask=attn_mask, kv_len=kv_len, with_stats=with_stats)
+        if with_stats:
+            attn_stats = attn_stats.update(stats, i)
         h = h + h_attn
         h = h + feed_forward(rms_norm(h, xfmr_weights.layer_weights[i].ffn_norm), xfmr_weights.layer_weights[i])
-    logits = F.linear(rms_norm(h, xfmr_weights.norm), xfmr_weights.output)
-    return logits, kvcache, scores, attn_stats
\ No newline at end of file
+    logits = linear(rms_norm(h, xfmr_weights.norm), xfmr_weights.output)
+    return logits, kvcache, attn_stats
\ No newline at end of file
@@ -0,0 +1,86 @@
+import torch
+import torch.nn as nn
+
+from typing import Optional
+
+from entropix import instrumentation
+
+# Device selection, tree is like first apple silicion, then cuda, fallback is cpu.
+if torch.backends.mps.is_available():
+    device = torch.device("mps")
+elif torch.cuda.is_available():
+    device = torch.device("cuda")
+else:
+    device = torch.device("cpu")
+
+
+class PagedKVCache(nn.Module):
+    def __init__(self, layers: int, n_blocks: int, block_size: int, kv_heads: int, head_dim: int, block_table: torch.Tensor):
+        super(PagedKVCache, self).__init__()
+        self.block_size = block_size
+        # Shared pool of blocks; `block_table[b, i]` holds logical positions [i * block_size, (i + 1) * block_size) of row b.
+        self.register_buffer('k', torch.zeros((layers, n_blocks, block_size, kv_heads, head_dim), dtype=torch.bfloat16, device=device))
+        self.register_buffer('v', torch.zeros((layers, n_blocks, block_size, kv_heads, head_dim), dtype=torch.bfloat16, device=device))
+        self.register_buffer('block_table', torch.as_tensor(block_table, dtype=torch.long, device=device))
+
+    @classmethod
+    def new(cls, layers: int, n_blocks: int, block_size: int, kv_heads: int, head_dim: int, block_table: torch.Tensor) -> 'PagedKVCache':
+        """Creates a block pool; see `entropix.paged_kvcache.BlockAllocator` for managing `block_table`."""
+        return cls(layers, n_blocks, block_size, kv_heads, head_dim, block_table)
+
+    @property
+    def max_seq_len(self) -> int:
+        return self.block_table.shape[1] * self.block_size
+
+    def set_block_table(self, block_table) -> 'PagedKVCache':
+        self.block_table = torch.as_tensor(block_table, dtype=torch.long, device=self.k.device)
+        return self
+
+    @instrumentation.instrument('kvcache_update', 'KV cache write and read', labels=lambda self, *args, **kwargs: {'cache': type(self).__name__})
+    def update(
+        self,
+        xk: torch.Tensor,
+        xv: torch.Tensor,
+        layer_idx: int,
+        cur_pos: int | torch.Tensor,
+        kv_len: Optional[int] = None
+    ):
+        """
+        Writes new keys/values through the block table; same contract as `KVCache.update`.
+
+        Args:
+            xk (torch.Tensor): New key tensor of shape (bsz, insert_len, kv_heads, head_dim).
+            xv (torch.Tensor): New value tensor of shape (bsz, insert_len, kv_heads, head_dim).
+            layer_idx (int): The index of the layer to update.
+            cur_pos (int | torch.Tensor): Logical start position, shared or one per row.
+            kv_len (Optional[int]): Number of logical positions to read back, all of them by default.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor, PagedKVCache]:
+                - keys/values: the fresh keys at `cur_pos == 0`, otherwise every row's logical view of
+                  the first `kv_len` positions. Pool blocks are reused without being cleared, so
+                  positions past each row's length hold stale keys; `attention` masks them by length.
+        """
+        bsz, insert_len = xk.shape[:2]
+        pos = torch.as_tensor(cur_pos, device=xk.device).view(-1, 1) + torch.arange(insert_len, device=xk.device)
+        pos = pos.expand(bsz, insert_len)
+        blocks = torch.gather(self.block_table, 1, pos // self.block_size)
+        offsets = pos % self.block_size
+        self.k[layer_idx, blocks, offsets] = xk.to(self.k.dtype)
+        self.v[layer_idx, blocks, offsets] = xv.to(self.v.dtype)
+
+        if isinstance(cur_pos, int) and cur_pos == 0:
+            keys = xk.to(self.k.dtype)
+            values = xv.to(self.v.dtype)
+        else:
+            keys = self.gather(self.k[layer_idx], kv_len)
+            values = self.gather(self.v[layer_idx], kv_len)
+
+        return keys, values, self
+
+    def gather(self, pool: torch.Tensor, kv_len: Optional[int] = None) -> torch.Tensor:
+        """(n_blocks, block_size, ...) layer pool -> (bsz, kv_len, ...) logical view, all table slots by default."""
+        kv_len = self.max_seq_len if kv_len is None else kv_len
+        table = self.block_table[:, :-(-kv_len // self.block_size)]
+        bsz, width = table.shape
+        return pool[table].reshape(bsz, width * self.block_size, *pool.shape[2:])[:, :kv_len]
@@ -1,6 +1,10 @@
 import torch
 import torch.nn.functional as F
-from typing import Tuple, Dict
+from typing import Dict, Optional, Tuple
+
+from entropix import instrumentation
+from entropix.sampler import BRANCH_NAMES
+from entropix.torch_stats import AttnStats, LayerStats
 
 # Device selection, tree is like first apple silicion, then cuda, fallback is cpu.
 if torch.backends.mps.is_available():
@@ -51,26 +55,63 @@ def _sample(logits: torch.Tensor, temperature=0.666, top_p=0.90, top_k=27, min_p
     next_token_g = torch.gather(probs_idx, -1, next_token.reshape(bsz, 1).to(torch.int64))
     return next_token_g.to(torch.int32)
 
-def calculate_metrics(logits: torch.Tensor, attention_scores: torch.Tensor) -> Dict[str, torch.Tensor]:
+def _sample_n(logits: torch.Tensor, n_samples: int, temperature=0.666, top_p=0.90, top_k=27, generator: torch.Generator = None) -> torch.Tensor:
+    """
+    `n_samples` calls of `_sample` from a single softmax and top-k: (n_samples, bsz, 1) tokens.
+
+    The noise is drawn call by call from `generator`, so the tokens are the ones the calls give.
+    Like `_sample`, min_p is not applied.
+    """
+    probs = F.softmax(logits[:, -1] / temperature, dim=-1)
+    top_k_probs, top_k_indices = torch.topk(probs, k=min(top_k, probs.shape[-1]))
+    probs_sort = torch.flip(top_k_probs, dims=[-1])
+    probs_idx = torch.flip(top_k_indices, dims=[-1])
+    probs_sum = torch.cumsum(probs_sort, dim=-1)
+    mask = torch.where(probs_sum - probs_sort > top_p, torch.tensor(1.0, device=device), torch.tensor(0.0, device=device))
+    probs_sort = probs_sort * (1 - mask)
+    probs_sort = probs_sort / torch.sum(probs_sort, dim=-1, keepdim=True)
+    q = torch.stack([torch.rand(probs_sort.shape, generator=generator, device=probs_sort.device) for _ in range(n_samples)])
+    next_tokens = torch.argmax(probs_sort / q, dim=-1, keepdim=True)
+    return torch.gather(probs_idx.expand(n_samples, *probs_idx.shape), -1, next_tokens).to(torch.int32)
+
+def _sample_rows(logits: torch.Tensor, n_samples: int, temperature: torch.Tensor, top_p: torch.Tensor, top_k: torch.Tensor,
+                 max_k: int, generator: Optional[torch.Generator] = None) -> torch.Tensor:
+    """
+    `_sample_n` with a (bsz,) `temperature`, `top_p` and `top_k` per row, `top_k` at most `max_k`.
+
+    A row keeps the last `top_k` of its ascending top `max_k` and weighs the rest 0, so its top-p
+    cut sees the running sums `_sample` does. Like `_sample`, min_p is not applied.
+    """
+    probs = F.softmax(logits[:, -1] / temperature.unsqueeze(-1), dim=-1)
+    max_k = min(max_k, probs.shape[-1])
+    top_k_probs, top_k_indices = torch.topk(probs, k=max_k)
+    probs_sort = torch.flip(top_k_probs, dims=[-1])
+    probs_idx = torch.flip(top_k_indices, dims=[-1])
+    in_top_k = torch.arange(max_k, device=probs.device) >= max_k - top_k.unsqueeze(-1)
+    probs_sort = torch.where(in_top_k, probs_sort, 0.0)
+    probs_sum = torch.cumsum(probs_sort, dim=-1)
+    probs_sort = torch.where(probs_sum - probs_sort > top_p.unsqueeze(-1), 0.0, probs_sort)
+    probs_sort = probs_sort / torch.sum(probs_sort, dim=-1, keepdim=True)
+    q = torch.rand((n_samples, *probs_sort.shape), generator=generator, device=probs_sort.device)
+    next_tokens = torch.argmax(probs_sort / q, dim=-1, keepdim=True)
+    return torch.gather(probs_idx.expand(n_samples, *probs_idx.shape), -1, next_tokens).to(torch.int32)
+
+def calculate_metrics(logits: torch.Tensor, attn_stats: LayerStats) -> Dict[str, torch.Tensor]:
+    """Sampler metrics from the logits and the last layer's statistics that `attention` computed."""
     entropy, varentropy = calculate_varentropy_logsoftmax(logits)
-    attention_probs = F.softmax(attention_scores, dim=-1)
-    attn_entropy = -torch.sum(attention_probs * torch.log2(torch.clamp(attention_probs, 1e-10, 1.0)), dim=-1)
+    attn_entropy = attn_stats.entropy / LN_2  # (bsz, n_heads, seqlen), base-2
     attn_varentropy = torch.var(attn_entropy, dim=-1)
     
     # Add a small epsilon to avoid NaN when all values are the same
     attn_varentropy = torch.where(torch.isnan(attn_varentropy), torch.zeros_like(attn_varentropy), attn_varentropy)
-    mean_attention = torch.mean(attention_probs, dim=1)
-    agreement = torch.mean(torch.abs(attention_probs - mean_attention.unsqueeze(1)), dim=(1, 2))
-
-    interaction_strength = torch.mean(torch.abs(attention_scores), dim=(1, 2, 3))
 
     return {
         "logits_entropy": torch.mean(entropy),
         "logits_varentropy": torch.mean(varentropy),
         "attn_entropy": torch.mean(attn_entropy),
         "attn_varentropy": torch.mean(attn_varentropy),
-        "agreement": torch.mean(agreement),
-        "interaction_strength": interaction_strength
+        "agreement": torch.mean(attn_stats.agreement),
+        "interaction_strength": torch.mean(attn_stats.interaction_strength, dim=-1)
     }
 
 def adaptive_sample(logits: torch.Tensor, metrics: Dict[str, torch.Tensor],
@@ -87,44 +128,29 @@ def adaptive_sample(logits: torch.Tensor, metrics: Dict[str, torch.Tensor],
         min=1,
         max=100
     ).item())
-    min_p = torch.clamp(base_min_p * (1 - 0.5 * logits_uncertainty), 0.01, 0.5)
-
-    samples = []
-    for _ in range(n_samples):
-        sample = _sample(logits, temperature=temperature, top_p=top_p, top_k=top_k, min_p=min_p, generator=generator)
-        samples.append(sample)
-
-    def score_sample(sample):
-        # Flatten the sample tensor and convert to long (int64)
-        sample_flat = sample.flatten().to(torch.long)
-        
-        # Create one-hot encoding
-        one_hot = F.one_hot(sample_flat, logits.shape[-1])
-        
-        # Reshape log_softmax output to match one_hot
-        log_probs = F.log_softmax(logits, dim=-1).view(-1, logits.shape[-1])
-        
-        # Calculate log probability
-        log_prob = torch.sum(log_probs * one_hot)
-        
-        confidence_score = (
-            (1 - metrics["logits_entropy"]) * 0.1 +
-            (1 - metrics["attn_entropy"]) * 0.2 +
-            (1 - metrics["logits_varentropy"]) * 0.3 +
-            (1 - metrics["attn_varentropy"]) * 0.4 +
-            metrics["agreement"] * 0.5 +
-            metrics["interaction_strength"] * 0.6
-        )
-        return log_prob + confidence_score
 
-    sample_scores = torch.stack([score_sample(sample) for sample in samples])
+    samples = _sample_n(logits, n_samples, temperature=temperature, top_p=top_p, top_k=top_k, generator=generator)
+
+    confidence_score = (
+        (1 - metrics["logits_entropy"]) * 0.1 +
+        (1 - metrics["attn_entropy"]) * 0.2 +
+        (1 - metrics["logits_varentropy"]) * 0.3 +
+        (1 - metrics["attn_varentropy"]) * 0.4 +
+        metrics["agreement"] * 0.5 +
+        metrics["interaction_strength"] * 0.6
+    )
+    # Log-probs of the candidates gathered by index, one log_softmax for all of them
+    log_probs = F.log_softmax(logits[:, -1], dim=-1)
+    sample_log_probs = torch.gather(log_probs.expand(n_samples, *log_probs.shape), -1, samples.to(torch.int64))
+    sample_scores = torch.sum(sample_log_probs, dim=(1, 2)) + torch.mean(confidence_score)
     best_sample_idx = torch.argmax(sample_scores)
     return samples[best_sample_idx]
 
-def sample(gen_tokens: torch.Tensor, logits: torch.Tensor, attention_scores: torch.Tensor,
+@instrumentation.instrument('sample', 'Sampling one token')
+def sample(gen_tokens: torch.Tensor, logits: torch.Tensor, attn_stats: AttnStats,
            temperature=0.666, top_p=0.90, top_k=27, min_p: float = 0.0, 
            generator: torch.Generator = torch.Generator(device=device).manual_seed(1337)) -> torch.Tensor:
-    metrics = calculate_metrics(logits, attention_scores)
+    metrics = calculate_metrics(logits, attn_stats.last_layer)
     ent, vent = metrics["logits_entropy"], metrics["logits_varentropy"]
     attn_ent, attn_vent = metrics["attn_entropy"], metrics["attn_varentropy"]
     agreement = metrics["agreement"]
@@ -132,10 +158,12 @@ def sample(gen_tokens: torch.Tensor, logits: torch.Tensor, attention_scores: tor
 
     # Low Entropy, Low Varentropy: "flowing with unspoken intent"
     if ent < 0.1 and vent < 0.1:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[0])
         return torch.argmax(logits[:, -1], dim=-1, keepdim=True).to(torch.int32)
 
     # High Entropy, Low Varentropy: "treading carefully, asking clarifying questions"
     elif ent > 3.0 and vent < 0.1:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[1])
         # Insert a clarifying question token if not already present
         if not torch.isin(gen_tokens[:,-1], torch.tensor([2564], device=device)).any():
             return torch.tensor([[2564]], dtype=torch.int32, device=device)  # Assuming 2564 is our "ask clarifying question" token
@@ -146,12 +174,14 @@ def sample(gen_tokens: torch.Tensor, logits: torch.Tensor, attention_scores: tor
 
     # Low Entropy, High Varentropy: "exploring forks in the path"
     elif ent < 5.0 and vent > 5.0:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[2])
         temp_adj = 1.2 + 0.3 * interaction_strength  # Increase temperature based on interaction strength
         top_k_adj = max(5, int(top_k * (1 + 0.5 * (1 - agreement))))  # Increase top_k when agreement is low
         return _sample(logits, temperature=min(1.5, temperature * temp_adj), top_p=top_p, top_k=top_k_adj, min_p=min_p, generator=generator)
 
     # High Entropy, High Varentropy: "resampling in the mist"
     elif ent > 5.0 and vent > 5.0:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[3])
         # Use high temperature and adjusted top_p based on attention metrics
         temp_adj = 2.0 + 0.5 * attn_vent  # Increase temperature based on attention varentropy
         top_p_adj = max(0.5, top_p - 0.2 * attn_ent)  # Decrease top_p when attention entropy is high
@@ -159,6 +189,7 @@ def sample(gen_tokens: torch.Tensor, logits: torch.Tensor, attention_scores: tor
 
     # Middle ground: use adaptive sampling
     else:
+        instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[4])
         return adaptive_sample(
             logits,
             metrics,
@@ -168,4 +199,61 @@ def sample(gen_tokens: torch.Tensor, logits: torch.Tensor, attention_scores: tor
             base_top_p=top_p,
             base_top_k=top_k,
             generator=generator
-        )
\ No newline at end of file
+        )
+
+@instrumentation.instrument('sample', 'Sampling one token')
+def sample_rows(gen_tokens: torch.Tensor, logits: torch.Tensor, attn_stats: AttnStats,
+                temperature=0.666, top_p=0.90, top_k=27, n_adaptive_samples: int = 5,
+                generator: Optional[torch.Generator] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Batched `sample` where every row picks its own quadrant from its own metrics.
+
+    The quadrants are chosen with `torch.where` masks rather than Python branches: every row gets
+    its quadrant's temperature, top-p and top-k, and one `_sample_rows` call draws the candidates
+    for all of them, so a step has no host syncs. `gen_tokens` is (bsz, n_generated) and `logits`
+    (bsz, 1, vocab); returns (bsz, 1) tokens and (bsz,) branch ids in `BRANCH_NAMES` order.
+    """
+    stats = attn_stats.last_layer
+    entropy, varentropy = calculate_varentropy_logsoftmax(logits)
+    ent, vent = entropy.mean(dim=-1), varentropy.mean(dim=-1)
+    attn_entropy = stats.entropy / LN_2
+    attn_varentropy = torch.var(attn_entropy, dim=-1)
+    attn_varentropy = torch.where(torch.isnan(attn_varentropy), torch.zeros_like(attn_varentropy), attn_varentropy)
+    attn_ent, attn_vent = attn_entropy.mean(dim=(1, 2)), attn_varentropy.mean(dim=1)
+    agreement = stats.agreement.mean(dim=-1)
+    interaction_strength = stats.interaction_strength.mean(dim=-1)
+
+    # The first quadrant that matches wins, as in `sample`'s if/elif chain
+    branch = torch.full(ent.shape, 4, dtype=torch.long, device=ent.device)
+    branch = torch.where((ent > 5.0) & (vent > 5.0), 3, branch)
+    branch = torch.where((ent < 5.0) & (vent > 5.0), 2, branch)
+    branch = torch.where((ent > 3.0) & (vent < 0.1), 1, branch)
+    branch = torch.where((ent < 0.1) & (vent < 0.1), 0, branch)
+
+    ada_temperature = temperature * (1 + 0.3 * (ent + vent) + 0.2 * (attn_ent + attn_vent) - 0.2 * agreement)
+    row_temperature = torch.where(branch == 1, torch.clamp(temperature * (1.3 + 0.2 * attn_ent), max=1.5),
+                      torch.where(branch == 2, torch.clamp(temperature * (1.2 + 0.3 * interaction_strength), max=1.5),
+                      torch.where(branch == 3, torch.clamp(temperature * (2.0 + 0.5 * attn_vent), min=2.0),
+                      torch.where(branch == 4, ada_temperature, temperature))))
+    row_top_p = torch.where(branch == 3, torch.clamp(top_p - 0.2 * attn_ent, min=0.5),
+                torch.where(branch == 4, torch.clamp(top_p * (1 + 0.1 * attn_vent), 0.1, 1.0), top_p))
+    lehv_top_k = torch.clamp((top_k * (1 + 0.5 * (1 - agreement))).long(), min=5)
+    ada_top_k = torch.clamp(torch.round(top_k * (1 + 0.3 * interaction_strength - 0.2 * agreement)), 1, 100).long()
+    row_top_k = torch.where(branch == 2, lehv_top_k, torch.where(branch == 4, ada_top_k, top_k))
+    # agreement is non-negative, so low_ent_high_vent's top-k is at most 1.5 * top_k
+    max_k = max(100, int(1.5 * top_k))
+
+    samples = _sample_rows(logits, n_adaptive_samples, row_temperature, row_top_p, row_top_k.clamp(1, max_k), max_k, generator)
+    # adaptive keeps its most likely candidate; the confidence score is the same for all of a row's candidates
+    log_probs = F.log_softmax(logits[:, -1], dim=-1)
+    sample_log_probs = torch.gather(log_probs.expand(n_adaptive_samples, *log_probs.shape), -1, samples.to(torch.int64))
+    best = torch.gather(samples, 0, torch.argmax(sample_log_probs, dim=0, keepdim=True))[0]
+
+    asked_question = gen_tokens[:, -1:] == 2564
+    next_token = torch.where(branch.unsqueeze(-1) == 4, best, samples[0])
+    next_token = torch.where((branch.unsqueeze(-1) == 1) & ~asked_question, 2564, next_token)
+    next_token = torch.where(branch.unsqueeze(-1) == 0, torch.argmax(logits[:, -1], dim=-1, keepdim=True).to(torch.int32), next_token)
+    if instrumentation.enabled():
+        for b in branch.tolist():
+            instrumentation.inc('sampler_branch', help='Sampler quadrant picks', branch=BRANCH_NAMES[b])
+    return next_token.to(torch.int32), branch
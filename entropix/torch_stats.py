@@ -10,13 +10,38 @@ else:
 
 #print(f"Using device: {device}")
 
-from typing import NamedTuple
+from typing import NamedTuple, Optional
+
+class LayerStats(NamedTuple):
+    entropy: torch.Tensor  # (bsz, num_heads, seqlen)
+    varentropy: torch.Tensor  # (bsz, num_heads, seqlen)
+    agreement: torch.Tensor  # (bsz, seqlen)
+    interaction_strength: torch.Tensor  # (bsz, seqlen)
+
+
+def layer_stats(probs: torch.Tensor, scores: torch.Tensor, valid: torch.Tensor) -> LayerStats:
+    """
+    Per query position statistics of one attention layer, from the float32 `probs` it attends with.
+
+    `scores` are the unmasked scaled scores and `valid` the slots the query can see, all
+    (bsz, n_heads, seqlen, kv_len). Masked slots carry no weight.
+    """
+    probs = torch.where(valid, probs, 0.0)
+    log_probs = torch.log(torch.where(probs > 0, probs, 1.0))
+    entropy = -torch.sum(probs * log_probs, dim=-1)
+    varentropy = torch.sum(probs * (log_probs + entropy.unsqueeze(-1))**2, dim=-1)
+    mean_probs = torch.mean(probs, dim=1, keepdim=True)
+    agreement = torch.sum(torch.mean(torch.abs(probs - mean_probs), dim=1), dim=-1) / torch.sum(valid.any(dim=1), dim=-1)
+    interaction_strength = torch.sum(torch.where(valid, torch.abs(scores), 0.0), dim=(1, 3)) / torch.sum(valid, dim=(1, 3))
+    return LayerStats(entropy=entropy, varentropy=varentropy, agreement=agreement, interaction_strength=interaction_strength)
+
 
 class AttnStats(NamedTuple):
-    entropy: torch.Tensor  # (bsz, n_layers, num_heads)
+    entropy: torch.Tensor  # (bsz, n_layers, num_heads), at the last query position
     varentropy: torch.Tensor  # (bsz, n_layers, num_heads)
     n_layers: int
     n_heads: int
+    last_layer: Optional[LayerStats] = None  # every query position of the final layer, what the sampler reads
 
     @classmethod
     def new(cls, bsz: int, n_layers: int, n_heads: int) -> 'AttnStats':
@@ -35,14 +60,9 @@ class AttnStats(NamedTuple):
     def std_error(self):
         return torch.sqrt(torch.mean(self.varentropy)) / (self.n_heads * self.n_layers)
 
-    def update(self, scores: torch.Tensor, layer_idx: int):
-        # scores shape: (bsz, n_heads, seqlen, n_words)
-        probs = torch.nn.functional.softmax(scores, dim=-1)
-        new_entropy = -torch.sum(torch.where(probs > 0, probs * torch.log(probs), torch.tensor(0.0)), dim=-1)
-        new_varentropy = torch.sum(probs * (torch.log(probs) + new_entropy.unsqueeze(-1))**2, dim=-1)
-
-        # Update entropy and varentropy tensors
-        self.entropy[:, layer_idx, :] = new_entropy
-        self.varentropy[:, layer_idx, :] = new_varentropy
+    def update(self, stats: LayerStats, layer_idx: int):
+        # stats come from `attention`, layers are visited in order so the last update is the final layer
+        self.entropy[:, layer_idx, :] = stats.entropy[:, :, -1]
+        self.varentropy[:, layer_idx, :] = stats.varentropy[:, :, -1]
 
-        return self
\ No newline at end of file
+        return self._replace(last_layer=stats)
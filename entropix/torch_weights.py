@@ -1,15 +1,16 @@
-from typing import List, NamedTuple
+from typing import Callable, List, NamedTuple, Optional, Sequence
 
 
 import torch
 import jax
-import jax.numpy as jnp
 import numpy as np
 
 import ml_dtypes
 
 from pathlib import Path
 
+from entropix.packed import PACKED_NAME, load_packed
+
 # Device selection, tree is like first apple silicion, then cuda, fallback is cpu.
 if torch.backends.mps.is_available():
     device = torch.device("mps")
@@ -20,6 +21,21 @@ else:
 
 #print(f"Using device: {device}")
 
+QUANTIZED_PROJECTIONS = ('wq', 'wk', 'wv', 'wo', 'w1', 'w2', 'w3', 'output')
+
+class QuantizedWeight(NamedTuple):
+  """Weight-only quantized projection, same layout as `weights.QuantizedWeight`."""
+  q: torch.Tensor
+  scale: torch.Tensor
+
+def dequantize(w: QuantizedWeight, dtype: torch.dtype = torch.bfloat16) -> torch.Tensor:
+  q = w.q
+  if q.dtype == torch.uint8:
+    q = torch.stack((q & 0xF, q >> 4), dim=-1).reshape(*q.shape[:-1], -1).to(torch.int8)
+    q = torch.where(q > 7, q - 16, q)
+  groups = q.reshape(*w.scale.shape, -1).float() * w.scale.unsqueeze(-1)
+  return groups.reshape(q.shape).to(dtype)
+
 class LayerWeights(NamedTuple):
   wq: torch.Tensor
   wk: torch.Tensor
@@ -48,36 +64,123 @@ def compare_outputs(torch_output: torch.Tensor, jax_output: jax.Array, atol: flo
     print(f'PyTorch output (first 30): {torch_output_np.flatten()[:30]}')
     raise e
 
-def load_weights(ckpt_dir: Path = Path('weights/1B-Instruct'), n_layers: int = 16):
-  w = {}
-  layer_weights = []
+def host_tensor(a: np.ndarray) -> torch.Tensor:
+  """A torch view of a host array; bf16 bytes are reinterpreted, never converted through float32."""
+  # jnp.save writes bfloat16 as raw 2-byte void ('|V2'), packed checkpoints as ml_dtypes.bfloat16.
+  if a.dtype in (np.dtype('V2'), np.dtype(ml_dtypes.bfloat16)):
+    return torch.from_numpy(a.view(np.int16)).view(torch.bfloat16)
+  return torch.from_numpy(a)
+
+def verify_weight(weight: torch.Tensor, ref: np.ndarray, n_samples: int, seed: int = 0) -> None:
+  """Checks `n_samples` random elements (plus the first and last) of `weight` against the mapped `ref`."""
+  ref = ref.reshape(-1)
+  ref = ref.view(ml_dtypes.bfloat16) if ref.dtype == np.dtype('V2') else ref
+  idx = np.concatenate([[0, ref.size - 1], np.random.default_rng(seed).integers(0, ref.size, n_samples)])
+  sample = weight.reshape(-1)[torch.from_numpy(idx).to(weight.device)]
+  compare_outputs(torch_output=sample, jax_output=ref[idx], atol=0, rtol=0)
+
+class LazyLayers(Sequence):
+  """`layer_weights` that loads layer `i` the first time it is indexed."""
+  def __init__(self, load_layer: Callable[[int], LayerWeights], n_layers: int):
+    self._load_layer = load_layer
+    self._layers: List[Optional[LayerWeights]] = [None] * n_layers
+
+  def __len__(self) -> int:
+    return len(self._layers)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    if self._layers[i] is None:
+      self._layers[i] = self._load_layer(i)
+    return self._layers[i]
+
+def load_weights(ckpt_dir: Path = Path('weights/1B-Instruct'), n_layers: int = 16, quant: Optional[str] = None, verify: int = 0, lazy: bool = True):
+  """
+  Memory-maps `ckpt_dir/weights.packed` when it exists, otherwise the `.npy` per tensor checkpoint,
+  straight into bf16 tensors; on CPU they stay views of the file.
+  `quant='int8'` or `'int4'` takes the projections from `weights.quantize_checkpoint` output instead.
+
+  `verify` > 0 compares that many sampled elements of each tensor with the file. An `output` equal to
+  `tok_embeddings` (tied embeddings) shares its tensor. With `lazy` each layer is moved to `device`
+  on first use rather than up front.
+  """
+  packed = ckpt_dir / PACKED_NAME
+  views = load_packed(packed) if packed.exists() else None
+
+  def mapped(name: str) -> np.ndarray:
+    # Copy-on-write mode gives torch a writable array without reading the file.
+    return views[name] if views is not None else np.load(ckpt_dir / f'{name}.npy', mmap_mode='c')
+
+  def load(name: str):
+    if quant is not None and name.split('.')[-2] in QUANTIZED_PROJECTIONS:
+      if views is not None:
+        return QuantizedWeight(q=host_tensor(views[f'{name}.{quant}.q']).to(device), scale=host_tensor(views[f'{name}.{quant}.scale']).to(device))
+      with np.load(ckpt_dir / f'{name}.{quant}.npz') as qw:
+        return QuantizedWeight(q=torch.from_numpy(qw['q']).to(device), scale=torch.from_numpy(qw['scale']).to(device))
+    ref = mapped(name)
+    weight = host_tensor(ref).to(device)
+    if verify > 0:
+      verify_weight(weight, ref, verify)
+    return weight
+
+  def load_layer(i: int) -> LayerWeights:
+    with torch.inference_mode():
+      return LayerWeights(
+        wq=load(f'layers.{i}.attention.wq.weight'),
+        wk=load(f'layers.{i}.attention.wk.weight'),
+        wv=load(f'layers.{i}.attention.wv.weight'),
+        wo=load(f'layers.{i}.attention.wo.weight'),
+        w1=load(f'layers.{i}.feed_forward.w1.weight'),
+        w2=load(f'layers.{i}.feed_forward.w2.weight'),
+        w3=load(f'layers.{i}.feed_forward.w3.weight'),
+        ffn_norm=load(f'layers.{i}.ffn_norm.weight'),
+        attention_norm=load(f'layers.{i}.attention_norm.weight'),
+      )
+
   with torch.inference_mode():
-    for file in ckpt_dir.glob("*.npy"):
-      name = '.'.join(str(file).split('/')[-1].split('.')[:-1])
-      jax_weight = jnp.load(file=file, mmap_mode='r', allow_pickle=True)
-      #print(f'JAX output (first 30): {jax_weight.flatten()[:30]}')
-      np_weight = np.array(jax_weight).astype(np.float32)
-      weight = torch.from_numpy(np_weight).to(torch.bfloat16).to(device)
-      compare_outputs(torch_output=weight, jax_output=jax_weight)
-      w[name] = weight.to(device)
-    for i in range(n_layers):
-      layer_weights.append(LayerWeights(
-        wq=w[f'layers.{i}.attention.wq.weight'],
-        wk=w[f'layers.{i}.attention.wk.weight'],
-        wv=w[f'layers.{i}.attention.wv.weight'],
-        wo=w[f'layers.{i}.attention.wo.weight'],
-        w1=w[f'layers.{i}.feed_forward.w1.weight'],
-        w2=w[f'layers.{i}.feed_forward.w2.weight'],
-        w3=w[f'layers.{i}.feed_forward.w3.weight'],
-        ffn_norm=w[f'layers.{i}.ffn_norm.weight'],
-        attention_norm=w[f'layers.{i}.attention_norm.weight'],
-      ))
+    tok_embeddings = load('tok_embeddings.weight')
+    # Compare the mapped files on the host so a tied checkpoint never holds two copies on `device`.
+    mapped_tok, mapped_out = host_tensor(mapped('tok_embeddings.weight')), host_tensor(mapped('output.weight'))
+    tied = quant is None and mapped_out.shape == mapped_tok.shape and torch.equal(mapped_out[:1], mapped_tok[:1]) and torch.equal(mapped_out, mapped_tok)
+    output = tok_embeddings if tied else load('output.weight')
+    layer_weights = LazyLayers(load_layer, n_layers) if lazy else [load_layer(i) for i in range(n_layers)]
 
     xfmr_weights = XfmrWeights(
-      tok_embeddings=w['tok_embeddings.weight'],
-      norm=w['norm.weight'],
-      output=w['output.weight'],
+      tok_embeddings=tok_embeddings,
+      norm=load('norm.weight'),
+      output=output,
       layer_weights=layer_weights
     )
 
-    return xfmr_weights
\ No newline at end of file
+    return xfmr_weights
+
+def random_weights(model_params, vocab_size: int, ffn_dim: Optional[int] = None, seed: int = 0) -> XfmrWeights:
+  """Random bf16 weights on `device` with the same distributions as `weights.random_weights` (not the same values)."""
+  dim = model_params.n_local_heads * model_params.head_dim
+  kv_dim = model_params.n_local_kv_heads * model_params.head_dim
+  ffn_dim = ffn_dim or -(-int(1.5 * int(2 * 4 * dim / 3)) // 256) * 256
+  generator = torch.Generator(device=device).manual_seed(seed)
+
+  def normal(*shape, std=None):
+    std = std or shape[-1] ** -0.5
+    return torch.randn(shape, generator=generator, dtype=torch.bfloat16, device=device).mul_(std)
+
+  with torch.inference_mode():
+    layer_weights = [LayerWeights(
+      wq=normal(dim, dim),
+      wk=normal(kv_dim, dim),
+      wv=normal(kv_dim, dim),
+      wo=normal(dim, dim),
+      w1=normal(ffn_dim, dim),
+      w2=normal(dim, ffn_dim),
+      w3=normal(ffn_dim, dim),
+      ffn_norm=torch.ones(dim, dtype=torch.bfloat16, device=device),
+      attention_norm=torch.ones(dim, dtype=torch.bfloat16, device=device),
+    ) for _ in range(model_params.n_layers)]
+    return XfmrWeights(
+      tok_embeddings=normal(vocab_size, dim, std=1.0),
+      norm=torch.ones(dim, dtype=torch.bfloat16, device=device),
+      output=normal(vocab_size, dim),
+      layer_weights=layer_weights
+    )
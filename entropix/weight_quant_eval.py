@@ -0,0 +1,78 @@
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import jax
+import jax.numpy as jnp
+import tyro
+
+from entropix.config import LLAMA_1B_PARAMS
+from entropix.kvcache import KVCache, bucket_len
+from entropix.main import DEFAULT_WEIGHTS_PATH, build_attn_mask, precompute_freqs_cis
+from entropix.model import xfmr, xfmr_scan
+from entropix.prompts import create_prompts_from_csv
+from entropix.tokenizer import Tokenizer
+from entropix.weights import load_weights, quantize_xfmr_weights, stack_weights
+
+QUANT_MODES = {'bf16': None, 'int8': (8, 0), 'int4': (4, 128)}  # (bits, group_size)
+
+
+def perplexity(xfmr_weights, model_params, tokens: List[int]) -> float:
+  """Teacher-forced perplexity of `tokens` from a single causal prefill."""
+  seqlen = len(tokens)
+  freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  kvcache = KVCache.new(model_params.n_layers, 1, seqlen, model_params.n_local_kv_heads, model_params.head_dim)
+  logits, _, _ = xfmr(xfmr_weights, model_params, jnp.array([tokens], jnp.int32), 0, freqs_cis[:seqlen], kvcache, attn_mask=build_attn_mask(seqlen, 0), with_stats=False)
+  logp = jax.nn.log_softmax(logits[0, :-1].astype(jnp.float32), axis=-1)
+  nll = -jnp.take_along_axis(logp, jnp.array(tokens[1:])[:, None], axis=-1).mean()
+  return float(jnp.exp(nll))
+
+
+def decode_tokens_per_sec(stacked_weights, model_params, prompt_tokens: List[int], n_steps: int) -> float:
+  """Greedy decode speed of the compiled `xfmr_scan` path, timed after a warm-up step."""
+  seqlen = len(prompt_tokens)
+  freqs_cis = precompute_freqs_cis(model_params.head_dim, model_params.max_seq_len, model_params.rope_theta, model_params.use_scaled_rope)
+  kvcache = KVCache.new(model_params.n_layers, 1, model_params.max_seq_len, model_params.n_local_kv_heads, model_params.head_dim)
+  logits, kvcache, _ = xfmr_scan(stacked_weights, model_params, jnp.array([prompt_tokens], jnp.int32), 0, freqs_cis[:seqlen], kvcache, attn_mask=build_attn_mask(seqlen, 0), with_stats=False)
+  next_token = jnp.argmax(logits[:, -1], axis=-1, keepdims=True).astype(jnp.int32)
+  kv_len = bucket_len(seqlen + n_steps + 1, model_params.max_seq_len)
+  start = None
+  for step in range(n_steps + 1):
+    if step == 1:
+      next_token.block_until_ready()
+      start = time.perf_counter()
+    cur_pos = seqlen + step
+    logits, kvcache, _ = xfmr_scan(stacked_weights, model_params, next_token, cur_pos, freqs_cis[cur_pos:cur_pos+1], kvcache, kv_len=kv_len)
+    next_token = jnp.argmax(logits[:, -1], axis=-1, keepdims=True).astype(jnp.int32)
+  next_token.block_until_ready()
+  return n_steps / (time.perf_counter() - start)
+
+
+def compare_weight_quant(xfmr_weights, model_params, eval_tokens: List[int], n_steps: int = 32) -> Dict[str, Dict[str, float]]:
+  """Perplexity and decode tokens/sec of bf16 weights against in-memory int8 (per channel) and int4 (groups of 128)."""
+  report = {}
+  for mode, quant in QUANT_MODES.items():
+    weights = xfmr_weights if quant is None else quantize_xfmr_weights(xfmr_weights, *quant)
+    report[mode] = {
+      'weight_bytes': sum(a.nbytes for a in jax.tree_util.tree_leaves(weights)),
+      'perplexity': perplexity(weights, model_params, eval_tokens),
+      'decode_tokens_per_sec': decode_tokens_per_sec(stack_weights(weights), model_params, eval_tokens[:32], n_steps),
+    }
+  return report
+
+
+def main(weights_path: Path = DEFAULT_WEIGHTS_PATH.joinpath('1B-Instruct'), n_eval_tokens: int = 512, n_steps: int = 32, json_out: Optional[Path] = None):
+  model_params = LLAMA_1B_PARAMS
+  xfmr_weights = load_weights(weights_path.absolute())
+  tokenizer = Tokenizer('entropix/tokenizer.model')
+  text = '\n'.join(create_prompts_from_csv('entropix/data/prompts.csv')[:4])
+  tokens = tokenizer.encode(text, bos=True, eos=False, allowed_special='all')[:n_eval_tokens]
+  report = compare_weight_quant(xfmr_weights, model_params, tokens, n_steps=n_steps)
+  for mode, metrics in report.items():
+    print(mode, ' '.join(f'{k}={v:.4g}' for k, v in metrics.items()))
+  if json_out is not None:
+    json_out.write_text(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+  tyro.cli(main)
@@ -1,10 +1,70 @@
-from typing import List, NamedTuple
+from typing import Callable, List, NamedTuple, Optional, Tuple
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 
 from pathlib import Path
 
+from entropix.packed import PACKED_NAME, load_packed
+
+
+QUANTIZED_PROJECTIONS = ('wq', 'wk', 'wv', 'wo', 'w1', 'w2', 'w3', 'output')
+
+
+class QuantizedWeight(NamedTuple):
+  """
+  Weight-only quantized (out_features, in_features) projection.
+
+  `q` is int8, or uint8 holding two int4 values per byte (even input column in the low nibble).
+  `scale` is (out_features, n_groups) float32, one absmax scale per group of input columns.
+  """
+  q: jax.Array
+  scale: jax.Array
+
+
+def quantize_weight(w: np.ndarray, bits: int = 8, group_size: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+  """Symmetric absmax quantization of an (out, in) weight per output channel, or per `group_size` input columns."""
+  w = np.asarray(w, dtype=np.float32)
+  out_features, in_features = w.shape
+  groups = w.reshape(out_features, -1, group_size or in_features)
+  qmax = 2 ** (bits - 1) - 1
+  scale = np.maximum(np.abs(groups).max(axis=-1), 1e-8) / qmax
+  q = np.clip(np.round(groups / scale[..., None]), -qmax, qmax).astype(np.int8).reshape(out_features, in_features)
+  if bits == 4:
+    u = q.astype(np.uint8)
+    q = (u[:, 0::2] & 0xF) | ((u[:, 1::2] & 0xF) << 4)
+  return q, scale.astype(np.float32)
+
+
+def dequantize(w: QuantizedWeight, dtype: jnp.dtype = jnp.bfloat16) -> jax.Array:
+  q = w.q
+  if q.dtype == jnp.uint8:
+    q = jnp.stack((q & 0xF, q >> 4), axis=-1).reshape(*q.shape[:-1], -1).astype(jnp.int8)
+    q = jnp.where(q > 7, q - 16, q)
+  groups = q.reshape(*w.scale.shape, -1).astype(jnp.float32) * w.scale[..., None]
+  return groups.reshape(q.shape).astype(dtype)
+
+
+def quantize_xfmr_weights(xfmr_weights: 'XfmrWeights', bits: int = 8, group_size: int = 0) -> 'XfmrWeights':
+  """Replaces the projections of loaded bf16 weights with `QuantizedWeight`s."""
+  def quantize(w):
+    return QuantizedWeight(*(jnp.asarray(a) for a in quantize_weight(np.asarray(w.astype(jnp.float32)), bits, group_size)))
+  layer_weights = [lw._replace(**{name: quantize(getattr(lw, name)) for name in QUANTIZED_PROJECTIONS[:-1]}) for lw in xfmr_weights.layer_weights]
+  return xfmr_weights._replace(output=quantize(xfmr_weights.output), layer_weights=layer_weights)
+
+
+def quantize_checkpoint(ckpt_dir: Path, bits: int = 8, group_size: int = 0):
+  """Writes `<name>.int<bits>.npz` (q, scale) next to every projection's `<name>.npy` in `ckpt_dir`."""
+  for file in sorted(ckpt_dir.glob("*.npy")):
+    name = '.'.join(str(file).split('/')[-1].split('.')[:-1])
+    if name.split('.')[-2] not in QUANTIZED_PROJECTIONS:
+      continue
+    weight = jnp.load(file=file, mmap_mode='r')
+    q, scale = quantize_weight(np.asarray(weight.astype(jnp.float32)), bits, group_size)
+    print(f'Writing {name} as int{bits} to {ckpt_dir}/{name}.int{bits}.npz')
+    np.savez(ckpt_dir / f'{name}.int{bits}.npz', q=q, scale=scale)
+
 
 class LayerWeights(NamedTuple):
   wq: jax.Array
@@ -25,35 +85,124 @@ class XfmrWeights(NamedTuple):
   layer_weights: List[LayerWeights]
 
 
-def load_weights(ckpt_dir: Path, n_layers: int = 16):
-  w = {}
-  layer_weights = []
+class StackedXfmrWeights(NamedTuple):
+  tok_embeddings: jax.Array
+  norm: jax.Array
+  output: jax.Array
+  layer_weights: LayerWeights  # every field has a leading (n_layers,) axis
+
+
+def stack_weights(xfmr_weights: XfmrWeights) -> StackedXfmrWeights:
+  """Stack the per-layer weights along a leading layer axis so the layers can be `lax.scan`ned."""
+  layer_weights = jax.tree_util.tree_map(lambda *ws: jnp.stack(ws), *xfmr_weights.layer_weights)
+  return StackedXfmrWeights(
+    tok_embeddings=xfmr_weights.tok_embeddings,
+    norm=xfmr_weights.norm,
+    output=xfmr_weights.output,
+    layer_weights=layer_weights
+  )
+
+
+def random_weights(model_params, vocab_size: int, ffn_dim: Optional[int] = None, seed: int = 0, stacked: bool = False) -> XfmrWeights | StackedXfmrWeights:
+  """
+  Random bf16 weights for `model_params`, for tests and benchmarks without a checkpoint: unit
+  Gaussian embeddings, 1/sqrt(fan_in) Gaussian projections and unit norms. `ffn_dim` defaults to
+  Llama's 8/3 * dim * 1.5, rounded up to a multiple of 256.
+
+  `stacked` returns what `stack_weights` would, stacking one field at a time so the per-layer and
+  stacked copies of the projections are never all in memory together.
+  """
+  dim = model_params.n_local_heads * model_params.head_dim
+  kv_dim = model_params.n_local_kv_heads * model_params.head_dim
+  ffn_dim = ffn_dim or -(-int(1.5 * int(2 * 4 * dim / 3)) // 256) * 256
+  keys = iter(jax.random.split(jax.random.PRNGKey(seed), 7 * model_params.n_layers + 2))
+
+  def normal(*shape, std=None):
+    std = std or shape[-1] ** -0.5
+    return (jax.random.normal(next(keys), shape, dtype=jnp.float32) * std).astype(jnp.bfloat16)
+
+  layer_weights = [LayerWeights(
+    wq=normal(dim, dim),
+    wk=normal(kv_dim, dim),
+    wv=normal(kv_dim, dim),
+    wo=normal(dim, dim),
+    w1=normal(ffn_dim, dim),
+    w2=normal(dim, ffn_dim),
+    w3=normal(ffn_dim, dim),
+    ffn_norm=jnp.ones(dim, dtype=jnp.bfloat16),
+    attention_norm=jnp.ones(dim, dtype=jnp.bfloat16),
+  ) for _ in range(model_params.n_layers)]
+  if stacked:
+    fields = {}
+    for field in LayerWeights._fields:
+      fields[field] = jnp.stack([getattr(w, field) for w in layer_weights])
+      layer_weights = [w._replace(**{field: None}) for w in layer_weights]
+    return StackedXfmrWeights(
+      tok_embeddings=normal(vocab_size, dim, std=1.0),
+      norm=jnp.ones(dim, dtype=jnp.bfloat16),
+      output=normal(vocab_size, dim),
+      layer_weights=LayerWeights(**fields)
+    )
+  return XfmrWeights(
+    tok_embeddings=normal(vocab_size, dim, std=1.0),
+    norm=jnp.ones(dim, dtype=jnp.bfloat16),
+    output=normal(vocab_size, dim),
+    layer_weights=layer_weights
+  )
+
+
+def load_weights(ckpt_dir: Path, n_layers: int = 16, quant: Optional[str] = None,
+                 sharding: Optional[Callable[[str, Tuple[int, ...]], jax.sharding.Sharding]] = None):
+  """
+  Loads `ckpt_dir/weights.packed` when it exists, otherwise the `.npy` per tensor checkpoint.
+  `quant='int8'` or `'int4'` takes the projections from `quantize_checkpoint` output instead.
+
+  `sharding(name, shape)` places each tensor across devices; every device then only reads its own
+  slice of the memory-mapped file.
+  """
   try:
     device = jax.devices("gpu")[0]
   except RuntimeError:
     print("GPU not found. Using CPU instead.")
     device = jax.devices("cpu")[0]
-  for file in ckpt_dir.glob("*.npy"):
-    name = '.'.join(str(file).split('/')[-1].split('.')[:-1])
-    weight = jnp.load(file=file, mmap_mode='r', allow_pickle=True)
-    w[name] = jax.device_put(weight, device)
+  packed = ckpt_dir / PACKED_NAME
+  views = load_packed(packed) if packed.exists() else None
+
+  def put(name: str, array: np.ndarray) -> jax.Array:
+    if sharding is None:
+      return jax.device_put(array, device)
+    return jax.make_array_from_callback(array.shape, sharding(name, array.shape), lambda index: array[index])
+
+  def load(name: str):
+    if quant is not None and name.split('.')[-2] in QUANTIZED_PROJECTIONS:
+      if views is not None:
+        return QuantizedWeight(q=put(f'{name}.{quant}.q', views[f'{name}.{quant}.q']), scale=put(f'{name}.{quant}.scale', views[f'{name}.{quant}.scale']))
+      with np.load(ckpt_dir / f'{name}.{quant}.npz') as qw:
+        return QuantizedWeight(q=put(f'{name}.{quant}.q', qw['q']), scale=put(f'{name}.{quant}.scale', qw['scale']))
+    if views is not None:
+      return put(name, views[name])
+    weight = np.load(ckpt_dir / f'{name}.npy', mmap_mode='r')
+    # jnp.save writes bfloat16 as raw 2-byte void.
+    return put(name, weight.view(jnp.bfloat16) if weight.dtype == 'V2' else weight)
+
+  layer_weights = []
   for i in range(n_layers):
     layer_weights.append(LayerWeights(
-      wq=w[f'layers.{i}.attention.wq.weight'],
-      wk=w[f'layers.{i}.attention.wk.weight'],
-      wv=w[f'layers.{i}.attention.wv.weight'],
-      wo=w[f'layers.{i}.attention.wo.weight'],
-      w1=w[f'layers.{i}.feed_forward.w1.weight'],
-      w2=w[f'layers.{i}.feed_forward.w2.weight'],
-      w3=w[f'layers.{i}.feed_forward.w3.weight'],
-      ffn_norm=w[f'layers.{i}.ffn_norm.weight'],
-      attention_norm=w[f'layers.{i}.attention_norm.weight'],
+      wq=load(f'layers.{i}.attention.wq.weight'),
+      wk=load(f'layers.{i}.attention.wk.weight'),
+      wv=load(f'layers.{i}.attention.wv.weight'),
+      wo=load(f'layers.{i}.attention.wo.weight'),
+      w1=load(f'layers.{i}.feed_forward.w1.weight'),
+      w2=load(f'layers.{i}.feed_forward.w2.weight'),
+      w3=load(f'layers.{i}.feed_forward.w3.weight'),
+      ffn_norm=load(f'layers.{i}.ffn_norm.weight'),
+      attention_norm=load(f'layers.{i}.attention_norm.weight'),
     ))
 
   xfmr_weights = XfmrWeights(
-    tok_embeddings=w['tok_embeddings.weight'],
-    norm=w['norm.weight'],
-    output=w['output.weight'],
+    tok_embeddings=load('tok_embeddings.weight'),
+    norm=load('norm.weight'),
+    output=load('output.weight'),
     layer_weights=layer_weights
   )
 
@@ -0,0 +1,16 @@
+import tyro
+from pathlib import Path
+
+from entropix.weights import quantize_checkpoint
+
+
+def main(ckpt_dir: Path = Path('weights/1B-Instruct'), bits: int = 8, group_size: int = 0):
+    """Writes weight-only int8/int4 projections (`<name>.int<bits>.npz`) next to the `.npy` checkpoint.
+
+    `group_size=0` keeps one scale per output channel; int4 wants groups, e.g. `--group-size 128`.
+    """
+    quantize_checkpoint(ckpt_dir, bits=bits, group_size=group_size)
+
+
+if __name__ == "__main__":
+    tyro.cli(main)